@@ -0,0 +1,66 @@
+"""
+In-process API: assemble a source and run it with no files and no stdout.
+
+    program = api.assemble(source)
+    result = api.run(program, [(1, 'a'), (10, 'b')])
+    result.output, result.instr, result.ticks, result.registers
+
+A program is translated and decoded once and can be run any number of
+times. Events are any iterable of (tick, char), see `InterruptController`.
+"""
+
+from typing import Iterable, NamedTuple, Optional, Tuple
+
+import machine
+import translator
+from isa import prepare_program
+
+
+class Program(NamedTuple):
+    """Decoded instructions, the start offset and the label positions."""
+    start: int
+    code: tuple
+    labels: dict[str, int]
+
+
+class RunResult(NamedTuple):
+    """`registers` maps register names to their final values."""
+    output: str
+    instr: int
+    ticks: int
+    registers: dict[str, int]
+    error: Optional[str]
+    halted: bool
+
+
+def assemble(source: str) -> Program:
+    target, labels = translator.translate_with_labels(source)
+    prepare_program(target)
+    return Program(target["start"], machine.decode_program(target["code"]), labels)
+
+
+def build(program: Program, events: Iterable[Tuple[int, str]] = (),
+          config: machine.MachineConfig = machine.MachineConfig(), output=None) -> machine.ControlUnit:
+    return machine.build_machine({"start": program.start, "code": program.code}, events,
+                                 config=config, output=output)
+
+
+def run(program: Program, events: Iterable[Tuple[int, str]] = (),
+        config: machine.MachineConfig = machine.MachineConfig(), backend: str = "step",
+        tracer=None, output=None) -> RunResult:
+    control_unit = build(program, events, config, output)
+    instr = machine.run(control_unit, config.limit, tracer, backend=backend)
+    data_path = control_unit.data_path
+    return RunResult(
+        output=''.join(data_path.output_buf),
+        instr=instr,
+        ticks=control_unit.current_tick(),
+        registers={register.value: value for register, value in data_path.registers_dump().items()},
+        error=control_unit.error,
+        halted=control_unit.halted,
+    )
+
+
+def run_source(source: str, events: Iterable[Tuple[int, str]] = (),
+               config: machine.MachineConfig = machine.MachineConfig(), backend: str = "step") -> RunResult:
+    return run(assemble(source), events, config, backend)
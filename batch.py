@@ -0,0 +1,116 @@
+"""
+Batch runner: simulates many (program, input schedule) jobs on a process pool.
+
+Manifest is a JSONL file, one job per line:
+
+    {"id": "cat-1", "program": "out/cat", "input": "tests/cat_input", "limit": 10000, "memory": 100}
+
+`input` is an input file in the `machine.py` format, or `schedule` gives
+the list of [tick, char] pairs inline. `limit` and `memory` are optional,
+as are the other fields of `machine.MachineConfig`: `program_addr`,
+`stack_top`, `input_addr`, `output_addr` and `tick_limit`.
+A program may be an `.asm` source, translated once through the
+translation cache. Every program is sent to each worker once, when the
+pool starts.
+Results are written as JSONL in completion order.
+"""
+
+import argparse
+import json
+import logging
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import IO, Iterable, Iterator
+
+import machine
+from cache import TranslationCache, program_file_bytes
+from devices import read_events
+from isa import parse_program
+
+DEFAULT_LIMIT = 10000
+DEFAULT_MEMORY = 100
+
+_programs: dict = {}
+
+
+def _init_worker(program_files: dict[str, bytes]):
+    logging.getLogger().setLevel(logging.CRITICAL)
+    for name, data in program_files.items():
+        _programs[name] = parse_program(data)
+
+
+def _run_job(job_id, program_name: str, schedule: list, config: machine.MachineConfig) -> dict:
+    control_unit = machine.build_machine(_programs[program_name], schedule, config=config)
+    instr_counter = machine.run(control_unit, config.limit)
+    return {
+        "id": job_id,
+        "output": ''.join(control_unit.data_path.output_buf),
+        "instr": instr_counter,
+        "ticks": control_unit.current_tick(),
+        "error": control_unit.error,
+    }
+
+
+def job_config(job: dict) -> machine.MachineConfig:
+    return machine.MachineConfig(
+        memory_size=job.get("memory", DEFAULT_MEMORY), limit=job.get("limit", DEFAULT_LIMIT),
+        **{name: job[name] for name in ("program_addr", "stack_top", "input_addr", "output_addr", "tick_limit")
+           if name in job})
+
+
+def read_manifest(lines: Iterable[str]) -> list[dict]:
+    jobs = []
+    for line in lines:
+        if not line.strip():
+            continue
+        job = json.loads(line)
+        if "schedule" not in job:
+            with open(job["input"], encoding='utf-8') as file:
+                job["schedule"] = list(read_events(file))
+        job["schedule"] = [tuple(event) for event in job["schedule"]]
+        jobs.append(job)
+    return jobs
+
+
+def run_batch(jobs: list[dict], workers: int = None, cache: TranslationCache = None) -> Iterator[dict]:
+    program_files = {}
+    for job in jobs:
+        if job["program"] not in program_files:
+            program_files[job["program"]] = program_file_bytes(job["program"], cache)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(program_files,)) as executor:
+        futures = [executor.submit(_run_job, job.get("id", idx), job["program"], job["schedule"], job_config(job))
+                   for idx, job in enumerate(jobs)]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def write_results(results: Iterable[dict], sink: IO[str]):
+    for result in results:
+        sink.write(json.dumps(result) + '\n')
+        sink.flush()
+
+
+def main(args):
+    parser = argparse.ArgumentParser(prog="batch.py")
+    parser.add_argument("manifest")
+    parser.add_argument("--workers", type=int, help="worker processes, all cores by default")
+    parser.add_argument("--output", help="results file, stdout by default")
+    parser.add_argument("--cache-dir", help="translation cache for .asm programs")
+    parser.add_argument("--no-cache", action="store_true")
+    options = parser.parse_args(args)
+    cache = None if options.no_cache else TranslationCache(options.cache_dir)
+
+    with open(options.manifest, encoding='utf-8') as file:
+        jobs = read_manifest(file)
+
+    if options.output:
+        with open(options.output, "w", encoding="utf-8") as sink:
+            write_results(run_batch(jobs, options.workers, cache), sink)
+    else:
+        write_results(run_batch(jobs, options.workers, cache), sys.stdout)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,153 @@
+"""
+Throughput benchmarks for the translator and the simulator.
+
+Workloads are generated at a given scale:
+
+    prob1       -- tests/prob1.asm with the upper bound multiplied by the scale
+    cat         -- tests/cat.asm with a long, densely scheduled input
+    labels      -- a synthetic program with many labels and jumps
+
+For every workload the translator is measured in source bytes per second
+and the simulator in instructions and ticks per second. Results are
+written as JSON and can be compared with a stored baseline: a metric that
+falls below `baseline * (1 - tolerance)` is a regression.
+
+With `--optimize` the workloads are translated with the peephole passes,
+and every result also has `ticks_saved` over the plain translation.
+"""
+
+import argparse
+import json
+import sys
+import time
+
+import machine
+import translator
+from isa import parse_program, prepare_program
+
+METRICS = ["translate_bytes_per_sec", "instr_per_sec", "ticks_per_sec"]
+
+
+def prob1_workload(scale: int):
+    with open("tests/prob1.asm", encoding="utf-8") as file:
+        source = file.read().replace("addi r3, r0, 1000", f"addi r3, r0, {1000 * scale}")
+    return source, [], 20 * 1000 * scale, 100
+
+
+def cat_workload(scale: int):
+    count = 1000 * scale
+    # every interrupt leaves two words on the stack, so memory grows with the input
+    memory = 100 + 2 * count
+    with open("tests/cat.asm", encoding="utf-8") as file:
+        source = file.read().replace("r0, 98", f"r0, {memory - 2}").replace("r0, 99", f"r0, {memory - 1}")
+    schedule = [(1 + 30 * i, chr(ord('a') + i % 26)) for i in range(count)] + [(30 * count + 30, '\0')]
+    return source, schedule, 20 * count, memory
+
+
+def labels_workload(scale: int):
+    count = 1000 * scale
+    lines = ["_start:", "    addi r1, r0, 0", f"    addi r2, r0, {count}", "    jmp l0"]
+    for i in range(count):
+        lines += [f"l{i}:", "    addi r1, r1, 1", "    beq r1, r2, exit", f"    jmp l{i + 1}"]
+    lines += [f"l{count}:", "exit:", "    hlt"]
+    return "\n".join(lines) + "\n", [], 10 * count, 100 + 3 * count
+
+
+WORKLOADS = {
+    "prob1": prob1_workload,
+    "cat": cat_workload,
+    "labels": labels_workload,
+}
+
+
+def simulated_ticks(source: str, schedule, limit: int, memory: int) -> int:
+    control_unit = machine.build_machine(prepare_program(translator.translate(source)), schedule, memory, limit)
+    machine.run(control_unit, limit)
+    return control_unit.current_tick()
+
+
+def measure(name: str, scale: int, repeat: int = 3, backend: str = "step", optimize: bool = False) -> dict:
+    source, schedule, limit, memory = WORKLOADS[name](scale)
+
+    translate_time = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        program = translator.translate(source, optimize)
+        translate_time = min(translate_time, time.perf_counter() - start)
+    encoded = json.dumps(program).encode("utf-8")
+
+    simulate_time = float('inf')
+    for _ in range(repeat):
+        control_unit = machine.build_machine(parse_program(encoded), schedule, memory, limit)
+        start = time.perf_counter()
+        instr = machine.run(control_unit, limit, fast_forward=False, backend=backend)
+        simulate_time = min(simulate_time, time.perf_counter() - start)
+    assert control_unit.error is None, f"{name}: {control_unit.error}"
+
+    result = {
+        "source_bytes": len(source.encode("utf-8")),
+        "instr": instr,
+        "ticks": control_unit.current_tick(),
+        "translate_bytes_per_sec": len(source.encode("utf-8")) / translate_time,
+        "instr_per_sec": instr / simulate_time,
+        "ticks_per_sec": control_unit.current_tick() / simulate_time,
+    }
+    if optimize:
+        result["ticks_saved"] = simulated_ticks(source, schedule, limit, memory) - control_unit.current_tick()
+    return result
+
+
+def run_benchmarks(names=None, scale: int = 1, repeat: int = 3, backend: str = "step",
+                   optimize: bool = False) -> dict:
+    return {name: measure(name, scale, repeat, backend, optimize) for name in (names or WORKLOADS)}
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for name, metrics in results.items():
+        for metric in METRICS:
+            if name not in baseline or metric not in baseline[name]:
+                continue
+            expected = baseline[name][metric]
+            if metrics[metric] < expected * (1 - tolerance):
+                regressions.append(f"{name}.{metric}: {metrics[metric]:.0f} < {expected:.0f} "
+                                   f"({metrics[metric] / expected - 1:+.1%})")
+    return regressions
+
+
+def main(args):
+    parser = argparse.ArgumentParser(prog="benchmark.py")
+    parser.add_argument("--workload", action="append", choices=list(WORKLOADS),
+                        help="workload to run, all by default; can be repeated")
+    parser.add_argument("--scale", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3, help="best of N runs")
+    parser.add_argument("--output", help="write results as JSON")
+    parser.add_argument("--baseline", help="compare with results stored by --output")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    parser.add_argument("--backend", choices=machine.BACKENDS, default="step")
+    parser.add_argument("--optimize", action="store_true", help="translate with the peephole passes")
+    options = parser.parse_args(args)
+
+    results = run_benchmarks(options.workload, options.scale, options.repeat, options.backend, options.optimize)
+    text = json.dumps({"scale": options.scale, "backend": options.backend, "optimize": options.optimize,
+                       "results": results}, indent=2)
+    if options.output:
+        with open(options.output, "w", encoding="utf-8") as file:
+            file.write(text + "\n")
+    print(text)
+
+    if options.baseline:
+        with open(options.baseline, encoding="utf-8") as file:
+            baseline = json.load(file)
+        assert baseline["scale"] == options.scale, "Baseline was measured at a different scale"
+        assert baseline.get("backend", "step") == options.backend, "Baseline was measured with another backend"
+        assert baseline.get("optimize", False) == options.optimize, "Baseline was translated with other passes"
+        regressions = compare(results, baseline["results"], options.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
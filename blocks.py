@@ -0,0 +1,238 @@
+"""
+Basic-block backend: straight-line code compiled into Python functions.
+
+A block starts at the address it is entered at and runs up to the next
+`jmp` or `iret`. A `beq` inside a block is a side exit. The block stops
+before any instruction that it can't handle: `hlt`, a jump to itself, an
+instruction that can only fail, and an ALU or `ld` result written to PC.
+Each block becomes one generated function that updates the registers and
+memory directly and adds the ticks of all its instructions at once, so
+the counters come out exactly as if the block had been stepped.
+
+A block is compiled once its address has been entered HOT_ENTRIES
+times; code that runs only a few times is stepped. The runner enters a
+block only when no interrupt can become due at any of the block's fetch
+ticks, and when the whole block fits under the instruction limit. Otherwise it steps the microcoded control unit. An
+instruction inside a block that would fail, or would write over the code,
+makes the block return its index. The runner sets the counters to the
+point just before it and steps that instruction, so errors and
+self-modifying code behave exactly as on the microcoded path. Any write
+over the code drops all compiled blocks.
+
+Only the registers, memory, I/O buffers and counters are kept exact. The
+ALU latches and the address bus are not updated inside a block.
+"""
+
+from typing import Callable, NamedTuple, Optional
+
+from machine import ALU_OPERATIONS, AluOperation, BEQ, ControlUnit, IRET, IdleLoop, JMP, LD, \
+    NO_REGISTER, PC, SP, ST, DecodedInstruction
+
+MAX_BLOCK = 64
+# entries into an address before a block is compiled for it; cold code is stepped
+HOT_ENTRIES = 4
+
+ALU_SYMBOLS = {
+    AluOperation.ADD: "+",
+    AluOperation.SUB: "-",
+    AluOperation.MUL: "*",
+    AluOperation.DIV: "//",
+    AluOperation.REM: "%",
+}
+
+
+class Block(NamedTuple):
+    """
+    `run` executes the block and returns the number of instructions done,
+    or `-1 - k` if instruction `k` has to be stepped instead. `prefix[k]`
+    is the number of ticks spent before instruction `k` when no side exit
+    is taken, and `last_fetch` is the tick of the last fetch counted from
+    the block entry.
+    """
+    run: Callable[[list], int]
+    start: int
+    length: int
+    prefix: tuple
+    last_fetch: int
+
+
+def compilable(instr: Optional[DecodedInstruction]) -> bool:
+    if instr is None or instr.handler != instr.opcode:
+        return False
+    if instr.opcode in (JMP, BEQ, IRET, ST):
+        return True
+    return instr.opcode in ALU_OPERATIONS and instr.rd != PC
+
+
+def _operand(reg: Optional[int], imm: int, addr: int) -> str:
+    if reg is NO_REGISTER:
+        return f"({imm})"
+    if reg == PC:
+        return str(addr)
+    return f"r[{reg}]"
+
+
+def _address(instr: DecodedInstruction, addr: int) -> str:
+    op1 = _operand(instr.rs1, instr.imm, addr)
+    if instr.rs2 is NO_REGISTER and instr.imm == 0:
+        return op1
+    return f"{op1} + {_operand(instr.rs2, instr.imm, addr)}"
+
+
+def _exit(lines: list, indent: str, ticks: int, done: int, pc: str):
+    lines += [f"{indent}cu._tick += {ticks}",
+              f"{indent}cu.instr_counter += {done}",
+              f"{indent}cu.last_instr = I[{done - 1}]",
+              f"{indent}r[{PC}] = {pc}",
+              f"{indent}return {done}"]
+
+
+def compile_block(control_unit: ControlUnit, start: int) -> Optional[Block]:
+    data_path = control_unit.data_path
+    code, code_base = data_path.code, data_path.code_base
+
+    instrs = []
+    for addr in range(start, min(start + MAX_BLOCK, code_base + len(code))):
+        instr = code[addr - code_base] if addr >= code_base else None
+        if not compilable(instr):
+            break
+        instrs.append(instr)
+        if instr.opcode in (JMP, IRET):
+            break
+    if not instrs:
+        return None
+
+    lines = ["def block(r):", "    k = 0", "    try:"]
+    body = "        "
+    ticks, prefix = 0, []
+    for k, instr in enumerate(instrs):
+        addr = start + k
+        prefix.append(ticks)
+        opcode = instr.opcode
+        if opcode in (LD, ST, IRET) or ALU_OPERATIONS[opcode] in (AluOperation.DIV, AluOperation.REM):
+            lines.append(f"{body}k = {k}")
+
+        if opcode == JMP:
+            _exit(lines, body, ticks + 2, k + 1, _address(instr, addr))
+        elif opcode == BEQ:
+            op1, op2 = _operand(instr.rs1, instr.imm, addr), _operand(instr.rs2, instr.imm, addr)
+            lines.append(f"{body}if {op1} - {op2} == 0:")
+            _exit(lines, body + "    ", ticks + 3, k + 1, str(addr + instr.imm))
+            ticks += 2
+        elif opcode == IRET:
+            lines += [f"{body}s = r[{SP}]",
+                      f"{body}o = s - CB",
+                      f"{body}if 0 <= o < CL and code[o] is not None:",
+                      f"{body}    raise ValueError",
+                      f"{body}v = memory[s]",
+                      f"{body}cu.is_interrupted = False",
+                      f"{body}r[{SP}] = s - 1"]
+            _exit(lines, body, ticks + 3, k + 1, "v")
+        elif opcode == LD:
+            lines += [f"{body}x = {_address(instr, addr)}",
+                      f"{body}if x == IN:",
+                      f"{body}    io_get({instr.rd})",
+                      f"{body}else:",
+                      f"{body}    o = x - CB",
+                      f"{body}    if 0 <= o < CL and code[o] is not None:",
+                      f"{body}        raise ValueError",
+                      f"{body}    r[{instr.rd}] = memory[x]"]
+            ticks += 3
+        elif opcode == ST:
+            lines += [f"{body}x = {_address(instr, addr)}",
+                      f"{body}if x == OUT:"]
+            if instr.rd == PC:
+                lines.append(f"{body}    r[{PC}] = {addr}")
+            lines += [f"{body}    io_put({instr.rd})",
+                      f"{body}else:",
+                      f"{body}    if 0 <= x - CB < CL:",
+                      f"{body}        raise ValueError",
+                      f"{body}    memory[x] = {_operand(instr.rd, 0, addr)}"]
+            ticks += 3
+        else:
+            op1, op2 = _operand(instr.rs1, instr.imm, addr), _operand(instr.rs2, instr.imm, addr)
+            lines.append(f"{body}r[{instr.rd}] = {op1} {ALU_SYMBOLS[ALU_OPERATIONS[opcode]]} {op2}")
+            ticks += 3
+
+    if instrs[-1].opcode not in (JMP, IRET):
+        _exit(lines, body, ticks, len(instrs), str(start + len(instrs)))
+    lines += ["    except Exception:", "        return -1 - k"]
+
+    namespace = {
+        "cu": control_unit,
+        "memory": data_path.memory,
+        "code": code,
+        "CB": code_base,
+        "CL": len(code),
+        "IN": data_path.input_map_addr,
+        "OUT": data_path.output_map_addr,
+        "io_get": data_path.io_get,
+        "io_put": data_path.io_put,
+        "I": tuple(instrs),
+    }
+    exec("\n".join(lines), namespace)
+    return Block(namespace["block"], start, len(instrs), tuple(prefix), prefix[-1] + 1)
+
+
+class BlockRunner:
+    """
+    Runs a control unit block by block. `instr_counter` is the count the
+    run has reached, also when the microcoded step raises.
+    """
+
+    def __init__(self, control_unit: ControlUnit):
+        self.control_unit = control_unit
+        self.instr_counter: int = control_unit.instr_counter
+        self._blocks: dict[int, Optional[Block]] = {}
+        self._entries: dict[int, int] = {}
+        self._code_writes: int = control_unit.data_path.code_writes
+
+    def _step(self, n: int) -> int:
+        control_unit = self.control_unit
+        self.instr_counter = n
+        control_unit.decode_and_execute_instruction()
+        if control_unit.data_path.code_writes != self._code_writes:
+            self._code_writes = control_unit.data_path.code_writes
+            self._blocks.clear()
+            self._entries.clear()
+        return n + 1
+
+    def run(self, end: int) -> int:
+        control_unit = self.control_unit
+        registers = control_unit.data_path.registers
+        input_irq = control_unit.input_irq
+        blocks = self._blocks
+
+        n = self.instr_counter
+        while n < end:
+            pc = registers[PC]
+            if pc in blocks:
+                block = blocks[pc]
+            else:
+                entries = self._entries[pc] = self._entries.get(pc, 0) + 1
+                block = None
+                if entries >= HOT_ENTRIES:
+                    block = blocks[pc] = compile_block(control_unit, pc)
+
+            if block is None or n + block.length > end or \
+                    (not control_unit.is_interrupted and input_irq.next_due <= control_unit._tick + block.last_fetch):
+                try:
+                    n = self._step(n)
+                except IdleLoop:
+                    n += 1
+                    n += control_unit.skip_idle_iterations(end - n)
+                continue
+
+            tick = control_unit._tick
+            done = block.run(registers)
+            if done > 0:
+                n += done
+                continue
+            k = -1 - done
+            control_unit._tick = tick + block.prefix[k]
+            control_unit.instr_counter = n + k
+            registers[PC] = block.start + k
+            n = self._step(n + k)
+
+        self.instr_counter = n
+        return n
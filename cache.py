@@ -0,0 +1,139 @@
+"""
+Content-addressed cache of translated programs.
+
+An entry is the program in the binary format, named by the SHA-256 of
+the translator version and the source text. A changed source or a new
+translator never hits an old entry. Entries are written atomically, so
+concurrent batch workers can share one directory. A hit touches the
+entry. Once the directory is over `max_bytes`, the least recently used
+entries are removed.
+
+Parsed programs are also kept in memory by key, so a process that loads
+the same source again does neither the translation nor the file read.
+"""
+
+import hashlib
+import json
+import os
+import struct
+import tempfile
+from typing import Optional
+
+import translator
+from isa import BINARY_MAGIC, encode_program, parse_program, prepare_program, read_program
+
+CACHE_DIR_ENV = "TRANSLATION_CACHE_DIR"
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+ENTRY_SUFFIX = ".pmbf"
+
+
+def default_cache_dir() -> str:
+    return os.environ.get(CACHE_DIR_ENV) or os.path.join(os.path.expanduser("~"), ".cache", "asm-translations")
+
+
+class TranslationCache:
+    """`directory` defaults to $TRANSLATION_CACHE_DIR, then to ~/.cache/asm-translations."""
+
+    def __init__(self, directory: Optional[str] = None, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.directory = directory or default_cache_dir()
+        self.max_bytes = max_bytes
+        self.hits: int = 0
+        self.misses: int = 0
+        self._programs: dict[str, dict] = {}
+
+    @staticmethod
+    def key(source: str) -> str:
+        digest = hashlib.sha256(translator.TRANSLATOR_VERSION.encode("utf-8") + b"\0")
+        digest.update(source.encode("utf-8"))
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ENTRY_SUFFIX)
+
+    def encoded(self, source: str) -> bytes:
+        """
+        The program file for `source`: the cache entry, translated and
+        stored on a miss. A program with an immediate that doesn't fit the
+        binary format is returned as JSON and not cached.
+        """
+        path = self._path(self.key(source))
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+            if data[:len(BINARY_MAGIC)] == BINARY_MAGIC:
+                os.utime(path)
+                self.hits += 1
+                return data
+        except OSError:
+            pass
+
+        self.misses += 1
+        target = translator.translate(source)
+        try:
+            data = encode_program(target)
+        except struct.error:
+            return json.dumps(target).encode("utf-8")
+        self.put(source, data)
+        return data
+
+    def translate(self, source: str) -> dict:
+        """The translated program, ready for `machine.build_machine`."""
+        key = self.key(source)
+        if key in self._programs:
+            self.hits += 1
+            return self._programs[key]
+        program = self._programs[key] = parse_program(self.encoded(source))
+        return program
+
+    def put(self, source: str, data: bytes):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, self._path(self.key(source)))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(ENTRY_SUFFIX):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
+
+
+def read_source(filename: str) -> str:
+    with open(filename, encoding="utf-8") as file:
+        return file.read()
+
+
+def load_program_file(filename: str, cache: Optional[TranslationCache] = None):
+    """A translated program file, or an `.asm` source translated through `cache`."""
+    if not filename.endswith(".asm"):
+        return read_program(filename)
+    source = read_source(filename)
+    if cache is None:
+        return prepare_program(translator.translate(source))
+    return cache.translate(source)
+
+
+def program_file_bytes(filename: str, cache: Optional[TranslationCache] = None) -> bytes:
+    """Like `load_program_file`, but the contents to be parsed with `isa.parse_program`."""
+    if not filename.endswith(".asm"):
+        with open(filename, "rb") as file:
+            return file.read()
+    source = read_source(filename)
+    if cache is None:
+        return json.dumps(translator.translate(source)).encode("utf-8")
+    return cache.encoded(source)
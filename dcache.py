@@ -0,0 +1,176 @@
+"""
+Data cache model in front of the memory of a machine.
+
+`DataCache` sits between `ControlUnit` and `DataPath.memory`: every load
+and store, and the stack accesses of interrupt entry and `iret`, look up
+the cache, and the latency of the lookup is added to the ticks of the
+control unit. The memory itself is still read and written directly, the
+cache only keeps tags, so a program computes the same with any geometry.
+
+A set is a list of the line numbers it holds, the next victim last. LRU
+moves a hit line to the front, FIFO leaves the order alone. The common
+case, a hit on the line used last in its set, is a single comparison.
+
+Hits and misses are counted per address range: the stack (from SP up to
+the stack top), the other data, and MMIO. MMIO bypasses the cache and
+every access to it counts as a miss without extra latency.
+
+    dcache.py <program> <input_file> [--size N] [--ways N] [--line N] ...
+"""
+
+import argparse
+import sys
+from typing import NamedTuple
+
+import machine
+import pipeline
+from devices import read_events
+from machine import SP
+
+STACK, DATA, MMIO = range(3)
+RANGES = ("stack", "data", "mmio")
+POLICIES = ("lru", "fifo")
+
+
+class CacheConfig(NamedTuple):
+    """
+    Sizes are in words, `size` and `line` are powers of two. Every hit
+    costs `hit_latency`; a line fill, the write-back of a dirty victim and
+    a write-through store each cost `memory_latency` more. Write-through
+    doesn't allocate a line on a store miss.
+    """
+    size: int = 64
+    ways: int = 2
+    line: int = 4
+    policy: str = "lru"
+    write_back: bool = True
+    hit_latency: int = 0
+    memory_latency: int = 10
+
+
+class DataCache:
+    def __init__(self, config: CacheConfig, data_path: machine.DataPath):
+        sets = config.size // (config.line * config.ways)
+        assert config.policy in POLICIES, f"Unknown replacement policy {config.policy}"
+        assert config.line > 0 and config.line & (config.line - 1) == 0, "Line size must be a power of two"
+        assert sets > 0 and sets & (sets - 1) == 0 and sets * config.line * config.ways == config.size, \
+            "Cache size must be a power of two multiple of line * ways"
+        self.config = config
+        self.sets: list[list[int]] = [[] for _ in range(sets)]
+        self.dirty: set[int] = set()
+        self.hits: list[int] = [0] * len(RANGES)
+        self.misses: list[int] = [0] * len(RANGES)
+        self.writebacks: int = 0
+        self.cycles: int = 0
+        self._shift = config.line.bit_length() - 1
+        self._mask = sets - 1
+        self._ways = config.ways
+        self._lru = config.policy == "lru"
+        self._write_back = config.write_back
+        self._hit = config.hit_latency
+        self._memory = config.memory_latency
+        self._registers = data_path.registers
+        self._stack_top = data_path.registers[SP]
+        self._mmio = (data_path.input_map_addr, data_path.output_map_addr)
+
+    def access(self, addr: int, write: bool) -> int:
+        """Look up `addr` and return the latency in ticks."""
+        if addr in self._mmio:
+            self.misses[MMIO] += 1
+            return 0
+        kind = STACK if self._registers[SP] <= addr <= self._stack_top else DATA
+        line = addr >> self._shift
+        tags = self.sets[line & self._mask]
+        latency = self._hit
+        if tags and tags[0] == line:
+            self.hits[kind] += 1
+        elif line in tags:
+            self.hits[kind] += 1
+            if self._lru:
+                tags.remove(line)
+                tags.insert(0, line)
+        else:
+            self.misses[kind] += 1
+            if write and not self._write_back:
+                latency += self._memory
+                self.cycles += latency
+                return latency
+            latency += self._memory
+            if len(tags) == self._ways:
+                victim = tags.pop()
+                if victim in self.dirty:
+                    self.dirty.remove(victim)
+                    self.writebacks += 1
+                    latency += self._memory
+            tags.insert(0, line)
+        if write:
+            if self._write_back:
+                self.dirty.add(line)
+            else:
+                latency += self._memory
+        self.cycles += latency
+        return latency
+
+    def report(self) -> dict:
+        ranges = {}
+        for kind, name in enumerate(RANGES):
+            accesses = self.hits[kind] + self.misses[kind]
+            ranges[name] = {"hits": self.hits[kind], "misses": self.misses[kind],
+                            "hit_rate": self.hits[kind] / accesses if accesses else 0.0}
+        return {"ranges": ranges, "writebacks": self.writebacks, "dirty": len(self.dirty), "cycles": self.cycles}
+
+
+def attach(control_unit: machine.ControlUnit, config: CacheConfig = CacheConfig()) -> DataCache:
+    """Put a cache in front of the memory of a built machine."""
+    control_unit.data_cache = DataCache(config, control_unit.data_path)
+    return control_unit.data_cache
+
+
+def simulation(program, input_schedule, config: machine.MachineConfig = machine.MachineConfig(),
+               cache_config: CacheConfig = CacheConfig(), timing=None):
+    """
+    Like `machine.simulation`, also returns the report of the cache. With
+    `timing` the machine is a `pipeline.PipelinedControlUnit`.
+    """
+    if timing is None:
+        control_unit = machine.build_machine(program, input_schedule, config=config)
+    else:
+        control_unit = pipeline.build_machine(program, input_schedule, config, timing)
+    cache = attach(control_unit, cache_config)
+    instr = machine.run(control_unit, config.limit)
+    return ''.join(control_unit.data_path.output_buf), instr, control_unit.current_tick(), cache.report()
+
+
+def main(args):
+    parser = argparse.ArgumentParser(prog="dcache.py")
+    parser.add_argument("program_file")
+    parser.add_argument("input_file")
+    defaults = CacheConfig()
+    parser.add_argument("--size", type=int, default=defaults.size, help="in words")
+    parser.add_argument("--ways", type=int, default=defaults.ways)
+    parser.add_argument("--line", type=int, default=defaults.line, help="in words")
+    parser.add_argument("--policy", choices=POLICIES, default=defaults.policy)
+    parser.add_argument("--write-through", action="store_true")
+    parser.add_argument("--hit-latency", type=int, default=defaults.hit_latency)
+    parser.add_argument("--memory-latency", type=int, default=defaults.memory_latency)
+    parser.add_argument("--pipeline", action="store_true", help="count ticks with the pipelined timing model")
+    machine.add_config_args(parser)
+    options = parser.parse_args(args)
+
+    cache_config = CacheConfig(options.size, options.ways, options.line, options.policy, not options.write_through,
+                               options.hit_latency, options.memory_latency)
+    timing = pipeline.PipelineTiming() if options.pipeline else None
+    program = machine.load_program_file(options.program_file)
+    with open(options.input_file, encoding="utf-8") as file:
+        output, instr, ticks, report = simulation(program, read_events(file), machine.config_from_args(options),
+                                                  cache_config, timing)
+    print(f"output: {output}")
+    print(f"instr: {instr}  ticks: {ticks}  memory stalls: {report['cycles']}")
+    for name, counters in report["ranges"].items():
+        print(f"{name}: hits: {counters['hits']}  misses: {counters['misses']}  "
+              f"hit rate: {counters['hit_rate']:.1%}")
+    print(f"writebacks: {report['writebacks']}  dirty: {report['dirty']}")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,63 @@
+"""
+Streaming memory-mapped I/O devices.
+
+`read_events` reads an input file of the `machine.py` format,
+`[(1, 'H'), (10, 'e'), ...]`, chunk by chunk and yields its events one by
+one. Given to `InterruptController`, it is a stream that is read one event
+ahead, so the events have to be ordered by tick.
+
+`StreamOutput` takes the place of `DataPath.output_buf`. Characters
+stored to the output address are collected into a chunk. The chunk is
+written to a text sink, such as a file or stdout, when it is full and
+when the run stops. Only one chunk is ever kept in memory.
+"""
+
+import ast
+import re
+from typing import IO, Iterator, Tuple
+
+EVENT_RE = re.compile(r"""\(\s*(-?\d+)\s*,\s*('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")\s*\)""")
+
+
+def read_events(file: IO[str], chunk_size: int = 1 << 16) -> Iterator[Tuple[int, str]]:
+    tail = ""
+    while True:
+        chunk = file.read(chunk_size)
+        text = tail + chunk
+        pos = 0
+        for match in EVENT_RE.finditer(text):
+            yield int(match.group(1)), ast.literal_eval(match.group(2))
+            pos = match.end()
+        tail = text[pos:]
+        if not chunk:
+            return
+
+
+class StreamOutput:
+    """
+    Output device that writes to `sink` in chunks of `chunk_size`
+    characters and flushes the sink after each one, so a reader sees the
+    output while the program runs. Iterating gives the characters not
+    written yet, so `''.join(output)` is empty after a run.
+    """
+
+    def __init__(self, sink: IO[str], chunk_size: int = 4096):
+        self.sink = sink
+        self.chunk_size = chunk_size
+        self.written: int = 0
+        self._chunk: list[str] = []
+
+    def __iter__(self):
+        return iter(self._chunk)
+
+    def append(self, char: str):
+        self._chunk.append(char)
+        if len(self._chunk) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        text = ''.join(self._chunk)
+        self._chunk.clear()
+        self.sink.write(text)
+        self.sink.flush()
+        self.written += len(text)
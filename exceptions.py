@@ -12,3 +12,7 @@ class AluOpcodeException(Exception):
 
 class ZeroRegisterModificationException(Exception):
     pass
+
+
+class WordOverflowException(Exception):
+    pass
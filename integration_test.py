@@ -5,17 +5,38 @@
 """Интеграционные тесты транслятора и машины
 """
 
+import ast
 import contextlib
 import io
+import itertools
+import json
 import logging
 import os
 import tempfile
 import unittest
+import unittest.mock
+from array import array
 
 import pytest
 
+import api
+import batch
+import benchmark
+import blocks
+import cache
+import dcache
+import devices
+import interrupts
+import isa
 import machine
+import pipeline
+import predictor
+import profiler
+import replay
+import snapshot
+import tracing
 import translator
+import vector
 
 
 @pytest.mark.golden_test("golden/*.yml")
@@ -96,3 +117,886 @@ class TestTranslator(unittest.TestCase):
 
             self.assertEqual(stdout.getvalue(),
                              'output: 233168\ninstr: 7899  ticks: 20473\n')
+
+    def test_many_labels(self):
+        source = "_start:\n" + "".join(f"l{i}:\n    addi r1, r1, 1\n    jmp l{i // 2}\n" for i in range(1000))
+
+        program = translator.translate(source)
+
+        self.assertEqual(len(program["code"]), 2000)
+        self.assertEqual(program["code"][1999], {"opcode": "jmp", "imm": 998 - 1999})
+
+    def test_peephole_passes(self):
+        source = "_int:\n    jmp handler\nhandler:\n    iret\n_start:\n    addi r1, r0, 5\n    subi r1, r1, 7\n" \
+                 "    beq r1, r0, skip\n    jmp out\nskip:\n    addi r1, r1, 1\nout:\n    jmp print\n" \
+                 "    addi r2, r0, 1\nprint:\n    addi r3, r0, 99\n    addi r1, r1, 50\n    st r1, r3\n    hlt\n" \
+                 "    jmp print\n"
+
+        program, labels = translator.translate_with_labels(source, optimize=True)
+
+        self.assertEqual(program["code"], [
+            {"opcode": "iret"},
+            {"opcode": "subi", "rd": "r1", "rs": "r0", "imm": "2"},
+            {"opcode": "beq", "rs1": "r1", "rs2": "r0", "imm": 2},
+            {"opcode": "jmp", "imm": 2},
+            {"opcode": "addi", "rd": "r1", "rs": "r1", "imm": "1"},
+            {"opcode": "addi", "rd": "r3", "rs": "r0", "imm": "99"},
+            {"opcode": "addi", "rd": "r1", "rs": "r1", "imm": "50"},
+            {"opcode": "st", "rd": "r1", "rs": "r3"},
+            {"opcode": "hlt"}])
+        self.assertEqual((program["start"], labels["skip"], labels["print"]), (1, 4, 5))
+        self.assertEqual(machine.simulation(load_source(source), [], tracer=None)[0], "0")
+        self.assertEqual(machine.simulation(isa.prepare_program(program), [], tracer=None)[0], "0")
+
+    def test_peephole_keeps_position_dependent_code(self):
+        source = "_start:\n    add r1, pc, r0\n    jmp next\nnext:\n    hlt\n"
+
+        self.assertEqual(translator.translate(source, optimize=True), translator.translate(source))
+
+    def test_peephole_saves_ticks(self):
+        results = benchmark.run_benchmarks(["prob1", "labels"], repeat=1, optimize=True)
+
+        self.assertEqual([results[name]["ticks_saved"] for name in ("prob1", "labels")], [2, 2000])
+        self.assertEqual(results["labels"]["ticks"], 5008)
+
+    def test_incremental_translation(self):
+        source = open("tests/prob1.asm", encoding="utf-8").read()
+        incremental = translator.IncrementalTranslator()
+
+        self.assertEqual(incremental.translate_with_labels(source), translator.translate_with_labels(source))
+        self.assertEqual(incremental.parsed, 6)
+
+        edited = source
+        for old, new in (("addi r4, r4, 1", "addi r4, r4, 1\n    addi r4, r4, 0"),
+                         ("print:\n", "_int:\n    iret\nprint:\n"),
+                         ("jmp push_digits", "jmp print")):
+            edited = edited.replace(old, new)
+            self.assertEqual(incremental.translate_with_labels(edited), translator.translate_with_labels(edited))
+            self.assertEqual(incremental.parsed, 1)
+        self.assertEqual(incremental.translate(source, optimize=True), translator.translate(source, optimize=True))
+
+    def test_prob1_binary(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            target = os.path.join(tmpdirname, "prob1")
+
+            with contextlib.redirect_stdout(io.StringIO()) as stdout:
+                translator.main(["--format", "binary", "tests/prob1.asm", target])
+                machine.main([target, "tests/prob1_input"])
+
+            self.assertEqual(stdout.getvalue(),
+                             'output: 233168\ninstr: 7899  ticks: 20473\n')
+
+    def test_binary_records_match_json(self):
+        program = translator.translate(open("tests/cat.asm", encoding="utf-8").read())
+        code = isa.read_binary_program(isa.encode_program(program))["code"]
+
+        for idx, instr in enumerate(program["code"]):
+            expected = dict(instr, opcode=isa.Opcode(instr["opcode"]), type=isa.instruction_type(instr))
+            self.assertEqual(code[idx], expected)
+
+
+def load_source(text):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        source = os.path.join(tmpdirname, "source.asm")
+        target = os.path.join(tmpdirname, "target")
+        with open(source, "w", encoding="utf-8") as file:
+            file.write(text)
+        translator.main([source, target])
+        return isa.read_program(target)
+
+
+class TestApi(unittest.TestCase):
+
+    def test_program_is_reused_without_files(self):
+        program = api.assemble(open("tests/cat.asm", encoding="utf-8").read())
+        config = machine.MachineConfig(input_addr=98, output_addr=99)
+
+        with unittest.mock.patch("builtins.open", side_effect=AssertionError("no files")), \
+                contextlib.redirect_stdout(io.StringIO()) as stdout:
+            first = api.run(program, [(1, 'h'), (30, 'i'), (60, '\0')], config)
+            second = api.run(program, iter([(5, 'o'), (50, 'k'), (90, '\0')]), config, backend="blocks")
+
+        self.assertEqual(stdout.getvalue(), "")
+        self.assertEqual((first.output, first.halted, first.error), ("hi", True, None))
+        self.assertEqual(second.output, "ok")
+        self.assertEqual(first.registers["r6"], 0)
+        self.assertEqual(program.labels["_int"], 0)
+
+    def test_matches_file_pipeline(self):
+        source = open("tests/prob1.asm", encoding="utf-8").read()
+
+        result = api.run_source(source, config=machine.MachineConfig(limit=100000))
+
+        self.assertEqual(result[:3], machine.simulation(load_source(source), [], limit=100000, tracer=None))
+        self.assertEqual(result.registers["r7"], 0)
+
+
+class TestVector(unittest.TestCase):
+
+    @unittest.skipIf(vector.np is None, "numpy is not installed")
+    def test_lanes_match_scalar_runs(self):
+        program = api.assemble(open("tests/cat.asm", encoding="utf-8").read())
+        config = machine.MachineConfig(limit=300)
+        schedules = [[(1, 'h'), (30, 'i'), (60, '\0')], [], [(5, 'a'), (6, 'b'), (200, 'c')],
+                     [(1, 'x'), (40, 'y')], [(90, '\0'), (10, 'z')]]
+
+        with self.assertLogs(level=logging.ERROR):
+            results = vector.simulate_lanes(program, schedules, config)
+
+        with self.assertLogs(level=logging.ERROR):
+            self.assertEqual(results, [api.run(program, schedule, config) for schedule in schedules])
+        self.assertEqual([result.output for result in results], ["hi", "", "abc", "xy", "z"])
+
+    @unittest.skipIf(vector.np is None, "numpy is not installed")
+    def test_faulting_lanes_continue_on_scalar_machine(self):
+        source = "_int:\n    addi r2, r0, 98\n    ld r1, r2\n    mul r3, r1, r1\n    mul r3, r3, r3\n" \
+                 "    mul r3, r3, r3\n    mul r3, r3, r3\n    mul r3, r3, r3\n    div r4, r3, r3\n" \
+                 "    st r3, r0, 50\n    iret\n_start:\n    jmp _start\n"
+        program = api.assemble(source)
+        config = machine.MachineConfig(limit=200)
+        # r3 = r1 ** 32: fits, fits into a word, doesn't fit into 64 bits, divides by zero
+        schedules = [[(1, '\1')], [(3, '\2'), (90, '\1')], [(10, '\4')], [(1, '\0')]]
+
+        with self.assertLogs(level=logging.ERROR):
+            results = vector.simulate_lanes(program, schedules, config)
+
+        with self.assertLogs(level=logging.ERROR):
+            self.assertEqual(results, [api.run(program, schedule, config) for schedule in schedules])
+        self.assertEqual([result.registers["r3"] for result in results[:3]], [1, 1, 2 ** 64])
+        self.assertEqual([result.error for result in results[2:]],
+                         ["Value 18446744073709551616 doesn't fit into a memory word", "integer division or modulo by zero"])
+
+
+class TestMachine(unittest.TestCase):
+
+    def test_zero_register_write_is_reported(self):
+        program = load_source("_start:\n    addi r1, r0, 1\n    addi r0, r1, 1\n    hlt\n")
+
+        with self.assertLogs(level=logging.ERROR) as logs:
+            output, instr, ticks = machine.simulation(program, [], data_memory_size=100, limit=100)
+
+        self.assertEqual((output, instr, ticks), ('', 1, 4))
+        self.assertIn("It's not allowed to modify R0", '\n'.join(logs.output))
+
+    def test_control_unit_repr_before_first_step(self):
+        data_path = machine.DataPath(array('q', bytes(8 * 100)))
+        control_unit = machine.ControlUnit(data_path, machine.InterruptController(), 100)
+
+        self.assertTrue(repr(control_unit).endswith('last_instr: {}'))
+
+    def test_instruction_read_as_data(self):
+        program = load_source("_start:\n    addi r1, r0, 20\n    ld r2, r1\n    hlt\n")
+
+        with self.assertLogs(level=logging.ERROR) as logs:
+            machine.simulation(program, [], data_memory_size=100, limit=100)
+
+        self.assertIn("Attempt to write an instruction to a register", '\n'.join(logs.output))
+
+    def test_word_overflow_on_store(self):
+        program = load_source("_start:\n    addi r1, r0, 2147483647\n    mul r1, r1, r1\n"
+                              "    mul r1, r1, r1\n    addi r2, r0, 50\n    st r1, r2\n    hlt\n")
+
+        with self.assertLogs(level=logging.ERROR) as logs:
+            machine.simulation(program, [], data_memory_size=100, limit=100)
+
+        self.assertIn("doesn't fit into a memory word", '\n'.join(logs.output))
+
+    def test_program_must_fit_into_memory(self):
+        program = load_source("_start:\n" + "    addi r1, r1, 1\n" * 200 + "    hlt\n")
+
+        with self.assertRaises(IndexError):
+            machine.simulation(program, [], data_memory_size=100, limit=1000)
+
+    def test_jsonl_trace(self):
+        program = load_source("_start:\n    addi r1, r0, 104\n    addi r7, r0, 99\n    st r1, r7\n    hlt\n")
+        sink = io.StringIO()
+
+        output, instr, ticks = machine.simulation(
+            program, [], data_memory_size=100, limit=100, tracer=tracing.JsonlTracer(sink))
+
+        records = [json.loads(line) for line in sink.getvalue().splitlines()]
+        self.assertEqual((output, instr, ticks), ('h', 4, 10))
+        self.assertEqual([r["opcode"] for r in records], ['addi', 'addi', 'st'])
+        self.assertEqual(records[2], {"instr": 3, "tick": 9, "pc": 22, "interrupted": False, "opcode": "st",
+                                      "rd": "r1", "rs1": "r7", "rs2": None, "imm": 0})
+
+    def test_disabled_trace_logs_nothing(self):
+        program = load_source("_start:\n    addi r1, r0, 1\n    hlt\n")
+
+        with self.assertNoLogs(level=logging.DEBUG):
+            machine.simulation(program, [], data_memory_size=100, limit=100, tracer=None)
+
+    def test_idle_loop_fast_forward_is_tick_exact(self):
+        program = load_source(open("tests/cat.asm", encoding="utf-8").read())
+        schedule = [(7, 'a'), (1000, 'b'), (1001, 'c'), (50000, '\0')]
+        results = []
+        for fast_forward in (True, False):
+            control_unit = machine.build_machine(program, schedule, 100, 100000)
+            instr = machine.run(control_unit, 100000, fast_forward=fast_forward)
+            results.append((''.join(control_unit.data_path.output_buf), instr, control_unit.current_tick()))
+
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0], ('abc', 24994, 50013))
+
+
+class TestMachineConfig(unittest.TestCase):
+
+    def test_large_memory_with_custom_map(self):
+        program = load_source(open("tests/cat.asm", encoding="utf-8").read())
+        schedule = [(1, 'h'), (20, 'i'), (100, '\0')]
+        config = machine.MachineConfig(memory_size=1 << 24, program_addr=1000, stack_top=(1 << 24) - 1,
+                                       input_addr=98, output_addr=99)
+
+        control_unit = machine.build_machine(program, schedule, config=config)
+        instr = machine.run(control_unit, config.limit)
+
+        self.assertEqual(''.join(control_unit.data_path.output_buf), "hi")
+        self.assertEqual(control_unit.data_path.memory[0], 1000)
+        restored = snapshot.restore_snapshot(snapshot.take_snapshot(control_unit))
+        self.assertEqual((restored.data_path.input_map_addr, restored.data_path.output_map_addr), (98, 99))
+        self.assertEqual(instr, machine.simulation(program, schedule, tracer=None)[1])
+
+    def test_tick_limit(self):
+        program = load_source(open("tests/prob1.asm", encoding="utf-8").read())
+        for backend in machine.BACKENDS:
+            control_unit = machine.build_machine(program, [], config=machine.MachineConfig(
+                limit=10 ** 9, tick_limit=1000))
+            machine.run(control_unit, control_unit.limit, backend=backend)
+
+            self.assertEqual(control_unit.error, "too long execution, increase tick limit!")
+            self.assertIn(control_unit.current_tick(), range(1001, 1001 + machine.MAX_INSTRUCTION_TICKS))
+
+    def test_config_from_args(self):
+        options = machine.parse_args(["prog", "input", "--memory-size", "4096", "--input-addr", "98",
+                                      "--output-addr", "99", "--limit", "1000000000"])
+
+        self.assertEqual(machine.config_from_args(options),
+                         machine.MachineConfig(4096, 20, None, 98, 99, 10 ** 9, None))
+
+
+class TestBlocks(unittest.TestCase):
+
+    def run_both(self, program, schedule, memory, limit):
+        results = []
+        for backend in ("step", "blocks"):
+            control_unit = machine.build_machine(program, schedule, memory, limit)
+            instr = machine.run(control_unit, limit, backend=backend)
+            data_path = control_unit.data_path
+            results.append((''.join(data_path.output_buf), instr, control_unit.current_tick(),
+                            data_path.registers, control_unit.error, data_path.memory.tolist(),
+                            [instr is None for instr in data_path.code]))
+        self.assertEqual(results[0], results[1])
+        return results[1]
+
+    def test_blocks_are_cycle_exact(self):
+        prob1 = load_source(open("tests/prob1.asm", encoding="utf-8").read())
+        cat = load_source(open("tests/cat.asm", encoding="utf-8").read())
+
+        self.assertEqual(self.run_both(prob1, [], 100, 20000)[:3], ('233168', 7899, 20473))
+        schedule = [(1, 'H'), (5, 'e'), (6, 'l'), (40, 'l'), (41, 'o'), (300, '\0')]
+        self.assertEqual(self.run_both(cat, schedule, 100, 1000)[:3], ('Hlo', 144, 313))
+
+    def test_faults_inside_a_block_are_stepped(self):
+        countdown = "_start:\n    addi r1, r0, 10\nloop:\n    subi r1, r1, 1\n    div r2, r2, r1\n    jmp loop\n"
+        self_modifying = "_start:\n    addi r1, r0, 40\nloop:\n    subi r1, r1, 1\n    st r1, r1\n    jmp loop\n"
+
+        result = self.run_both(load_source(countdown), [], 100, 1000)
+        self.assertEqual(result[4], "integer division or modulo by zero")
+        result = self.run_both(load_source(self_modifying), [], 100, 1000)
+        self.assertEqual(result[4], "Attempt to execute data as an instruction")
+
+    def test_cold_code_is_not_compiled(self):
+        program = load_source("_start:\n    addi r1, r0, 1\n    hlt\n")
+        control_unit = machine.build_machine(program, [], 100, 100)
+        runner = blocks.BlockRunner(control_unit)
+
+        with self.assertRaises(StopIteration):
+            runner.run(100)
+        self.assertEqual(runner.instr_counter, 1)
+        self.assertIsNone(blocks.compile_block(control_unit, 21))
+
+
+class TestInterruptController(unittest.TestCase):
+
+    def test_latest_past_due_event_wins(self):
+        irq = machine.InterruptController([(10, 'b'), (1, 'a'), (10, 'c'), (30, 'd')])
+
+        self.assertEqual(irq.next_due, 1)
+        self.assertIsNone(irq.poll(0))
+        self.assertEqual(irq.poll(15), 'c')
+        self.assertEqual((irq.next_due, len(irq)), (30, 1))
+
+    def test_push_at_runtime(self):
+        irq = machine.InterruptController([(30, 'd')])
+        irq.push(5, 'x')
+
+        self.assertEqual(irq.next_due, 5)
+        self.assertEqual(irq.poll(5), 'x')
+        self.assertEqual(irq.poll(100), 'd')
+        self.assertIsNone(irq.poll(1000))
+
+
+class TestDevices(unittest.TestCase):
+
+    def test_read_events_across_chunks(self):
+        text = open("tests/cat_input", encoding="utf-8").read() + "\n[(400, \"'\"), (401, ')')]"
+        expected = ast.literal_eval(open("tests/cat_input", encoding="utf-8").read()) + [(400, "'"), (401, ')')]
+
+        self.assertEqual(list(devices.read_events(io.StringIO(text), chunk_size=7)), expected)
+
+    def test_stream_must_be_ordered(self):
+        with self.assertRaises(ValueError):
+            machine.InterruptController(iter([(5, 'a'), (1, 'b')])).poll(10)
+
+    def test_endless_input_stream(self):
+        program = load_source(open("tests/cat.asm", encoding="utf-8").read())
+        events = ((tick, 'x') for tick in itertools.count(1, 50))
+        sink = io.StringIO()
+        output = devices.StreamOutput(sink, chunk_size=16)
+
+        config = machine.MachineConfig(memory_size=1000, stack_top=997, input_addr=98, output_addr=99, limit=1000)
+
+        result = machine.simulation(program, events, tracer=None, config=config, output=output)
+
+        self.assertEqual(result[0], '')
+        self.assertEqual(sink.getvalue(), 'x' * 47)
+        self.assertEqual(output.written, 47)
+
+
+class TestProfiler(unittest.TestCase):
+
+    def test_profile_prob1(self):
+        result = profiler.profile(open("tests/prob1.asm", encoding="utf-8").read(), [],
+                                  machine.MachineConfig(limit=100000))
+        folded = io.StringIO()
+        result.write_folded(folded)
+
+        self.assertEqual((sum(result.counts), sum(result.main_ticks)), (7899, 20473))
+        self.assertEqual(result.by_label()["add"], [932, 2330, 0])
+        self.assertEqual(sum(int(line.rsplit(' ', 1)[1]) for line in folded.getvalue().splitlines()), 20473)
+        self.assertIn("main;inc;inc+1 3000\n", folded.getvalue())
+
+    def test_interrupt_time(self):
+        result = profiler.profile(open("tests/cat.asm", encoding="utf-8").read(),
+                                  [(1, 'H'), (10, 'i'), (70, '\0')],
+                                  machine.MachineConfig(input_addr=98, output_addr=99))
+        report = io.StringIO()
+        result.write_report(report)
+
+        self.assertEqual(result.interrupts, 3)
+        self.assertEqual(sum(result.main_ticks) + sum(result.handler_ticks) + result.entry_ticks,
+                         machine.simulation(load_source(open("tests/cat.asm", encoding="utf-8").read()),
+                                            [(1, 'H'), (10, 'i'), (70, '\0')], tracer=None)[2])
+        self.assertIn("3 interrupts", report.getvalue())
+
+
+class TestTranslationCache(unittest.TestCase):
+
+    def test_hit_after_miss(self):
+        source = open("tests/prob1.asm", encoding="utf-8").read()
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            first = cache.TranslationCache(tmpdirname)
+            program = first.translate(source)
+            second = cache.TranslationCache(tmpdirname)
+            cached = second.translate(source)
+            second.translate(source)
+
+            self.assertEqual((first.hits, first.misses, second.hits, second.misses), (0, 1, 2, 0))
+            self.assertEqual(list(cached["code"]), list(program["code"]))
+            self.assertEqual(machine.simulation(cached, [], limit=100000, tracer=None), ('233168', 7899, 20473))
+
+    def test_key_depends_on_translator_version(self):
+        key = cache.TranslationCache.key("_start:\n    hlt\n")
+        with unittest.mock.patch.object(translator, "TRANSLATOR_VERSION", "test"):
+            self.assertNotEqual(cache.TranslationCache.key("_start:\n    hlt\n"), key)
+
+    def test_least_recently_used_are_evicted(self):
+        sources = [f"_start:\n    addi r1, r0, {i}\n    hlt\n" for i in range(4)]
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            translations = cache.TranslationCache(tmpdirname)
+            for source in sources:
+                translations.encoded(source)
+            paths = [translations._path(translations.key(source)) for source in sources]
+            for mtime, path in zip([3, 1, 2, 4], paths):
+                os.utime(path, ns=(mtime, mtime))
+
+            translations.max_bytes = 3 * os.path.getsize(paths[0])
+            translations.evict()
+
+            self.assertEqual([os.path.exists(path) for path in paths], [True, False, True, True])
+
+    def test_machine_runs_source_through_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            with contextlib.redirect_stdout(io.StringIO()) as stdout:
+                machine.main(["tests/cat.asm", "tests/cat_input", "--trace", "none", "--cache-dir", tmpdirname])
+                machine.main(["tests/cat.asm", "tests/cat_input", "--trace", "none", "--cache-dir", tmpdirname])
+
+            self.assertEqual(len(os.listdir(tmpdirname)), 1)
+        self.assertEqual(stdout.getvalue(), "output: Hello, world!\ninstr: 154  ticks: 403\n" * 2)
+
+
+class TestBatch(unittest.TestCase):
+
+    def test_batch_matches_single_runs(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            target = os.path.join(tmpdirname, "cat")
+            translator.main(["tests/cat.asm", target])
+            manifest = [
+                json.dumps({"id": "cat", "program": target, "input": "tests/cat_input"}),
+                json.dumps({"id": "short", "program": target, "schedule": [[1, "a"], [40, "\0"]]}),
+                json.dumps({"id": "limit", "program": target, "input": "tests/cat_input", "limit": 10}),
+                json.dumps({"id": "source", "program": "tests/cat.asm", "input": "tests/cat_input"}),
+            ]
+            translations = cache.TranslationCache(os.path.join(tmpdirname, "cache"))
+
+            results = {r["id"]: r for r in batch.run_batch(batch.read_manifest(manifest), 2, translations)}
+
+        self.assertEqual(results["cat"], {"id": "cat", "output": "Hello, world!", "instr": 154, "ticks": 403,
+                                          "error": None})
+        self.assertEqual(dict(results["source"], id="cat"), results["cat"])
+        self.assertEqual(results["short"]["output"], "a")
+        self.assertEqual(results["limit"]["error"], "too long execution, increase limit!")
+
+
+class TestReplay(unittest.TestCase):
+
+    def test_seek_matches_fresh_run(self):
+        program = load_source(open("tests/cat.asm", encoding="utf-8").read())
+        schedule = [(1, 'H'), (10, 'i'), (70, '!'), (150, 'x'), (200, '\0')]
+        config = machine.MachineConfig(limit=1000)
+
+        log = replay.record(program, schedule, config, interval=16)
+
+        self.assertEqual((log.output, log.instr, log.ticks),
+                         machine.simulation(program, schedule, config=config, tracer=None))
+        self.assertEqual(len(log.checkpoints), 14)
+        self.assertTrue(all(len(checkpoint.pages) <= 1 for checkpoint in log.checkpoints))
+        for instr in (0, 5, 37, 60, 10000):
+            control_unit = machine.build_machine(program, schedule, config=config)
+            machine.run(control_unit, config.limit, stop_at=instr)
+            seeked = log.seek(instr=instr)
+            self.assertEqual((seeked.current_tick(), seeked.instr_counter, seeked.data_path.registers,
+                              seeked.data_path.output_buf, seeked.data_path.memory.tolist()),
+                             (control_unit.current_tick(), control_unit.instr_counter,
+                              control_unit.data_path.registers, control_unit.data_path.output_buf,
+                              control_unit.data_path.memory.tolist()))
+        self.assertEqual(log.seek(tick=100).current_tick(), 101)
+        self.assertEqual(log.seek(tick=10 ** 6).halted, True)
+
+    def test_log_file_and_cli(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            target = os.path.join(tmpdirname, "prob1")
+            log_file = os.path.join(tmpdirname, "prob1.log")
+            with contextlib.redirect_stdout(io.StringIO()) as stdout:
+                translator.main(["tests/prob1.asm", target])
+                replay.main(["record", target, "tests/prob1_input", log_file, "--interval", "1000"])
+                replay.main(["seek", log_file, "--tick", "12345"])
+
+            log = replay.load_log(log_file)
+
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(lines[0], "checkpoints: 21  instr: 7899  ticks: 20473")
+        self.assertEqual(lines[1], "tick: 12347  instr: 4767  interrupted: False")
+        self.assertEqual(log.seek(instr=7899).data_path.output_buf, list("233168"))
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_same_output_other_ticks(self):
+        program = load_source(open("tests/prob1.asm", encoding="utf-8").read())
+
+        output, instr, ticks, report = pipeline.simulation(program, [])
+
+        self.assertEqual((output, instr), machine.simulation(program, [], tracer=None)[:2])
+        self.assertEqual(ticks, 9859)
+        self.assertEqual(report["stalls"], {"load_use": 6, "branch": 938, "jump": 1012, "return": 0,
+                                            "pc_write": 0, "interrupt": 0, "drain": 4})
+        self.assertEqual((report["branches"], report["taken"]), (2679, 469))
+        self.assertEqual(ticks, instr + sum(report["stalls"].values()))
+        self.assertAlmostEqual(report["cpi"] * report["ipc"], 1)
+
+    def test_hazard_penalties(self):
+        program = load_source("""
+_start:
+    addi r1, r0, 5
+    st r1, r0, 50
+    ld r2, r0, 50
+    add r3, r2, r2
+    beq r3, r0, _start
+    jmp end
+end:
+    hlt
+""")
+        timing = pipeline.PipelineTiming(load_use=2, branch_penalty=5, jump_penalty=3)
+        _, instr, ticks, report = pipeline.simulation(program, [], timing=timing)
+
+        self.assertEqual(instr, 7)
+        self.assertEqual(report["stalls"]["load_use"], 2)
+        self.assertEqual(report["stalls"]["branch"], 0)
+        self.assertEqual(report["stalls"]["jump"], 3)
+        self.assertEqual(ticks, 7 + 2 + 3 + 4)
+
+    def test_interrupts_and_idle_loop(self):
+        program = load_source(open("tests/cat.asm", encoding="utf-8").read())
+        schedule = [(1, 'H'), (10, 'i'), (70, '!'), (5000, '\0')]
+        stepped = pipeline.build_machine(program, schedule)
+        machine.run(stepped, stepped.limit, fast_forward=False, backend="blocks")
+        skipped = pipeline.build_machine(program, schedule)
+        machine.run(skipped, skipped.limit)
+
+        self.assertEqual(''.join(skipped.data_path.output_buf), "Hi!")
+        self.assertEqual(skipped.report(), stepped.report())
+        self.assertEqual(skipped.stalls["interrupt"], 4 * pipeline.PipelineTiming().interrupt_penalty)
+
+    def test_cli(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            target = os.path.join(tmpdirname, "hello")
+            with contextlib.redirect_stdout(io.StringIO()) as stdout:
+                translator.main(["tests/hello.asm", target])
+                pipeline.main([target, "tests/hello_input", "--branch-penalty", "3"])
+
+        self.assertEqual(stdout.getvalue().splitlines(), [
+            "output: hello",
+            "instr: 12  ticks: 16  CPI: 1.333  IPC: 0.750",
+            "stalls: load_use: 0  branch: 0  jump: 0  return: 0  pc_write: 0  interrupt: 0  drain: 4",
+            "branches: 0  taken: 0",
+        ])
+
+
+class TestDataCache(unittest.TestCase):
+    program = """
+_start:
+    addi r1, r0, 104
+    st r1, r0, 50
+    ld r2, r0, 60
+    ld r2, r0, 50
+    ld r2, r0, 70
+    ld r2, r0, 50
+    st r1, r0, 99
+    hlt
+"""
+
+    def test_replacement_and_write_policies(self):
+        program = load_source(self.program)
+        self.assertEqual(machine.simulation(program, [], tracer=None), ("h", 8, 22))
+
+        for policy, write_back, hits, writebacks, cycles in [("lru", True, 2, 0, 30), ("fifo", True, 1, 1, 50),
+                                                             ("lru", False, 1, 0, 40)]:
+            config = dcache.CacheConfig(size=2, ways=2, line=1, policy=policy, write_back=write_back)
+            output, instr, ticks, report = dcache.simulation(program, [], cache_config=config)
+
+            self.assertEqual((output, instr, ticks), ("h", 8, 22 + cycles))
+            self.assertEqual(report["ranges"]["data"]["hits"], hits)
+            self.assertEqual(report["ranges"]["data"]["misses"], 5 - hits)
+            self.assertEqual(report["ranges"]["mmio"], {"hits": 0, "misses": 1, "hit_rate": 0.0})
+            self.assertEqual((report["writebacks"], report["cycles"]), (writebacks, cycles))
+
+            control_unit = machine.build_machine(program, [])
+            dcache.attach(control_unit, config)
+            machine.run(control_unit, control_unit.limit, backend="blocks")
+            self.assertEqual(control_unit.current_tick(), ticks)
+
+    def test_stack_range_and_pipeline(self):
+        program = load_source(open("tests/cat.asm", encoding="utf-8").read())
+        schedule = [(1, 'a'), (10, 'b'), (30, 'c'), (60, '\0')]
+
+        output, instr, ticks, report = dcache.simulation(program, schedule, timing=pipeline.PipelineTiming())
+
+        self.assertEqual(output, "abc")
+        self.assertEqual(report["ranges"]["stack"], {"hits": 4, "misses": 3, "hit_rate": 4 / 7})
+        self.assertEqual(report["ranges"]["data"]["hits"] + report["ranges"]["data"]["misses"], 0)
+        control_unit = pipeline.build_machine(program, schedule)
+        dcache.attach(control_unit)
+        machine.run(control_unit, control_unit.limit)
+        stalls = control_unit.report()["stalls"]
+        self.assertEqual(stalls["memory"], report["cycles"])
+        self.assertEqual(ticks, instr + sum(stalls.values()))
+
+    def test_cli(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            source = os.path.join(tmpdirname, "source.asm")
+            with open(source, "w", encoding="utf-8") as file:
+                file.write(self.program)
+            with contextlib.redirect_stdout(io.StringIO()) as stdout:
+                dcache.main([source, "tests/hello_input", "--size", "2", "--line", "1", "--policy", "fifo"])
+
+        self.assertEqual(stdout.getvalue().splitlines(), [
+            "output: h",
+            "instr: 8  ticks: 72  memory stalls: 50",
+            "stack: hits: 0  misses: 0  hit rate: 0.0%",
+            "data: hits: 1  misses: 4  hit rate: 20.0%",
+            "mmio: hits: 0  misses: 1  hit rate: 0.0%",
+            "writebacks: 1  dirty: 0",
+        ])
+
+
+class TestPredictor(unittest.TestCase):
+    program = """
+_start:
+    addi r2, r0, 10
+loop:
+    addi r1, r1, 1
+    beq r1, r2, end
+    beq r0, r0, loop
+end:
+    hlt
+"""
+
+    def test_predictors_and_btb(self):
+        program = load_source(self.program)
+        self.assertEqual(machine.simulation(program, [], tracer=None), ("", 31, 82))
+
+        for kind, btb_entries, mispredicted, btb_hits, cycles in [("not-taken", 0, 10, 0, 20), ("bimodal", 0, 2, 0, 12),
+                                                                  ("bimodal", 16, 2, 8, 4), ("gshare", 16, 4, 7, 8)]:
+            config = predictor.PredictorConfig(kind=kind, entries=16, history=2, btb_entries=btb_entries)
+            _, instr, ticks, report = predictor.simulation(program, [], predictor_config=config)
+
+            self.assertEqual((instr, ticks), (31, 82 + cycles))
+            self.assertEqual((report["branches"], report["mispredicted"]), (19, mispredicted))
+            self.assertEqual((report["btb_hits"], report["cycles"]), (btb_hits, cycles))
+
+        exit_branch, loop_branch = report["per_pc"]
+        self.assertEqual((exit_branch["pc"], exit_branch["executed"], exit_branch["taken"]), (22, 10, 1))
+        self.assertEqual((loop_branch["pc"], loop_branch["executed"], loop_branch["taken"]), (23, 9, 9))
+
+    def test_pipeline_and_blocks_backend(self):
+        program = load_source(self.program)
+        control_unit = machine.build_machine(program, [])
+        predictor.attach(control_unit)
+        machine.run(control_unit, control_unit.limit, backend="blocks")
+        self.assertEqual(control_unit.current_tick(), 82 + 12)
+
+        control_unit = pipeline.build_machine(program, [])
+        predictor.attach(control_unit)
+        machine.run(control_unit, control_unit.limit)
+        report = control_unit.report()
+        self.assertEqual(report["stalls"]["branch"], 12)
+        self.assertEqual(report["ticks"], 31 + 12 + 4)
+
+    def test_cli(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            source = os.path.join(tmpdirname, "source.asm")
+            with open(source, "w", encoding="utf-8") as file:
+                file.write(self.program)
+            with contextlib.redirect_stdout(io.StringIO()) as stdout:
+                predictor.main([source, "tests/hello_input", "--btb", "16"])
+
+        self.assertEqual(stdout.getvalue().splitlines(), [
+            "output: ",
+            "instr: 31  ticks: 86  branch stalls: 4",
+            "branches: 19  mispredicted: 2  accuracy: 89.5%  BTB hits: 8",
+            "     22: executed: 10  taken: 1  accuracy: 90.0%",
+            "     23: executed: 9  taken: 9  accuracy: 88.9%",
+        ])
+
+
+class TestInterrupts(unittest.TestCase):
+    nested = """
+_int:
+    addi r7, r0, 98
+    ld r6, r7
+    beq r6, r0, end
+    addi r5, r0, 20
+busy:
+    subi r5, r5, 1
+    beq r5, r0, echo
+    jmp busy
+echo:
+    addi r7, r0, 99
+    st r6, r7
+    iret
+_timer:
+    addi r4, r0, 33
+    addi r3, r0, 99
+    st r4, r3
+    iret
+_start:
+    subi r1, pc, 4
+    addi r2, r0, 1
+    st r1, r2
+    addi r2, r0, 4
+    addi r3, r0, 97
+    st r2, r3
+loop:
+    jmp loop
+end:
+    hlt
+"""
+    time_slices = """
+_int:
+    iret
+_tick:
+    addi r6, r0, 96
+    ld r6, r6
+    addi r2, r2, 1
+    addi r3, r2, 48
+    addi r7, r0, 99
+    st r3, r7
+    beq r2, r5, end
+    iret
+_start:
+    subi r4, pc, 8
+    addi r3, r0, 1
+    st r4, r3
+    addi r5, r0, 5
+    addi r3, r0, 97
+    addi r4, r0, 4
+    st r4, r3
+    addi r3, r0, 95
+    addi r4, r0, 50
+    st r4, r3
+work:
+    addi r1, r1, 1
+    jmp work
+end:
+    hlt
+"""
+    output_ready = """
+_int:
+    iret
+_ready:
+    addi r1, r1, 1
+    beq r1, r2, end
+    st r1, r3
+    iret
+_start:
+    subi r4, pc, 4
+    addi r5, r0, 2
+    st r4, r5
+    addi r1, r0, 97
+    addi r2, r0, 101
+    addi r3, r0, 99
+    addi r5, r0, 97
+    addi r6, r0, 2
+    st r6, r5
+    st r1, r3
+loop:
+    jmp loop
+end:
+    hlt
+"""
+
+    def test_no_input_is_lost(self):
+        program = load_source(open("tests/cat.asm", encoding="utf-8").read())
+        schedule = [(1, 'a'), (2, 'b'), (3, 'c'), (100, '\0')]
+
+        self.assertEqual(machine.simulation(program, schedule, tracer=None)[0], "ac")
+        output, _, _, report = interrupts.simulation(program, schedule)
+        self.assertEqual(output, "abc")
+        self.assertEqual(report["input"]["entered"], 4)
+
+    def test_nested_priorities(self):
+        program = load_source(self.nested)
+        schedule = [(50, 'a'), (51, 'b'), (52, 'c'), (600, '\0')]
+
+        for priorities, expected, timer_latency in [((1, 2, 0), "!abc", 4), ((2, 1, 0), "abc!", 473)]:
+            control_unit = interrupts.build_machine(program, schedule,
+                                                    irq_config=interrupts.IrqConfig(priorities=priorities))
+            control_unit.input_irq.raise_request(interrupts.TIMER, 70)
+            machine.run(control_unit, control_unit.limit, backend="blocks")
+
+            self.assertEqual(''.join(control_unit.data_path.output_buf), expected)
+            self.assertIsNone(control_unit.error)
+            report = control_unit.input_irq.report()
+            self.assertEqual((report["input"]["entered"], report["timer"]["entered"]), (4, 1))
+            self.assertEqual(report["timer"]["max_latency"], timer_latency)
+            # the last input handler halts, its frame is left on the stack
+            self.assertEqual(control_unit.data_path.registers[machine.SP], 94)
+
+    def test_output_ready(self):
+        program = load_source(self.output_ready)
+
+        output, instr, ticks, report = interrupts.simulation(program, [],
+                                                             irq_config=interrupts.IrqConfig(output_delay=10))
+
+        self.assertEqual((output, instr, ticks), ("abcd", 43, 114))
+        self.assertEqual(report["output_ready"], {"entered": 4, "coalesced": 0, "mean_latency": 3.25,
+                                                  "max_latency": 4})
+
+    def test_timer_slices(self):
+        busy = load_source(self.time_slices)
+        idle = load_source(self.time_slices.replace("    addi r1, r1, 1\n    jmp work", "    jmp work"))
+
+        for program, instr in [(busy, 111), (idle, 125)]:
+            for fast_forward in (True, False):
+                control_unit = interrupts.build_machine(program, [])
+                machine.run(control_unit, control_unit.limit, fast_forward=fast_forward)
+
+                self.assertEqual(''.join(control_unit.data_path.output_buf), "12345")
+                self.assertEqual((control_unit.instr_counter, control_unit.current_tick()), (instr, 304))
+                # the counter register read 8 ticks into the last handler
+                self.assertEqual(control_unit.data_path.registers[6], 42)
+                self.assertEqual(control_unit.input_irq.report()["timer"]["coalesced"], 0)
+
+    def test_timer_overrun_and_one_shot(self):
+        program = load_source(self.time_slices.replace("addi r4, r0, 50", "addi r4, r0, 10"))
+        output, _, ticks, report = interrupts.simulation(program, [])
+
+        self.assertEqual((output, ticks), ("12345", 172))
+        self.assertEqual((report["timer"]["entered"], report["timer"]["coalesced"]), (5, 6))
+
+        timer = interrupts.build_machine(program, []).input_irq.timer
+        timer.write_counter(100, 30)
+        self.assertEqual((timer.expiry, timer.read_counter(110)), (130, 20))
+        timer.serviced(135)
+        self.assertEqual((timer.expiry, timer.read_counter(140)), (interrupts.NONE, 0))
+        timer.write_reload(200, 25)
+        self.assertEqual((timer.expiry, timer.read_counter(260)), (225, 15))
+        timer.serviced(260)
+        self.assertEqual(timer.expiry, 275)
+        self.assertEqual(timer.controller.coalesced[interrupts.TIMER], 1)
+
+    def test_cli(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            source = os.path.join(tmpdirname, "source.asm")
+            with open(source, "w", encoding="utf-8") as file:
+                file.write(self.output_ready)
+            with contextlib.redirect_stdout(io.StringIO()) as stdout:
+                interrupts.main([source, "tests/hello_input", "--output-delay", "10"])
+
+        self.assertEqual(stdout.getvalue().splitlines(), [
+            "output: abcd",
+            "instr: 43  ticks: 114",
+            "input: entered: 0  coalesced: 0  latency: mean 0.0  max 0",
+            "timer: entered: 0  coalesced: 0  latency: mean 0.0  max 0",
+            "output_ready: entered: 4  coalesced: 0  latency: mean 3.2  max 4",
+        ])
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def test_resume_matches_uninterrupted_run(self):
+        program = load_source(open("tests/cat.asm", encoding="utf-8").read())
+        schedule = [(1, 'H'), (10, 'i'), (70, '!'), (200, '\0')]
+        expected = machine.simulation(program, schedule, data_memory_size=100, limit=1000, tracer=None)
+
+        control_unit = machine.build_machine(program, schedule, 100, 1000)
+        machine.run(control_unit, 1000, stop_at=9)
+        data = snapshot.take_snapshot(control_unit)
+
+        self.assertEqual(snapshot.resume_simulation(data), expected)
+        self.assertEqual(snapshot.resume_simulation(data), expected)
+
+    def test_snapshot_keeps_overwritten_code(self):
+        program = load_source("_start:\n    addi r1, r0, 21\n    st r1, r1\n    hlt\n")
+        control_unit = machine.build_machine(program, [], 100, 100)
+        machine.run(control_unit, 100, stop_at=2)
+
+        restored = snapshot.restore_snapshot(snapshot.take_snapshot(control_unit))
+
+        self.assertEqual(restored.data_path.code[1], None)
+        self.assertEqual(restored.data_path.memory[21], 21)
+        self.assertEqual((restored.current_tick(), restored.instr_counter), (6, 2))
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_benchmark_reports_and_compares(self):
+        results = benchmark.run_benchmarks(["cat", "labels"], scale=1, repeat=1)
+
+        self.assertEqual((results["labels"]["instr"], results["labels"]["ticks"]), (3003, 7008))
+        self.assertEqual(benchmark.compare(results, results, tolerance=0.1), [])
+        slower = {"labels": dict(results["labels"], instr_per_sec=results["labels"]["instr_per_sec"] / 2)}
+        regressions = benchmark.compare(slower, results, tolerance=0.1)
+        self.assertEqual(len(regressions), 1)
+        self.assertTrue(regressions[0].startswith("labels.instr_per_sec"))
@@ -0,0 +1,392 @@
+"""
+Vectored interrupt controller with priorities, masking and nesting.
+
+`VectoredControlUnit` replaces the single input interrupt of
+`ControlUnit` with several sources:
+
+    0  input         -- a character of the input schedule
+    1  timer         -- the programmable `Timer`, or any device calling
+                        `raise_request`
+    2  output_ready  -- the output device is ready again `output_delay`
+                        ticks after a character is written
+
+The handler of source i starts at the address in memory[i], the vector
+table. memory[0] is the `_int` label as before, a program installs the
+other handlers by storing their addresses. Source i is masked while bit i
+of the mask register is set.
+
+Device registers are read and written by `ld`/`st`. By default they sit
+below the input and output addresses, and the stack starts below them:
+
+    memory_size - 3   mask register
+    memory_size - 4   timer counter
+    memory_size - 5   timer reload, the initial SP that the stack never writes
+
+A handler runs at the priority of its source and is preempted only by a
+source of a higher priority, so handlers nest, and `iret` returns to the
+priority of the interrupted code. Requests are latched: input events wait
+in the queue until they can be delivered, one per interrupt, and none is
+dropped. A timer or output-ready request stays raised until its handler
+is entered; raising it again meanwhile is counted as coalesced.
+
+`next_due` is the earliest tick an unmasked source of a priority above
+the running handler is requested at. It is recomputed only when the mask,
+the running priority or a request changes, so checking for an interrupt
+is still one comparison per instruction. The latency of every interrupt,
+from the tick it was raised to the tick its handler starts, is counted
+per source.
+
+    interrupts.py <program> <input_file> [--priorities 1,2,0] [--mask N] ...
+"""
+
+import argparse
+import sys
+from typing import Callable, NamedTuple, Optional, Tuple
+
+import machine
+from devices import read_events
+from machine import PC, SP, AluOperation, ControlUnit, InterruptController
+
+INPUT, TIMER, OUTPUT_READY = range(3)
+SOURCES = ("input", "timer", "output_ready")
+NONE = float('inf')
+
+
+class IrqConfig(NamedTuple):
+    """
+    `priorities` of the sources, a higher one preempts a lower one. Set
+    bits of `mask` mask the sources, only the input is enabled at start.
+    `mask_addr` None is `memory_size - 3`. `timer_addr` is the counter
+    register, the reload register is the word below it; None is
+    `memory_size - 4`.
+    """
+    priorities: Tuple[int, ...] = (1, 2, 0)
+    mask: int = 0b110
+    output_delay: int = 0
+    mask_addr: Optional[int] = None
+    timer_addr: Optional[int] = None
+
+
+class Timer:
+    """
+    A programmable timer, the timer source of its controller. Writing the
+    counter register sets the ticks to the next expiry, 0 stops the timer.
+    Writing the reload register sets the period and starts a stopped
+    timer; with reload 0 the timer is one-shot.
+
+    The timer never counts ticks down. It keeps the tick of its next
+    expiry, which is the raised tick of the timer source, and a read of the
+    counter register is computed from it. When the handler is entered
+    later than a period after the expiry, the missed expiries are counted
+    as coalesced and the next one after the entry is armed.
+    """
+
+    def __init__(self, controller: "VectoredInterruptController"):
+        self.controller = controller
+        self.period: int = 0
+        self.expiry: float = NONE
+
+    def arm(self, expiry: float):
+        self.expiry = expiry
+        self.controller.raised[TIMER] = expiry
+        self.controller.update()
+
+    def read_counter(self, tick: int) -> int:
+        if self.expiry == NONE:
+            return 0
+        if self.expiry > tick:
+            return int(self.expiry) - tick
+        if not self.period:
+            return 0
+        return self.period - (tick - int(self.expiry)) % self.period
+
+    def write_counter(self, tick: int, value: int):
+        self.arm(tick + value if value > 0 else NONE)
+
+    def read_reload(self, tick: int) -> int:
+        return self.period
+
+    def write_reload(self, tick: int, value: int):
+        self.period = max(0, value)
+        if self.expiry == NONE and self.period:
+            self.arm(tick + self.period)
+
+    def serviced(self, tick: int):
+        """The handler of the expiry is entered at `tick`."""
+        if not self.period:
+            self.arm(NONE)
+            return
+        expired = (tick - int(self.expiry)) // self.period + 1
+        self.controller.coalesced[TIMER] += expired - 1
+        self.arm(self.expiry + expired * self.period)
+
+
+class VectoredInterruptController:
+    """
+    Has the interface of `InterruptController` the rest of the machine
+    uses: `next_due`, `consumed`, `pending` and `push` refer to the input.
+    """
+
+    def __init__(self, schedule=(), config: IrqConfig = IrqConfig()):
+        assert len(config.priorities) == len(SOURCES), f"Priorities of {len(SOURCES)} sources expected"
+        self.events = InterruptController(schedule)
+        self.priorities: Tuple[int, ...] = tuple(config.priorities)
+        self.mask: int = config.mask
+        # the tick a source other than the input is raised at
+        self.raised: list[float] = [NONE] * len(SOURCES)
+        # priorities of the running handlers, innermost last
+        self.levels: list[int] = []
+        self.entered: list[int] = [0] * len(SOURCES)
+        self.coalesced: list[int] = [0] * len(SOURCES)
+        self.latency_total: list[int] = [0] * len(SOURCES)
+        self.latency_max: list[int] = [0] * len(SOURCES)
+        self.next_due: float = NONE
+        self.timer = Timer(self)
+        self.update()
+
+    @property
+    def consumed(self) -> int:
+        return self.events.consumed
+
+    def __len__(self):
+        return len(self.events)
+
+    def pending(self) -> list[Tuple[int, str]]:
+        return self.events.pending()
+
+    def push(self, tick: int, char: str):
+        self.events.push(tick, char)
+        self.update()
+
+    def requested_at(self, source: int) -> float:
+        return self.events.next_due if source == INPUT else self.raised[source]
+
+    def deliverable(self, source: int) -> bool:
+        level = self.levels[-1] if self.levels else -1
+        return self.priorities[source] > level and not self.mask >> source & 1
+
+    def update(self):
+        level = self.levels[-1] if self.levels else -1
+        due = NONE
+        for source, priority in enumerate(self.priorities):
+            if priority > level and not self.mask >> source & 1:
+                requested = self.events.next_due if source == INPUT else self.raised[source]
+                if requested < due:
+                    due = requested
+        self.next_due = due
+
+    def read_mask(self, tick: int) -> int:
+        return self.mask
+
+    def write_mask(self, tick: int, mask: int):
+        self.mask = mask
+        self.update()
+
+    def raise_request(self, source: int, tick: int):
+        if self.raised[source] == NONE:
+            self.raised[source] = tick
+            self.update()
+        else:
+            self.coalesced[source] += 1
+
+    def acknowledge(self, tick: int) -> Tuple[int, int, Optional[str]]:
+        """
+        Take the most urgent request due at `tick` and run at its priority.
+        Returns the source, the tick it was raised at and the input character.
+        """
+        source = None
+        for candidate in range(len(SOURCES)):
+            if self.deliverable(candidate) and self.requested_at(candidate) <= tick and \
+                    (source is None or self.priorities[candidate] > self.priorities[source]):
+                source = candidate
+        char = None
+        if source == INPUT:
+            raised, char = self.events.take(tick)
+        else:
+            raised, self.raised[source] = int(self.raised[source]), NONE
+        self.levels.append(self.priorities[source])
+        if source == TIMER and self.timer.expiry != NONE:
+            self.timer.serviced(tick)
+        self.update()
+        return source, raised, char
+
+    def record(self, source: int, raised: int, entered: int):
+        latency = entered - raised
+        self.entered[source] += 1
+        self.latency_total[source] += latency
+        self.latency_max[source] = max(self.latency_max[source], latency)
+
+    def leave(self):
+        if self.levels:
+            self.levels.pop()
+        self.update()
+
+    def report(self) -> dict:
+        return {name: {"entered": self.entered[source], "coalesced": self.coalesced[source],
+                       "mean_latency": self.latency_total[source] / self.entered[source] if self.entered[source] else 0.0,
+                       "max_latency": self.latency_max[source]}
+                for source, name in enumerate(SOURCES)}
+
+
+class VectoredControlUnit(ControlUnit):
+    """
+    `input_irq` is a `VectoredInterruptController`. `device_registers` maps
+    an address to the read and the write function of a device register,
+    both are given the current tick.
+    """
+
+    # the blocks backend compiles the single-source interrupt check
+    compilable = False
+
+    def __init__(self, data_path, controller: VectoredInterruptController, limit, mask_addr: int,
+                 timer_addr: int, output_delay: int = 0):
+        super().__init__(data_path, controller, limit)
+        self.output_delay = output_delay
+        timer = controller.timer
+        self.device_registers: dict[int, Tuple[Callable[[int], int], Callable[[int, int], None]]] = {
+            mask_addr: (controller.read_mask, controller.write_mask),
+            timer_addr: (timer.read_counter, timer.write_counter),
+            timer_addr - 1: (timer.read_reload, timer.write_reload),
+        }
+
+    def decode_and_execute_instruction(self):
+        op1 = self.data_path.registers[PC]
+        self.data_path.latch_alu(op1, 0, AluOperation.ADD)
+        self.data_path.latch_calc_on_memory()
+        self.tick()
+        instr = self.data_path.fetch_instruction()
+
+        self.last_instr = instr
+        self.instr_counter += 1
+
+        if self.input_irq.next_due <= self._tick:
+            self.enter_interrupt()
+            return
+
+        self._handlers[instr.handler](instr)
+
+    def enter_interrupt(self):
+        controller = self.input_irq
+        source, raised, char = controller.acknowledge(self._tick)
+        self.is_interrupted = True
+        self.push_program_counter()
+        self.data_path.registers[PC] = self.data_path.memory[source]
+        if char is not None:
+            self.data_path.input_buf = ord(char)
+        self.tick()
+        controller.record(source, raised, self._tick)
+
+    def pop_program_counter(self):
+        """
+        Unlike `ControlUnit`, SP moves back up past the popped PC, so the
+        frames of nested handlers unwind in order.
+        """
+        sp_current = self.data_path.registers[SP]
+        self.data_path.latch_alu(sp_current, 0, AluOperation.ADD)
+        self.data_path.latch_calc_on_memory()
+        if self.data_cache is not None:
+            self._tick += self.data_cache.access(self.data_path.mem_addr_bus, False)
+        self.data_path.mem_read(PC)
+        self.tick()
+        self.data_path.latch_alu(sp_current, 1, AluOperation.ADD)
+        self.data_path.latch_calc_on_register(SP)
+        self.tick()
+
+    def execute_iret(self, instr):
+        super().execute_iret(instr)
+        self.input_irq.leave()
+        self.is_interrupted = bool(self.input_irq.levels)
+
+    def execute_ld(self, instr):
+        self.latch_operands(instr)
+        register = self.device_registers.get(self.data_path.alu.result)
+        if register is None:
+            super().execute_ld(instr)
+            return
+        self.data_path.latch_calc_on_memory()
+        self.data_path.registers[instr.rd] = register[0](self._tick)
+        self.tick()
+        self.inc_program_counter()
+
+    def execute_st(self, instr):
+        self.latch_operands(instr)
+        addr = self.data_path.alu.result
+        register = self.device_registers.get(addr)
+        if register is None:
+            super().execute_st(instr)
+            if addr == self.data_path.output_map_addr:
+                self.input_irq.raise_request(OUTPUT_READY, self._tick + self.output_delay)
+            return
+        self.data_path.latch_calc_on_memory()
+        register[1](self._tick, self.data_path.registers[instr.rd])
+        self.tick()
+        self.inc_program_counter()
+
+    def skip_idle_iterations(self, max_iterations: int) -> int:
+        """As in ControlUnit, but a handler can be interrupted too."""
+        if self.input_irq.next_due == NONE:
+            skipped = max_iterations
+        else:
+            due = int(self.input_irq.next_due)
+            skipped = min(max(0, (due - self._tick) // 2), max_iterations)
+        self._tick += 2 * skipped
+        self.instr_counter += skipped
+        return skipped
+
+
+def build_machine(program, input_schedule, config: machine.MachineConfig = machine.MachineConfig(),
+                  irq_config: IrqConfig = IrqConfig()) -> VectoredControlUnit:
+    data_path = machine.build_machine(program, (), config=config).data_path
+    mask_addr = config.memory_size - 3 if irq_config.mask_addr is None else irq_config.mask_addr
+    timer_addr = config.memory_size - 4 if irq_config.timer_addr is None else irq_config.timer_addr
+    registers = (mask_addr, timer_addr, timer_addr - 1)
+    assert all(0 < addr < config.memory_size for addr in registers), "Device registers are outside of memory"
+    assert len(set(registers + (data_path.input_map_addr, data_path.output_map_addr))) == 5, \
+        "Device registers overlap"
+    if config.stack_top is None:
+        data_path.registers[SP] = min(registers)
+    controller = VectoredInterruptController(input_schedule, irq_config)
+    control_unit = VectoredControlUnit(data_path, controller, config.limit, mask_addr, timer_addr,
+                                       irq_config.output_delay)
+    control_unit.tick_limit = config.tick_limit
+    return control_unit
+
+
+def simulation(program, input_schedule, config: machine.MachineConfig = machine.MachineConfig(),
+               irq_config: IrqConfig = IrqConfig()):
+    """Like `machine.simulation`, also returns the interrupt metrics per source."""
+    control_unit = build_machine(program, input_schedule, config, irq_config)
+    instr = machine.run(control_unit, config.limit)
+    return ''.join(control_unit.data_path.output_buf), instr, control_unit.current_tick(), \
+        control_unit.input_irq.report()
+
+
+def main(args):
+    parser = argparse.ArgumentParser(prog="interrupts.py")
+    parser.add_argument("program_file")
+    parser.add_argument("input_file")
+    defaults = IrqConfig()
+    parser.add_argument("--priorities", type=lambda text: tuple(int(p) for p in text.split(",")),
+                        default=defaults.priorities, help="of " + ",".join(SOURCES))
+    parser.add_argument("--mask", type=int, default=defaults.mask, help="initial mask register")
+    parser.add_argument("--output-delay", type=int, default=defaults.output_delay)
+    parser.add_argument("--mask-addr", type=int, help="memory size - 3 by default")
+    parser.add_argument("--timer-addr", type=int, help="counter, reload below it; memory size - 4 by default")
+    machine.add_config_args(parser)
+    options = parser.parse_args(args)
+
+    irq_config = IrqConfig(options.priorities, options.mask, options.output_delay, options.mask_addr,
+                           options.timer_addr)
+    program = machine.load_program_file(options.program_file)
+    with open(options.input_file, encoding="utf-8") as file:
+        output, instr, ticks, report = simulation(program, read_events(file), machine.config_from_args(options),
+                                                  irq_config)
+    print(f"output: {output}")
+    print(f"instr: {instr}  ticks: {ticks}")
+    for name, metrics in report.items():
+        print(f"{name}: entered: {metrics['entered']}  coalesced: {metrics['coalesced']}  "
+              f"latency: mean {metrics['mean_latency']:.1f}  max {metrics['max_latency']}")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
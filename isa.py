@@ -1,4 +1,6 @@
 import json
+import mmap
+import struct
 from enum import Enum
 
 
@@ -43,23 +45,135 @@ class Register(str, Enum):
     SP = "sp",
 
 
-def read_program(filename: str):
-    with open(filename, encoding='utf-8') as file:
-        program = json.load(file)
-        for instr in program["code"]:
-            instr["opcode"] = Opcode(instr["opcode"])
-            if len(instr) == 4:
-                if ('imm' in instr) and ('rs' in instr):
-                    instr["type"] = InstructionType.B
-                elif 'imm' in instr:
-                    instr["type"] = InstructionType.E
-                else:
-                    instr["type"] = InstructionType.A
-            elif len(instr) == 3:
-                instr["type"] = InstructionType.C
-            elif len(instr) == 2:
-                instr["type"] = InstructionType.D
-            elif len(instr) == 1:
-                instr["type"] = InstructionType.F
+OPCODE_INDEX: dict[Opcode, int] = {opcode: idx for idx, opcode in enumerate(Opcode)}
+REGISTER_INDEX: dict[Register, int] = {register: idx for idx, register in enumerate(Register)}
+
+
+INSTRUCTION_TYPES = list(InstructionType)
+OPCODES = list(Opcode)
+REGISTERS = list(Register)
+
+# Binary object format: a header followed by one fixed-width record per
+# instruction. The record packs opcode and type into the first byte, then
+# three register slots and a 32-bit immediate. Slot usage per type:
+#   A: rd, rs1, rs2     B: rd, rs, -, imm     C: rd, rs
+#   D: -, -, -, imm     E: -, rs1, rs2, imm   F: nothing
+BINARY_MAGIC = b"PMBF"
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct("<4sHHII")        # magic, version, reserved, start, count
+BINARY_INSTRUCTION = struct.Struct("<BBBBi")    # opcode | type << 4, slot1, slot2, slot3, imm
+NO_SLOT = 0xFF
+
+
+def instruction_type(instr) -> InstructionType:
+    if len(instr) == 4:
+        if ('imm' in instr) and ('rs' in instr):
+            return InstructionType.B
+        if 'imm' in instr:
+            return InstructionType.E
+        return InstructionType.A
+    if len(instr) == 3:
+        return InstructionType.C
+    if len(instr) == 2:
+        return InstructionType.D
+    if len(instr) == 1:
+        return InstructionType.F
+    raise ValueError(f"Unknown instruction format: {instr}")
+
+
+def encode_instruction(instr) -> bytes:
+    instr_type = instruction_type(instr)
+    slots = [NO_SLOT, NO_SLOT, NO_SLOT]
+    imm = 0
+    if instr_type == InstructionType.A:
+        slots = [REGISTER_INDEX[instr['rd']], REGISTER_INDEX[instr['rs1']], REGISTER_INDEX[instr['rs2']]]
+    elif instr_type == InstructionType.B:
+        slots = [REGISTER_INDEX[instr['rd']], REGISTER_INDEX[instr['rs']], NO_SLOT]
+        imm = int(instr['imm'])
+    elif instr_type == InstructionType.C:
+        slots = [REGISTER_INDEX[instr['rd']], REGISTER_INDEX[instr['rs']], NO_SLOT]
+    elif instr_type == InstructionType.D:
+        imm = int(instr['imm'])
+    elif instr_type == InstructionType.E:
+        slots = [NO_SLOT, REGISTER_INDEX[instr['rs1']], REGISTER_INDEX[instr['rs2']]]
+        imm = int(instr['imm'])
+    if not -2147483648 <= imm <= 2147483647:
+        raise ValueError(f"Immediate doesn't fit into 32 bits: {instr}")
+    opcode_type = OPCODE_INDEX[Opcode(instr['opcode'])] | INSTRUCTION_TYPES.index(instr_type) << 4
+    return BINARY_INSTRUCTION.pack(opcode_type, *slots, imm)
+
+
+def encode_program(program) -> bytes:
+    header = BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, 0, program["start"], len(program["code"]))
+    return header + b"".join(encode_instruction(instr) for instr in program["code"])
+
+
+def record_to_dict(record) -> dict:
+    """Rebuild the instruction as read_program returns it from JSON."""
+    opcode_type, slot1, slot2, slot3, imm = record
+    opcode, instr_type = OPCODES[opcode_type & 0xF], INSTRUCTION_TYPES[opcode_type >> 4]
+    instr: dict = {"opcode": opcode}
+    if instr_type == InstructionType.A:
+        instr.update(rd=REGISTERS[slot1].value, rs1=REGISTERS[slot2].value, rs2=REGISTERS[slot3].value)
+    elif instr_type == InstructionType.B:
+        instr.update(rd=REGISTERS[slot1].value, rs=REGISTERS[slot2].value, imm=str(imm))
+    elif instr_type == InstructionType.C:
+        instr.update(rd=REGISTERS[slot1].value, rs=REGISTERS[slot2].value)
+    elif instr_type == InstructionType.D:
+        instr.update(imm=imm)
+    elif instr_type == InstructionType.E:
+        instr.update(rs1=REGISTERS[slot2].value, rs2=REGISTERS[slot3].value, imm=imm)
+    instr["type"] = instr_type
+    return instr
+
+
+class BinaryCode:
+    """
+    Instruction records of a binary program, read in place from a buffer.
 
+    Iterating yields raw record tuples, so no dict is built per instruction.
+    """
+
+    def __init__(self, buffer, count: int):
+        self.buffer = memoryview(buffer)[BINARY_HEADER.size:BINARY_HEADER.size + count * BINARY_INSTRUCTION.size]
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return BINARY_INSTRUCTION.iter_unpack(self.buffer)
+
+    def __getitem__(self, idx: int) -> dict:
+        return record_to_dict(BINARY_INSTRUCTION.unpack_from(self.buffer, idx * BINARY_INSTRUCTION.size))
+
+
+def read_binary_program(buffer):
+    magic, version, _, start, count = BINARY_HEADER.unpack_from(buffer)
+    assert magic == BINARY_MAGIC, "Not a binary program"
+    assert version == BINARY_VERSION, f"Unsupported binary program version {version}"
+    assert len(buffer) >= BINARY_HEADER.size + count * BINARY_INSTRUCTION.size, "Truncated binary program"
+    return {"start": start, "code": BinaryCode(buffer, count)}
+
+
+def prepare_program(program):
+    """Turn translator output into the loadable form, in place: opcodes become enums and types are added."""
+    for instr in program["code"]:
+        instr["opcode"] = Opcode(instr["opcode"])
+        if 1 <= len(instr) <= 4:
+            instr["type"] = instruction_type(instr)
     return program
+
+
+def parse_program(data: bytes):
+    if data[:len(BINARY_MAGIC)] == BINARY_MAGIC:
+        return read_binary_program(data)
+    return prepare_program(json.loads(data))
+
+
+def read_program(filename: str):
+    with open(filename, "rb") as file:
+        if file.read(len(BINARY_MAGIC)) == BINARY_MAGIC:
+            return read_binary_program(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+        file.seek(0)
+        return parse_program(file.read())
@@ -1,10 +1,19 @@
 import sys
-import ast
-from typing import Union, Tuple
+import argparse
+import contextlib
+import heapq
+import mmap
+from array import array
+from typing import Iterable, Iterator, Tuple, NamedTuple, Optional, Union
 import logging
-from isa import Opcode, Register, InstructionType, read_program
-from exceptions import OutOfBufferException, AluOpcodeException, ZeroRegisterModificationException
+from isa import Opcode, Register, InstructionType, OPCODE_INDEX, REGISTER_INDEX, \
+    INSTRUCTION_TYPES, NO_SLOT, BinaryCode, record_to_dict
+from exceptions import OutOfBufferException, AluOpcodeException, ZeroRegisterModificationException, \
+    WordOverflowException
 from enum import Enum
+from tracing import TextTracer, TRACE_MODES, make_tracer
+from devices import StreamOutput, read_events
+from cache import TranslationCache, load_program_file
 
 
 class AluOperation(str, Enum):
@@ -43,6 +52,142 @@ class Alu:
             self.ZF = 1
 
 
+R0 = REGISTER_INDEX[Register.R0]
+PC = REGISTER_INDEX[Register.PC]
+SP = REGISTER_INDEX[Register.SP]
+
+LD = OPCODE_INDEX[Opcode.LD]
+ST = OPCODE_INDEX[Opcode.ST]
+JMP = OPCODE_INDEX[Opcode.JMP]
+BEQ = OPCODE_INDEX[Opcode.BEQ]
+IRET = OPCODE_INDEX[Opcode.IRET]
+HLT = OPCODE_INDEX[Opcode.HLT]
+
+ALU_OPERATIONS: dict[int, AluOperation] = {
+    OPCODE_INDEX[Opcode.ADD]: AluOperation.ADD,
+    OPCODE_INDEX[Opcode.SUB]: AluOperation.SUB,
+    OPCODE_INDEX[Opcode.MUL]: AluOperation.MUL,
+    OPCODE_INDEX[Opcode.DIV]: AluOperation.DIV,
+    OPCODE_INDEX[Opcode.REM]: AluOperation.REM,
+    OPCODE_INDEX[Opcode.ADDI]: AluOperation.ADD,
+    OPCODE_INDEX[Opcode.SUBI]: AluOperation.SUB,
+    LD: AluOperation.ADD,
+    ST: AluOperation.ADD,
+    JMP: AluOperation.ADD,
+    BEQ: AluOperation.SUB,
+}
+
+NO_REGISTER = None
+
+# Handlers that do not correspond to an opcode. The decoder selects them
+# for instructions that can only fail, so the step loop does no validation,
+# and for a jump to itself, which the run loop can fast-forward.
+ILLEGAL_INSTRUCTION = len(Opcode)
+ZERO_REGISTER_WRITE = len(Opcode) + 1
+IDLE_JMP = len(Opcode) + 2
+
+
+BACKENDS = ["step", "blocks"]
+
+# the longest step: an interrupt entry is a fetch, two ticks of push and a jump to the handler
+MAX_INSTRUCTION_TICKS = 4
+
+
+class IdleLoop(Exception):
+    """Raised after a jump to itself when the run loop may skip idle iterations."""
+
+
+def bound(num: int):
+    if num > 2147483647:
+        return -2147483648 + (num - 2147483647)
+    if num < -2147483648:
+        return 2147483647 - (num + 2147483648)
+    return num
+
+
+class DecodedInstruction(NamedTuple):
+    """
+    Instruction prepared for execution at load time.
+
+    Registers are indices into `DataPath.registers`. `rs1`/`rs2` select
+    the left and right ALU inputs. NO_REGISTER means that the input is taken
+    from `imm`, so every instruction type shares a single operand fetch.
+    `rd` is NO_REGISTER when the instruction has no destination. `handler`
+    is the opcode, or one of the raising handlers for an instruction that
+    can't be executed. `source` keeps the original instruction for the log:
+    a dict from JSON or a record tuple from the binary format.
+    """
+    opcode: int
+    rd: Optional[int]
+    rs1: Optional[int]
+    rs2: Optional[int]
+    imm: int
+    handler: int
+    source: Union[dict, tuple]
+
+
+def decode_operands(opcode: int, instr_type: InstructionType, rd: Optional[int], rs1: Optional[int],
+                    rs2: Optional[int], imm: int, source) -> DecodedInstruction:
+    """Map the instruction type to ALU inputs. Register slots not used by the type are ignored."""
+    if rd == R0:
+        return DecodedInstruction(opcode, rd, NO_REGISTER, NO_REGISTER, 0, ZERO_REGISTER_WRITE, source)
+
+    if instr_type == InstructionType.A:
+        imm = 0
+    elif instr_type == InstructionType.B:
+        rs2, imm = NO_REGISTER, bound(imm)
+    elif instr_type == InstructionType.C:
+        rs2, imm = NO_REGISTER, 0
+    elif instr_type == InstructionType.D:
+        rs1, rs2, imm = NO_REGISTER, PC, bound(imm)
+    elif instr_type == InstructionType.E:
+        imm = bound(imm)
+    elif opcode in (IRET, HLT):
+        rs1, rs2, imm = NO_REGISTER, NO_REGISTER, 0
+    else:
+        rs1, rs2, imm = PC, NO_REGISTER, 0
+
+    if rd is NO_REGISTER and opcode not in (JMP, BEQ, IRET, HLT):
+        return DecodedInstruction(opcode, rd, rs1, rs2, imm, ILLEGAL_INSTRUCTION, source)
+
+    if opcode == JMP and imm == 0 and {rs1, rs2} == {NO_REGISTER, PC}:
+        return DecodedInstruction(opcode, rd, rs1, rs2, imm, IDLE_JMP, source)
+
+    return DecodedInstruction(opcode, rd, rs1, rs2, imm, opcode, source)
+
+
+def decode_instruction(instr) -> DecodedInstruction:
+    opcode = OPCODE_INDEX[instr['opcode']]
+    try:
+        rd = REGISTER_INDEX[instr['rd']] if 'rd' in instr else NO_REGISTER
+        if rd == R0:
+            return decode_operands(opcode, InstructionType.F, rd, NO_REGISTER, NO_REGISTER, 0, instr)
+
+        instr_type = instr['type']
+        rs1 = rs2 = NO_REGISTER
+        imm = 0
+        if instr_type in (InstructionType.A, InstructionType.E):
+            rs1, rs2 = REGISTER_INDEX[instr['rs1']], REGISTER_INDEX[instr['rs2']]
+        elif instr_type in (InstructionType.B, InstructionType.C):
+            rs1 = REGISTER_INDEX[instr['rs']]
+        if instr_type in (InstructionType.B, InstructionType.D, InstructionType.E):
+            imm = int(instr['imm'])
+    except (KeyError, ValueError):
+        return DecodedInstruction(opcode, NO_REGISTER, NO_REGISTER, NO_REGISTER, 0, ILLEGAL_INSTRUCTION, instr)
+
+    return decode_operands(opcode, instr_type, rd, rs1, rs2, imm, instr)
+
+
+def decode_record(record) -> DecodedInstruction:
+    """Decode a record of the binary format. The record itself is kept as the source."""
+    opcode_type, slot1, slot2, slot3, imm = record
+    opcode, instr_type = opcode_type & 0xF, INSTRUCTION_TYPES[opcode_type >> 4]
+    rd = NO_REGISTER if slot1 == NO_SLOT else slot1
+    rs1 = NO_REGISTER if slot2 == NO_SLOT else slot2
+    rs2 = NO_REGISTER if slot3 == NO_SLOT else slot3
+    return decode_operands(opcode, instr_type, rd, rs1, rs2, imm, record)
+
+
 class DataPath:
     """
     Memory:
@@ -54,69 +199,200 @@ class DataPath:
     | INPUT            |
     | OUTPUT           |
     |__________________|
+
+    Data words live in `memory`, a buffer of signed 64-bit words: an array
+    or a memoryview from `allocate_memory`. Instructions are
+    kept in `code`, which mirrors the cells starting at `code_base`. A cell
+    that still holds an instruction can't be read as data. Writing data
+    over it drops the instruction and bumps `code_writes`, so anything
+    compiled from the code can tell that it is stale.
+
+    `output_buf` is the output device: a list that keeps all the output,
+    or a `devices.StreamOutput` that writes it out in chunks.
     """
 
-    def __init__(self, memory):
-        self.registers: dict[Register, int] = {
-            Register.R0: 0,
-            Register.R1: 0,
-            Register.R2: 0,
-            Register.R3: 0,
-            Register.R4: 0,
-            Register.R5: 0,
-            Register.R6: 0,
-            Register.R7: 0,
-            Register.PC: 0,
-            Register.SP: len(memory) - 3,
-        }
-        self.memory: list[Union[dict[str, str], int]] = memory
+    def __init__(self, memory: Union[array, memoryview]):
+        self.registers: list[int] = [0] * len(Register)
+        self.registers[SP] = len(memory) - 3
+        self.memory: Union[array, memoryview] = memory
+        self.code: list[Optional[DecodedInstruction]] = []
+        self.code_base: int = 0
+        self.code_writes: int = 0
         self.alu = Alu()
         self.input_buf: int = -1
-        self.output_buf: list[str] = []
+        self.output_buf: Union[list[str], StreamOutput] = []
         self.mem_addr_bus: int = 0
         self.input_map_addr: int = len(memory) - 2
         self.output_map_addr: int = len(memory) - 1
 
-    def io_get(self, rd: Register):
+    def io_get(self, rd: int):
         if self.input_buf == -1:
             raise OutOfBufferException()
         self.registers[rd] = self.input_buf
 
-    def io_put(self, rs: Register):
+    def io_put(self, rs: int):
         self.output_buf.append(chr(self.registers[rs]))
 
+    def flush_output(self):
+        if not isinstance(self.output_buf, list):
+            self.output_buf.flush()
+
     def latch_alu(self, op1: int, op2: int, opcode: AluOperation):
         self.alu.op1 = op1
         self.alu.op2 = op2
         self.alu.opcode = opcode
         self.alu.execute()
 
-    def latch_calc_on_register(self, rd: Register):
+    def latch_calc_on_register(self, rd: int):
         self.registers[rd] = self.alu.result
 
     def latch_calc_on_memory(self):
         self.mem_addr_bus = self.alu.result
 
-    def mem_read(self, rd: Register):
-        tmp = self.memory[self.mem_addr_bus]
-        if not isinstance(tmp, int):
+    def mem_read(self, rd: int):
+        offset = self.mem_addr_bus - self.code_base
+        if 0 <= offset < len(self.code) and self.code[offset] is not None:
             raise ValueError("Attempt to write an instruction to a register")
-        self.registers[rd] = tmp
+        self.registers[rd] = self.memory[self.mem_addr_bus]
+
+    def mem_write(self, rs: int):
+        offset = self.mem_addr_bus - self.code_base
+        if 0 <= offset < len(self.code):
+            self.code[offset] = None
+            self.code_writes += 1
+        try:
+            self.memory[self.mem_addr_bus] = self.registers[rs]
+        except (OverflowError, ValueError) as e:
+            raise WordOverflowException(
+                f"Value {self.registers[rs]} doesn't fit into a memory word") from e
+
+    def fetch_instruction(self) -> DecodedInstruction:
+        offset = self.mem_addr_bus - self.code_base
+        if 0 <= offset < len(self.code) and self.code[offset] is not None:
+            return self.code[offset]
+        raise ValueError("Attempt to execute data as an instruction")
+
+    def registers_dump(self) -> dict[Register, int]:
+        return dict(zip(Register, self.registers))
+
+
+class InterruptController:
+    """
+    Input events ordered by the tick they arrive at.
+
+    `next_due` is the tick of the earliest pending event, so checking for
+    an interrupt is a single comparison. When several events are past due
+    the latest one is delivered and the earlier ones are dropped, unless
+    they are taken one by one. Events with the same tick keep the order
+    they were pushed in.
+
+    A list or tuple schedule is queued at once and may be in any order.
+    Any other iterable is a stream: it has to be ordered by tick and is
+    read one event ahead, so a long input never has to fit in memory.
+    `len` counts the events queued so far. `consumed` counts the events
+    taken off the queue, delivered or dropped.
+    """
 
-    def mem_write(self, rs: Register):
-        self.memory[self.mem_addr_bus] = self.registers[rs]
+    def __init__(self, schedule: Iterable[Tuple[int, str]] = ()):
+        self._source: Optional[Iterator[Tuple[int, str]]] = None
+        if not isinstance(schedule, (list, tuple)):
+            self._source, schedule = iter(schedule), ()
+        self._queue: list[Tuple[int, int, str]] = [
+            (tick, seq, char) for seq, (tick, char) in enumerate(schedule)]
+        self._seq: int = len(self._queue)
+        heapq.heapify(self._queue)
+        self._lookahead: Optional[int] = None
+        self._last_tick: float = float('-inf')
+        self.consumed: int = 0
+        self._pull()
+        self.next_due: float = self._queue[0][0] if self._queue else float('inf')
+
+    def __len__(self):
+        return len(self._queue)
+
+    def _pull(self):
+        """Queue the next event of the stream, which keeps the earliest stream event in the queue."""
+        if self._source is None:
+            return
+        event = next(self._source, None)
+        if event is None:
+            self._source = None
+            return
+        tick, char = event
+        if tick < self._last_tick:
+            raise ValueError(f"Input stream is not ordered by tick: {tick} after {self._last_tick}")
+        self._last_tick = tick
+        self._lookahead = self._seq
+        heapq.heappush(self._queue, (tick, self._seq, char))
+        self._seq += 1
+
+    def push(self, tick: int, char: str):
+        heapq.heappush(self._queue, (tick, self._seq, char))
+        self._seq += 1
+        if tick < self.next_due:
+            self.next_due = tick
+
+    def pending(self) -> list[Tuple[int, str]]:
+        """All events not delivered yet. The rest of a stream is read into the queue."""
+        while self._source is not None:
+            self._pull()
+        return [(tick, char) for tick, _, char in sorted(self._queue)]
+
+    def take(self, current_tick: int) -> Optional[Tuple[int, str]]:
+        """The earliest event past due, without dropping the others."""
+        if not self._queue or self._queue[0][0] > current_tick:
+            return None
+        tick, seq, char = heapq.heappop(self._queue)
+        self.consumed += 1
+        if seq == self._lookahead:
+            self._pull()
+        self.next_due = self._queue[0][0] if self._queue else float('inf')
+        return tick, char
+
+    def poll(self, current_tick: int) -> Optional[str]:
+        char = None
+        while self._queue and self._queue[0][0] <= current_tick:
+            _, seq, char = heapq.heappop(self._queue)
+            self.consumed += 1
+            if seq == self._lookahead:
+                self._pull()
+        self.next_due = self._queue[0][0] if self._queue else float('inf')
+        return char
 
 
 class ControlUnit:
     def __init__(self, data_path, input_irq, limit):
         self.data_path = data_path
-        self.input_irq: dict[int, str] = input_irq
+        self.input_irq: InterruptController = input_irq
         self.input_irq_handler = 0
         self.limit: int = limit
+        self.tick_limit: Optional[int] = None
         self.is_interrupted: bool = False
-        self.last_instr = {}
+        self.last_instr: Optional[DecodedInstruction] = None
+        self.error: Optional[str] = None
+        self.halted: bool = False
         self.instr_counter = 0
         self._tick: int = 0
+        self._handlers = [self.execute_alu] * (len(Opcode) + 3)
+        self._handlers[LD] = self.execute_ld
+        self._handlers[ST] = self.execute_st
+        self._handlers[JMP] = self.execute_jmp
+        self._handlers[BEQ] = self.execute_beq
+        self._handlers[IRET] = self.execute_iret
+        self._handlers[HLT] = self.execute_hlt
+        self._handlers[ILLEGAL_INSTRUCTION] = self.execute_illegal
+        self._handlers[ZERO_REGISTER_WRITE] = self.execute_zero_register_write
+        self._handlers[IDLE_JMP] = self.execute_idle_jmp
+        self.fast_forward: bool = False
+        # the `dcache.DataCache` in front of memory, if any
+        self.data_cache = None
+        # the `predictor.BranchPredictor` that charges `beq` penalties, if any
+        self.branch_predictor = None
+
+    @property
+    def compilable(self) -> bool:
+        """The blocks backend compiles the multi-cycle accounting without a cache or a predictor."""
+        return self.data_cache is None and self.branch_predictor is None
 
     def tick(self):
         self._tick += 1
@@ -124,212 +400,423 @@ class ControlUnit:
     def current_tick(self):
         return self._tick
 
-    def bound(self, num: int):
-        if num > 2147483647:
-            return -2147483648 + (num - 2147483647)
-        if num < -2147483648:
-            return 2147483647 - (num + 2147483648)
-        return num
-
     def inc_program_counter(self):
-        pc_current = self.data_path.registers[Register.PC]
+        pc_current = self.data_path.registers[PC]
         self.data_path.latch_alu(pc_current, 1, AluOperation.ADD)
-        self.data_path.latch_calc_on_register(Register.PC)
+        self.data_path.latch_calc_on_register(PC)
         self.tick()
 
     def push_program_counter(self):
-        sp_current = self.data_path.registers[Register.SP]
+        sp_current = self.data_path.registers[SP]
         self.data_path.latch_alu(sp_current, 1, AluOperation.SUB)
-        self.data_path.latch_calc_on_register(Register.SP)
+        self.data_path.latch_calc_on_register(SP)
         self.tick()
-        sp_current = self.data_path.registers[Register.SP]
+        sp_current = self.data_path.registers[SP]
         self.data_path.latch_alu(sp_current, 0, AluOperation.ADD)
         self.data_path.latch_calc_on_memory()
-        self.data_path.mem_write(Register.PC)
+        if self.data_cache is not None:
+            self._tick += self.data_cache.access(self.data_path.mem_addr_bus, True)
+        self.data_path.mem_write(PC)
         self.tick()
 
     def pop_program_counter(self):
-        sp_current = self.data_path.registers[Register.SP]
+        sp_current = self.data_path.registers[SP]
         self.data_path.latch_alu(sp_current, 0, AluOperation.ADD)
         self.data_path.latch_calc_on_memory()
-        self.data_path.mem_read(Register.PC)
+        if self.data_cache is not None:
+            self._tick += self.data_cache.access(self.data_path.mem_addr_bus, False)
+        self.data_path.mem_read(PC)
         self.tick()
         self.data_path.latch_alu(sp_current, 1, AluOperation.SUB)
-        self.data_path.latch_calc_on_register(Register.SP)
+        self.data_path.latch_calc_on_register(SP)
         self.tick()
 
+    def latch_operands(self, instr: DecodedInstruction):
+        registers = self.data_path.registers
+        op1 = instr.imm if instr.rs1 is NO_REGISTER else registers[instr.rs1]
+        op2 = instr.imm if instr.rs2 is NO_REGISTER else registers[instr.rs2]
+        self.data_path.latch_alu(op1, op2, ALU_OPERATIONS[instr.opcode])
+
+    def execute_alu(self, instr: DecodedInstruction):
+        self.latch_operands(instr)
+        self.data_path.latch_calc_on_register(instr.rd)
+        self.tick()
+        self.inc_program_counter()
+
+    def execute_ld(self, instr: DecodedInstruction):
+        self.latch_operands(instr)
+        self.data_path.latch_calc_on_memory()
+        if self.data_cache is not None:
+            self._tick += self.data_cache.access(self.data_path.mem_addr_bus, False)
+        if self.data_path.mem_addr_bus == self.data_path.input_map_addr:
+            self.data_path.io_get(instr.rd)
+        else:
+            self.data_path.mem_read(instr.rd)
+        self.tick()
+        self.inc_program_counter()
+
+    def execute_st(self, instr: DecodedInstruction):
+        self.latch_operands(instr)
+        self.data_path.latch_calc_on_memory()
+        if self.data_cache is not None:
+            self._tick += self.data_cache.access(self.data_path.mem_addr_bus, True)
+        if self.data_path.mem_addr_bus == self.data_path.output_map_addr:
+            self.data_path.io_put(instr.rd)
+        else:
+            self.data_path.mem_write(instr.rd)
+        self.tick()
+        self.inc_program_counter()
+
+    def execute_jmp(self, instr: DecodedInstruction):
+        self.latch_operands(instr)
+        self.data_path.latch_calc_on_register(PC)
+        self.tick()
+
+    def execute_idle_jmp(self, instr: DecodedInstruction):
+        self.execute_jmp(instr)
+        if self.fast_forward:
+            raise IdleLoop()
+
+    def skip_idle_iterations(self, max_iterations: int) -> int:
+        """
+        Account for the iterations of a self-loop that end without an
+        interrupt, as if they had been stepped. Each iteration is a fetch
+        tick and a jump tick. An interrupt is taken on the first fetch at
+        or after its due tick, and never while the handler is running.
+        Returns the number of skipped iterations.
+        """
+        if self.is_interrupted or self.input_irq.next_due == float('inf'):
+            skipped = max_iterations
+        else:
+            due = int(self.input_irq.next_due)
+            skipped = min(max(0, (due - self._tick) // 2), max_iterations)
+        self._tick += 2 * skipped
+        self.instr_counter += skipped
+        return skipped
+
+    def execute_beq(self, instr: DecodedInstruction):
+        self.latch_operands(instr)
+        pc = self.data_path.registers[PC]
+        taken = self.data_path.alu.ZF
+        if taken:
+            self.tick()
+            self.data_path.latch_alu(pc, instr.imm, AluOperation.ADD)
+            self.data_path.latch_calc_on_register(PC)
+            self.tick()
+        else:
+            self.inc_program_counter()
+        if self.branch_predictor is not None:
+            self._tick += self.branch_predictor.update(pc, taken, self.data_path.registers[PC])
+
+    def execute_iret(self, instr: DecodedInstruction):
+        self.is_interrupted = False
+        self.pop_program_counter()
+
+    def execute_hlt(self, instr: DecodedInstruction):
+        self.halted = True
+        raise StopIteration()
+
+    def execute_illegal(self, instr: DecodedInstruction):
+        raise ValueError(f"Malformed instruction: {instr.source}")
+
+    def execute_zero_register_write(self, instr: DecodedInstruction):
+        raise ZeroRegisterModificationException(
+            "It's not allowed to modify R0")
+
     def decode_and_execute_instruction(self):
-        op1 = self.data_path.registers[Register.PC]
-        op2 = 0
-        alu_op = AluOperation.ADD
-        self.data_path.latch_alu(op1, op2, alu_op)
+        op1 = self.data_path.registers[PC]
+        self.data_path.latch_alu(op1, 0, AluOperation.ADD)
         self.data_path.latch_calc_on_memory()
         self.tick()
-        instr = self.data_path.memory[self.data_path.mem_addr_bus]
+        instr = self.data_path.fetch_instruction()
 
         self.last_instr = instr
         self.instr_counter += 1
 
-        past_irq = list(filter(lambda x: x <= self.current_tick(), self.input_irq.keys()))
-
-        if not self.is_interrupted and len(past_irq) > 0:
-            current_char = self.input_irq[max(past_irq)]
-            self.input_irq = {k: v for k, v in self.input_irq.items() if k > self.current_tick()}
+        if not self.is_interrupted and self.input_irq.next_due <= self._tick:
+            current_char = self.input_irq.poll(self._tick)
             self.is_interrupted = True
             self.push_program_counter()
-            self.data_path.registers[Register.PC] = self.data_path.memory[0]
+            self.data_path.registers[PC] = self.data_path.memory[0]
             self.data_path.input_buf = ord(current_char)
             self.tick()
             return
 
-        if instr['opcode'] == Opcode.HLT:
-            raise StopIteration()
-
-        if instr['opcode'] == Opcode.IRET:
-            self.is_interrupted = False
-            self.pop_program_counter()
-            return
-
-        if ('rd' in instr) and (instr['rd'] == 'r0'):
-            raise ZeroRegisterModificationException(
-                "It's not allowed to modify R0")
-
-        if instr["type"] == InstructionType.A or instr["type"] == InstructionType.E:
-            op1 = self.data_path.registers[Register(instr['rs1'])]
-            op2 = self.data_path.registers[Register(instr['rs2'])]
-        elif instr["type"] == InstructionType.B:
-            op1 = self.data_path.registers[Register(instr['rs'])]
-            op2 = self.bound(int(instr['imm']))
-        elif instr["type"] == InstructionType.C:
-            op1 = self.data_path.registers[Register(instr['rs'])]
-            op2 = 0
-        elif instr["type"] == InstructionType.D:
-            op1 = self.bound(int(instr['imm']))
-            op2 = self.data_path.registers[Register.PC]
-
-        if instr['opcode'] in [
-                Opcode.ADD,
-                Opcode.SUB,
-                Opcode.MUL,
-                Opcode.DIV,
-                Opcode.REM]:
-            alu_op = AluOperation(instr['opcode'].value)
-        elif instr['opcode'] == Opcode.ADDI:
-            alu_op = AluOperation.ADD
-        elif instr['opcode'] == Opcode.SUBI:
-            alu_op = AluOperation.SUB
-        elif instr['opcode'] == Opcode.LD:
-            alu_op = AluOperation.ADD
-        elif instr['opcode'] == Opcode.ST:
-            alu_op = AluOperation.ADD
-        elif instr['opcode'] == Opcode.JMP:
-            alu_op = AluOperation.ADD
-        elif instr['opcode'] == Opcode.BEQ:
-            alu_op = AluOperation.SUB
-
-        self.data_path.latch_alu(op1, op2, alu_op)
-        if instr['opcode'] not in [
-                Opcode.JMP,
-                Opcode.BEQ,
-                Opcode.ST,
-                Opcode.LD]:
-            self.data_path.latch_calc_on_register(Register(instr['rd']))
-            self.tick()
-            self.inc_program_counter()
-        if instr['opcode'] == Opcode.LD:
-            self.data_path.latch_calc_on_memory()
-            if self.data_path.mem_addr_bus == self.data_path.input_map_addr:
-                self.data_path.io_get(Register(instr['rd']))
-            else:
-                self.data_path.mem_read(Register(instr['rd']))
-            self.tick()
-            self.inc_program_counter()
-        if instr['opcode'] == Opcode.ST:
-            self.data_path.latch_calc_on_memory()
-            if self.data_path.mem_addr_bus == self.data_path.output_map_addr:
-                self.data_path.io_put(Register(instr['rd']))
-            else:
-                self.data_path.mem_write(Register(instr['rd']))
-            self.tick()
-            self.inc_program_counter()
-        if instr['opcode'] == Opcode.JMP:
-            self.data_path.latch_calc_on_register(Register.PC)
-            self.tick()
-        if instr['opcode'] == Opcode.BEQ:
-            if self.data_path.alu.ZF:
-                self.tick()
-                op1 = self.data_path.registers[Register.PC]
-                op2 = self.bound(int(instr['imm']))
-                alu_op = AluOperation.ADD
-                self.data_path.latch_alu(op1, op2, alu_op)
-                self.data_path.latch_calc_on_register(Register.PC)
-                self.tick()
-            else:
-                self.inc_program_counter()
+        self._handlers[instr.handler](instr)
 
     def __repr__(self):
+        last_instr = self.last_instr.source if self.last_instr is not None else {}
+        if isinstance(last_instr, tuple):
+            last_instr = record_to_dict(last_instr)
         return f'is_interrupted: {self.is_interrupted} | ' \
-               f'PC: {self.data_path.registers[Register.PC]} | ' \
+               f'PC: {self.data_path.registers[PC]} | ' \
                f'instr_counter: {self.instr_counter} | ' \
                f'tick: {self.current_tick()} | ' \
-               f'last_instr: {self.last_instr}'
+               f'last_instr: {last_instr}'
 
 
 def initialize_vectors(memory, handler_addr):
     memory[0] = handler_addr
 
 
-def load_program(memory, code, start):
-    for i in range(len(code)):
-        memory[start + i] = code[i]
+def decode_program(code) -> tuple[DecodedInstruction, ...]:
+    """Decode code once for many machines. `load_program` takes the result as it is."""
+    if isinstance(code, tuple):
+        return code
+    if isinstance(code, BinaryCode):
+        return tuple(decode_record(record) for record in code)
+    return tuple(decode_instruction(instr) for instr in code)
 
 
-def simulation(program, input_schedule, data_memory_size: int,
-               limit: int) -> Tuple[str, int, int]:
-    assert data_memory_size >= 100, "Memory size have to be >= 100"
+def load_program(data_path, code, start):
+    if start + len(code) > len(data_path.memory):
+        raise IndexError("Program doesn't fit into memory")
+    data_path.code = list(decode_program(code))
+    data_path.code_base = start
 
-    memory = [0] * data_memory_size
-    program_addr = 20
 
-    initialize_vectors(memory, program_addr)
-    load_program(memory, program["code"], program_addr)
+class Stepper:
+    """
+    Steps the control unit, recording every instruction when a tracer is
+    given. `instr_counter` is the count the run has reached, also when a
+    step raises.
+    """
 
-    data_path = DataPath(memory)
-    data_path.registers[Register.PC] = program_addr + int(program["start"])
-    input_irq = dict(input_schedule)
-    control_unit = ControlUnit(data_path, input_irq, limit)
-    instr_counter = 0
+    def __init__(self, control_unit: ControlUnit, tracer=None):
+        self.control_unit = control_unit
+        self.tracer = tracer
+        self.instr_counter: int = control_unit.instr_counter
+
+    def run(self, end: int) -> int:
+        control_unit = self.control_unit
+        step = control_unit.decode_and_execute_instruction
+        tracer = self.tracer
+        n = self.instr_counter
+        try:
+            if tracer is None:
+                while n < end:
+                    try:
+                        while n < end:
+                            step()
+                            n += 1
+                    except IdleLoop:
+                        n += 1
+                        n += control_unit.skip_idle_iterations(end - n)
+            else:
+                registers = control_unit.data_path.registers
+                while n < end:
+                    pc = registers[PC]
+                    step()
+                    n += 1
+                    tracer.record(pc, control_unit)
+        finally:
+            self.instr_counter = n
+        return n
+
+
+def run(control_unit, limit: int, tracer=None, stop_at: Optional[int] = None,
+        fast_forward: bool = True, backend: str = "step") -> int:
+    """
+    Step the control unit until `hlt`, an error or the instruction limit.
+
+    With `stop_at` the run pauses once that many instructions have been
+    executed and can be continued by another call. Counting continues from
+    `control_unit.instr_counter`, so a restored machine resumes where it
+    stopped. The loop without a tracer does nothing but step, so disabled
+    tracing costs nothing per instruction. It also skips idle self-loops
+    straight to the next interrupt, unless `fast_forward` is off. Traced
+    runs always step every instruction.
+
+    `backend` "blocks" runs untraced code as compiled basic blocks, see
+    the `blocks` module. The counters and the output are the same. Control
+    units with other tick accounting are always stepped.
 
+    With `control_unit.tick_limit` set the run is an error once the tick
+    counter passes it. The loop runs in chunks that can't reach the limit,
+    so the check costs nothing per instruction.
+
+    A streaming output device is flushed whenever the run stops or pauses.
+    """
+    if tracer is None and backend == "blocks" and control_unit.compilable:
+        # imported here, the blocks module is built on top of this one
+        from blocks import BlockRunner
+        runner = BlockRunner(control_unit)
+    else:
+        runner = Stepper(control_unit, tracer)
+    end = limit + 1 if stop_at is None else min(stop_at, limit + 1)
+    tick_limit = control_unit.tick_limit
+    control_unit.fast_forward = fast_forward and tracer is None
     try:
-        while True:
-            assert instr_counter <= limit, "too long execution, increase limit!"
-            control_unit.decode_and_execute_instruction()
-            instr_counter += 1
-            logging.debug(repr(control_unit))
+        if tick_limit is None:
+            runner.run(end)
+        else:
+            while runner.instr_counter < end:
+                chunk = (tick_limit - control_unit.current_tick()) // MAX_INSTRUCTION_TICKS
+                runner.run(min(end, runner.instr_counter + max(1, chunk)))
+                assert control_unit.current_tick() <= tick_limit, "too long execution, increase tick limit!"
+        instr_counter = runner.instr_counter
+        assert instr_counter <= limit, "too long execution, increase limit!"
+        return instr_counter
     except StopIteration:
-        instr_counter += 1
-        pass
+        instr_counter = runner.instr_counter + 1
     except Exception as e:
-        logging.error("Error message:", e)
-        logging.error(data_path.memory)
+        instr_counter = runner.instr_counter
+        control_unit.error = str(e)
+        logging.error("Error message: %s", e)
+        logging.error('%s', control_unit.data_path.registers_dump())
+    finally:
+        control_unit.data_path.flush_output()
+
+    if tracer is not None:
+        tracer.finish(control_unit)
+    return instr_counter
+
+
+class MachineConfig(NamedTuple):
+    """
+    Memory map and limits of a machine.
+
+    The stack top and the MMIO addresses default to the last three words
+    of memory. `tick_limit` bounds the run by ticks in addition to
+    `limit` instructions.
+    """
+    memory_size: int = 100
+    program_addr: int = 20
+    stack_top: Optional[int] = None
+    input_addr: Optional[int] = None
+    output_addr: Optional[int] = None
+    limit: int = 10000
+    tick_limit: Optional[int] = None
+
+
+def allocate_memory(size: int) -> memoryview:
+    """
+    Zeroed memory of `size` signed 64-bit words. It is an anonymous
+    mapping, so the OS backs a page only once it is written, and a large
+    address space costs nothing until it is used.
+    """
+    return memoryview(mmap.mmap(-1, 8 * size)).cast('q')
+
+
+def build_machine(program, input_schedule, data_memory_size: int = 100, limit: int = 10000,
+                  config: Optional[MachineConfig] = None, output: Optional[StreamOutput] = None) -> ControlUnit:
+    """
+    `config` gives the whole memory map; without it only the memory size
+    and the limit are set. `input_schedule` may be a stream, see
+    `InterruptController`, and `output` replaces the in-memory output.
+    """
+    if config is None:
+        config = MachineConfig(memory_size=data_memory_size, limit=limit)
+    size = config.memory_size
+    for name in ("program_addr", "stack_top", "input_addr", "output_addr"):
+        addr = getattr(config, name)
+        assert addr is None or 0 < addr < size, f"{name} {addr} is outside of memory of {size} words"
+
+    memory = allocate_memory(size)
+    program_addr = config.program_addr
+
+    initialize_vectors(memory, program_addr)
+
+    data_path = DataPath(memory)
+    if config.stack_top is not None:
+        data_path.registers[SP] = config.stack_top
+    if config.input_addr is not None:
+        data_path.input_map_addr = config.input_addr
+    if config.output_addr is not None:
+        data_path.output_map_addr = config.output_addr
+    if output is not None:
+        data_path.output_buf = output
+    load_program(data_path, program["code"], program_addr)
+    data_path.registers[PC] = program_addr + int(program["start"])
+    input_irq = InterruptController(input_schedule)
+    control_unit = ControlUnit(data_path, input_irq, config.limit)
+    control_unit.tick_limit = config.tick_limit
+    return control_unit
+
+
+def simulation(program, input_schedule, data_memory_size: int = 100, limit: int = 10000,
+               tracer="auto", backend: str = "step", config: Optional[MachineConfig] = None,
+               output: Optional[StreamOutput] = None) -> Tuple[str, int, int]:
+    """
+    `tracer` is a tracer from the `tracing` module or None. The default
+    writes the text log when DEBUG logging is enabled. `backend` is one
+    of BACKENDS, see `run`. `config` replaces `data_memory_size` and
+    `limit`, see `build_machine`. With a streaming `output` the returned
+    output is empty, the text has been written to its sink.
+    """
+    control_unit = build_machine(program, input_schedule, data_memory_size, limit, config, output)
+    data_path = control_unit.data_path
+
+    if tracer == "auto":
+        tracer = TextTracer() if logging.getLogger().isEnabledFor(logging.DEBUG) else None
+    instr_counter = run(control_unit, control_unit.limit, tracer, backend=backend)
 
-    logging.debug(data_path.registers)
     return ''.join(
         data_path.output_buf), instr_counter, control_unit.current_tick()
 
 
-def main(args):
-    assert len(args) == 2, "2 arguments required <program_file> <input_file>"
-    program_file, input_file = args
+def add_config_args(parser: argparse.ArgumentParser):
+    defaults = MachineConfig()
+    parser.add_argument("--memory-size", type=int, default=defaults.memory_size, help="in words")
+    parser.add_argument("--program-addr", type=int, default=defaults.program_addr)
+    parser.add_argument("--stack-top", type=int, help="memory size - 3 by default")
+    parser.add_argument("--input-addr", type=int, help="memory size - 2 by default")
+    parser.add_argument("--output-addr", type=int, help="memory size - 1 by default")
+    parser.add_argument("--limit", type=int, default=defaults.limit, help="instruction limit")
+    parser.add_argument("--tick-limit", type=int)
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(prog="machine.py")
+    parser.add_argument("program_file", help="translated program, or an .asm source translated through the cache")
+    parser.add_argument("input_file")
+    parser.add_argument("--cache-dir", help="translation cache, $TRANSLATION_CACHE_DIR or ~/.cache by default")
+    parser.add_argument("--no-cache", action="store_true", help="translate an .asm source without the cache")
+    parser.add_argument("--trace", choices=["auto"] + TRACE_MODES, default="auto",
+                        help="per-instruction trace; auto logs text when DEBUG is enabled")
+    parser.add_argument("--trace-file", help="output file for the jsonl trace")
+    parser.add_argument("--backend", choices=BACKENDS, default="step",
+                        help="blocks runs untraced code as compiled basic blocks")
+    add_config_args(parser)
+    parser.add_argument("--output-file", help="stream the output to a file, - for stdout")
+    return parser.parse_args(args)
 
-    program = read_program(program_file)
-    with open(input_file, encoding='utf-8') as file:
-        input_schedule = ast.literal_eval(file.read())
 
-    output, instr_counter, ticks = simulation(
-        program, input_schedule=input_schedule, data_memory_size=100, limit=10000)
+def config_from_args(options) -> MachineConfig:
+    return MachineConfig(options.memory_size, options.program_addr, options.stack_top,
+                         options.input_addr, options.output_addr, options.limit, options.tick_limit)
 
-    print(f'output: {output}\ninstr: {instr_counter}  ticks: {ticks}')
+
+def main(args):
+    options = parse_args(args)
+    config = config_from_args(options)
+
+    cache = None if options.no_cache or not options.program_file.endswith(".asm") \
+        else TranslationCache(options.cache_dir)
+    program = load_program_file(options.program_file, cache)
+    with contextlib.ExitStack() as stack:
+        input_file = stack.enter_context(open(options.input_file, encoding='utf-8'))
+
+        if options.trace == "jsonl":
+            assert options.trace_file, "--trace jsonl requires --trace-file"
+            tracer = make_tracer("jsonl", stack.enter_context(open(options.trace_file, "w", encoding="utf-8")))
+        else:
+            tracer = "auto" if options.trace == "auto" else make_tracer(options.trace)
+
+        output = None
+        if options.output_file == "-":
+            output = StreamOutput(sys.stdout)
+        elif options.output_file:
+            output = StreamOutput(stack.enter_context(open(options.output_file, "w", encoding="utf-8")))
+
+        text, instr_counter, ticks = simulation(
+            program, input_schedule=read_events(input_file), tracer=tracer,
+            backend=options.backend, config=config, output=output)
+
+    if output is None:
+        print(f'output: {text}\ninstr: {instr_counter}  ticks: {ticks}')
+    else:
+        print(f'instr: {instr_counter}  ticks: {ticks}', file=sys.stderr if options.output_file == "-" else sys.stdout)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,197 @@
+"""
+Pipelined timing model: an alternative ControlUnit for sizing hardware.
+
+`PipelinedControlUnit` executes every instruction with the handlers and
+the DataPath of `ControlUnit`, so a program computes the same. Only the
+tick accounting is different. The ticks are the cycles of a classic
+5-stage in-order pipeline (fetch, decode, execute, memory, writeback)
+with full forwarding:
+
+    every instruction issues in one cycle
+    load-use    -- an instruction that needs the register loaded by the
+                   instruction before it waits `load_use` cycles
+    branch      -- a taken `beq` is resolved in execute and flushes
+                   `branch_penalty` younger instructions
+    jump        -- `jmp` is resolved in decode, `jump_penalty` cycles
+    return      -- `iret` gets PC from memory, `return_penalty` cycles
+    pc write    -- an ALU result or a load into PC, as a taken branch
+    interrupt   -- the fetched instruction is dropped and the pipeline
+                   flushed, `interrupt_penalty` cycles
+    drain       -- `hlt` retires after the pipeline empties
+
+Interrupts are checked against the pipeline clock, so input events land
+at other points of a program than with the multi-cycle unit.
+
+    pipeline.py <program> <input_file> [--branch-penalty N] ...
+"""
+
+import argparse
+import sys
+from typing import NamedTuple
+
+import machine
+from devices import read_events
+from machine import BEQ, HLT, IDLE_JMP, IRET, JMP, LD, NO_REGISTER, PC, AluOperation, ControlUnit
+
+STALL_KINDS = ("load_use", "branch", "jump", "return", "pc_write", "interrupt", "drain")
+
+
+class PipelineTiming(NamedTuple):
+    """Cycles lost to each hazard, and the depth the pipeline drains at `hlt`."""
+    load_use: int = 1
+    branch_penalty: int = 2
+    jump_penalty: int = 1
+    return_penalty: int = 3
+    interrupt_penalty: int = 3
+    depth: int = 5
+
+
+class PipelinedControlUnit(ControlUnit):
+    """
+    `stalls` counts the cycles lost per kind, see STALL_KINDS. The
+    multi-cycle `tick` calls of the handlers are ignored. The latency of a
+    data cache, see `dcache`, is reported as "memory" stalls. A branch
+    predictor, see `predictor`, replaces the fixed taken `beq` penalty
+    with its own penalties.
+    """
+
+    # the blocks backend compiles the multi-cycle tick accounting
+    compilable = False
+
+    def __init__(self, data_path, input_irq, limit, timing: PipelineTiming = PipelineTiming()):
+        super().__init__(data_path, input_irq, limit)
+        self.timing = timing
+        self.stalls: dict[str, int] = dict.fromkeys(STALL_KINDS, 0)
+        self.branches: int = 0
+        self.taken: int = 0
+        self._loaded: object = NO_REGISTER
+
+    def tick(self):
+        pass
+
+    def _stall(self, kind: str, cycles: int):
+        self.stalls[kind] += cycles
+        self._tick += cycles
+
+    def decode_and_execute_instruction(self):
+        data_path = self.data_path
+        registers = data_path.registers
+        pc = registers[PC]
+        data_path.latch_alu(pc, 0, AluOperation.ADD)
+        data_path.latch_calc_on_memory()
+        self._tick += 1
+        instr = data_path.fetch_instruction()
+
+        self.last_instr = instr
+        self.instr_counter += 1
+
+        if not self.is_interrupted and self.input_irq.next_due <= self._tick:
+            current_char = self.input_irq.poll(self._tick)
+            self.is_interrupted = True
+            self.push_program_counter()
+            registers[PC] = data_path.memory[0]
+            data_path.input_buf = ord(current_char)
+            self._loaded = NO_REGISTER
+            self._stall("interrupt", self.timing.interrupt_penalty)
+            return
+
+        loaded, self._loaded = self._loaded, NO_REGISTER
+        if loaded is not NO_REGISTER and loaded in (instr.rs1, instr.rs2):
+            self._stall("load_use", self.timing.load_use)
+
+        handler = instr.handler
+        if handler == BEQ:
+            self.branches += 1
+            before = self._tick
+            self._handlers[handler](instr)
+            if registers[PC] != pc + 1:
+                self.taken += 1
+                if self.branch_predictor is None:
+                    self._tick += self.timing.branch_penalty
+            self.stalls["branch"] += self._tick - before
+        elif handler == JMP or handler == IDLE_JMP:
+            self._stall("jump", self.timing.jump_penalty)
+            self._handlers[handler](instr)
+        elif handler == IRET:
+            self._stall("return", self.timing.return_penalty)
+            self._handlers[handler](instr)
+        elif handler == HLT:
+            self._stall("drain", self.timing.depth - 1)
+            self._handlers[handler](instr)
+        else:
+            self._handlers[handler](instr)
+            if registers[PC] != pc + 1:
+                self._stall("pc_write", self.timing.branch_penalty)
+            elif handler == LD:
+                self._loaded = instr.rd
+
+    def skip_idle_iterations(self, max_iterations: int) -> int:
+        """As in ControlUnit, for a self-loop of one issue cycle and the jump penalty."""
+        period = 1 + self.timing.jump_penalty
+        if self.is_interrupted or self.input_irq.next_due == float('inf'):
+            skipped = max_iterations
+        else:
+            due = int(self.input_irq.next_due)
+            skipped = min(max(0, (due - self._tick + period - 2) // period), max_iterations)
+        self._tick += period * skipped
+        self.stalls["jump"] += self.timing.jump_penalty * skipped
+        self.instr_counter += skipped
+        return skipped
+
+    def report(self) -> dict:
+        instr, ticks = self.instr_counter, self.current_tick()
+        stalls = dict(self.stalls)
+        if self.data_cache is not None:
+            stalls["memory"] = self.data_cache.cycles
+        return {
+            "instr": instr,
+            "ticks": ticks,
+            "cpi": ticks / instr if instr else 0.0,
+            "ipc": instr / ticks if ticks else 0.0,
+            "stalls": stalls,
+            "branches": self.branches,
+            "taken": self.taken,
+        }
+
+
+def build_machine(program, input_schedule, config: machine.MachineConfig = machine.MachineConfig(),
+                  timing: PipelineTiming = PipelineTiming()) -> PipelinedControlUnit:
+    multi_cycle = machine.build_machine(program, input_schedule, config=config)
+    control_unit = PipelinedControlUnit(multi_cycle.data_path, multi_cycle.input_irq, config.limit, timing)
+    control_unit.tick_limit = config.tick_limit
+    return control_unit
+
+
+def simulation(program, input_schedule, config: machine.MachineConfig = machine.MachineConfig(),
+               timing: PipelineTiming = PipelineTiming()):
+    """Like `machine.simulation`, also returns the report of the pipeline."""
+    control_unit = build_machine(program, input_schedule, config, timing)
+    instr = machine.run(control_unit, config.limit)
+    report = control_unit.report()
+    report["instr"] = instr
+    return ''.join(control_unit.data_path.output_buf), instr, control_unit.current_tick(), report
+
+
+def main(args):
+    parser = argparse.ArgumentParser(prog="pipeline.py")
+    parser.add_argument("program_file")
+    parser.add_argument("input_file")
+    defaults = PipelineTiming()
+    for name in PipelineTiming._fields:
+        parser.add_argument("--" + name.replace("_", "-"), type=int, default=getattr(defaults, name))
+    machine.add_config_args(parser)
+    options = parser.parse_args(args)
+
+    timing = PipelineTiming(*(getattr(options, name) for name in PipelineTiming._fields))
+    program = machine.load_program_file(options.program_file)
+    with open(options.input_file, encoding="utf-8") as file:
+        output, instr, ticks, report = simulation(program, read_events(file), machine.config_from_args(options),
+                                                  timing)
+    print(f"output: {output}")
+    print(f"instr: {instr}  ticks: {ticks}  CPI: {report['cpi']:.3f}  IPC: {report['ipc']:.3f}")
+    print("stalls: " + "  ".join(f"{kind}: {cycles}" for kind, cycles in report["stalls"].items()))
+    print(f"branches: {report['branches']}  taken: {report['taken']}")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,227 @@
+"""
+Branch predictor models for `beq`.
+
+A `BranchPredictor` is an optional layer of `ControlUnit`: after every
+`beq` the control unit asks it for the penalty of the branch and adds it
+to the ticks. The direction is predicted by one of
+
+    not-taken   -- static, every branch falls through
+    bimodal     -- 2-bit saturating counters indexed by the branch PC
+    gshare      -- 2-bit counters indexed by the PC xor the global history
+                   of the last `history` branches
+
+and a branch target buffer, when it has entries, remembers the targets of
+taken branches. A mispredicted branch costs `mispredict_penalty`. A taken
+branch predicted as taken still costs `taken_penalty` unless the BTB
+has its target. The multi-cycle cost of `beq` is unchanged, the penalties
+come on top; in the pipelined model they replace the fixed taken penalty.
+
+The tables are bytearrays and arrays allocated once, and so are the
+per-PC counters of the report, one slot per cell of the loaded code.
+
+    predictor.py <program> <input_file> [--kind gshare] [--btb N] ...
+"""
+
+import argparse
+import sys
+from array import array
+from typing import NamedTuple, Optional
+
+import machine
+import pipeline
+from devices import read_events
+
+KINDS = ("not-taken", "bimodal", "gshare")
+
+
+class PredictorConfig(NamedTuple):
+    """Table sizes are entries, powers of two. `btb_entries` 0 means no BTB."""
+    kind: str = "bimodal"
+    entries: int = 1024
+    history: int = 8
+    btb_entries: int = 0
+    mispredict_penalty: int = 2
+    taken_penalty: int = 1
+
+
+class NotTaken:
+    def predict(self, pc: int) -> bool:
+        return False
+
+    def train(self, pc: int, taken: bool):
+        pass
+
+
+class Bimodal:
+    """Counters start weakly not taken."""
+
+    def __init__(self, entries: int):
+        assert entries > 0 and entries & (entries - 1) == 0, "Table size must be a power of two"
+        self.counters = bytearray([1]) * entries
+        self.mask = entries - 1
+
+    def index(self, pc: int) -> int:
+        return pc & self.mask
+
+    def predict(self, pc: int) -> bool:
+        return self.counters[self.index(pc)] >= 2
+
+    def train(self, pc: int, taken: bool):
+        index = self.index(pc)
+        counter = self.counters[index]
+        if taken:
+            if counter < 3:
+                self.counters[index] = counter + 1
+        elif counter > 0:
+            self.counters[index] = counter - 1
+
+
+class Gshare(Bimodal):
+    def __init__(self, entries: int, history: int):
+        super().__init__(entries)
+        self.history = 0
+        self.history_mask = (1 << history) - 1
+
+    def index(self, pc: int) -> int:
+        return (pc ^ self.history) & self.mask
+
+    def train(self, pc: int, taken: bool):
+        super().train(pc, taken)
+        self.history = ((self.history << 1) | taken) & self.history_mask
+
+
+class BranchTargetBuffer:
+    """Direct-mapped, tagged with the whole branch PC."""
+
+    def __init__(self, entries: int):
+        assert entries > 0 and entries & (entries - 1) == 0, "BTB size must be a power of two"
+        self.tags = array('q', [-1]) * entries
+        self.targets = array('q', [0]) * entries
+        self.mask = entries - 1
+
+    def lookup(self, pc: int) -> Optional[int]:
+        index = pc & self.mask
+        return self.targets[index] if self.tags[index] == pc else None
+
+    def insert(self, pc: int, target: int):
+        index = pc & self.mask
+        self.tags[index] = pc
+        self.targets[index] = target
+
+
+def make_direction(config: PredictorConfig):
+    assert config.kind in KINDS, f"Unknown predictor {config.kind}"
+    if config.kind == "not-taken":
+        return NotTaken()
+    if config.kind == "bimodal":
+        return Bimodal(config.entries)
+    return Gshare(config.entries, config.history)
+
+
+class BranchPredictor:
+    def __init__(self, config: PredictorConfig, data_path: machine.DataPath):
+        self.config = config
+        self.direction = make_direction(config)
+        self.btb = BranchTargetBuffer(config.btb_entries) if config.btb_entries else None
+        self.code_base = data_path.code_base
+        size = len(data_path.code)
+        self.executed = array('q', [0]) * size
+        self.taken = array('q', [0]) * size
+        self.mispredicted = array('q', [0]) * size
+        self.btb_hits: int = 0
+        self.cycles: int = 0
+
+    def update(self, pc: int, taken: bool, target: int) -> int:
+        """Predict and train on a resolved branch, return its penalty in ticks."""
+        predicted = self.direction.predict(pc)
+        self.direction.train(pc, taken)
+        offset = pc - self.code_base
+        self.executed[offset] += 1
+        penalty = 0
+        if taken:
+            self.taken[offset] += 1
+        if predicted != taken:
+            self.mispredicted[offset] += 1
+            penalty = self.config.mispredict_penalty
+        elif taken:
+            if self.btb is not None and self.btb.lookup(pc) == target:
+                self.btb_hits += 1
+            else:
+                penalty = self.config.taken_penalty
+        if taken and self.btb is not None:
+            self.btb.insert(pc, target)
+        self.cycles += penalty
+        return penalty
+
+    def report(self) -> dict:
+        branches = []
+        for offset, executed in enumerate(self.executed):
+            if executed:
+                mispredicted = self.mispredicted[offset]
+                branches.append({"pc": self.code_base + offset, "executed": executed, "taken": self.taken[offset],
+                                 "mispredicted": mispredicted, "accuracy": 1 - mispredicted / executed})
+        executed, mispredicted = sum(self.executed), sum(self.mispredicted)
+        return {
+            "branches": executed,
+            "mispredicted": mispredicted,
+            "accuracy": 1 - mispredicted / executed if executed else 0.0,
+            "btb_hits": self.btb_hits,
+            "cycles": self.cycles,
+            "per_pc": branches,
+        }
+
+
+def attach(control_unit: machine.ControlUnit, config: PredictorConfig = PredictorConfig()) -> BranchPredictor:
+    """Put a predictor into a built machine."""
+    control_unit.branch_predictor = BranchPredictor(config, control_unit.data_path)
+    return control_unit.branch_predictor
+
+
+def simulation(program, input_schedule, config: machine.MachineConfig = machine.MachineConfig(),
+               predictor_config: PredictorConfig = PredictorConfig(), timing=None):
+    """
+    Like `machine.simulation`, also returns the report of the predictor.
+    With `timing` the machine is a `pipeline.PipelinedControlUnit`.
+    """
+    if timing is None:
+        control_unit = machine.build_machine(program, input_schedule, config=config)
+    else:
+        control_unit = pipeline.build_machine(program, input_schedule, config, timing)
+    branch_predictor = attach(control_unit, predictor_config)
+    instr = machine.run(control_unit, config.limit)
+    return ''.join(control_unit.data_path.output_buf), instr, control_unit.current_tick(), branch_predictor.report()
+
+
+def main(args):
+    parser = argparse.ArgumentParser(prog="predictor.py")
+    parser.add_argument("program_file")
+    parser.add_argument("input_file")
+    defaults = PredictorConfig()
+    parser.add_argument("--kind", choices=KINDS, default=defaults.kind)
+    parser.add_argument("--entries", type=int, default=defaults.entries)
+    parser.add_argument("--history", type=int, default=defaults.history, help="gshare history length in branches")
+    parser.add_argument("--btb", type=int, default=defaults.btb_entries, help="BTB entries, none by default")
+    parser.add_argument("--mispredict-penalty", type=int, default=defaults.mispredict_penalty)
+    parser.add_argument("--taken-penalty", type=int, default=defaults.taken_penalty)
+    parser.add_argument("--pipeline", action="store_true", help="count ticks with the pipelined timing model")
+    machine.add_config_args(parser)
+    options = parser.parse_args(args)
+
+    predictor_config = PredictorConfig(options.kind, options.entries, options.history, options.btb,
+                                       options.mispredict_penalty, options.taken_penalty)
+    timing = pipeline.PipelineTiming() if options.pipeline else None
+    program = machine.load_program_file(options.program_file)
+    with open(options.input_file, encoding="utf-8") as file:
+        output, instr, ticks, report = simulation(program, read_events(file), machine.config_from_args(options),
+                                                  predictor_config, timing)
+    print(f"output: {output}")
+    print(f"instr: {instr}  ticks: {ticks}  branch stalls: {report['cycles']}")
+    print(f"branches: {report['branches']}  mispredicted: {report['mispredicted']}  "
+          f"accuracy: {report['accuracy']:.1%}  BTB hits: {report['btb_hits']}")
+    for branch in report["per_pc"]:
+        print(f"  {branch['pc']:5}: executed: {branch['executed']}  taken: {branch['taken']}  "
+              f"accuracy: {branch['accuracy']:.1%}")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,168 @@
+"""
+Profiler: where a simulated program spends its instructions and ticks.
+
+`Profiler` is a tracer (see `tracing`) for `machine.run`. Per code
+address it counts executions and the ticks spent in the main program and
+in the interrupt handler. The counters are arrays allocated once for the
+loaded code, so a step costs a few array updates. The ticks of entering
+an interrupt, where the fetched instruction is dropped, are counted
+separately. Addresses are mapped back to labels with the positions from
+`translator.translate_with_labels`.
+
+The report is plain text. The folded stacks are one line per address,
+
+    main;inc;inc+1 2997
+
+which `flamegraph.pl` and speedscope read directly.
+
+    profiler.py <source.asm> <input_file> [--report FILE] [--folded FILE]
+"""
+
+import argparse
+import bisect
+import contextlib
+import sys
+from array import array
+from typing import IO, Optional
+
+import machine
+import translator
+from devices import read_events
+from isa import prepare_program
+from tracing import OPCODE_NAMES
+
+
+class Profiler:
+    """`labels` maps label names to positions in the code, as the translator gives them."""
+
+    def __init__(self, control_unit, labels: Optional[dict[str, int]] = None):
+        data_path = control_unit.data_path
+        self.code = data_path.code
+        self.code_base: int = data_path.code_base
+        size = len(self.code)
+        self.counts = array('q', bytes(8 * size))
+        self.main_ticks = array('q', bytes(8 * size))
+        self.handler_ticks = array('q', bytes(8 * size))
+        self.interrupts: int = 0
+        self.entry_ticks: int = 0
+        self._tick: int = control_unit.current_tick()
+        self._interrupted: bool = control_unit.is_interrupted
+
+        # the last label at a position names the code that follows it
+        by_position = {position: label for label, position in (labels or {}).items()}
+        self._label_positions = sorted(by_position)
+        self._label_names = [by_position[position] for position in self._label_positions]
+
+    def record(self, pc, control_unit):
+        tick = control_unit.current_tick()
+        spent, self._tick = tick - self._tick, tick
+        interrupted = control_unit.is_interrupted
+        if interrupted and not self._interrupted:
+            self.interrupts += 1
+            self.entry_ticks += spent
+        else:
+            offset = pc - self.code_base
+            self.counts[offset] += 1
+            if self._interrupted:
+                self.handler_ticks[offset] += spent
+            else:
+                self.main_ticks[offset] += spent
+        self._interrupted = interrupted
+
+    def finish(self, control_unit):
+        """Account for the instruction that stopped the run: `hlt` or the one that failed."""
+        spent = control_unit.current_tick() - self._tick
+        offset = control_unit.data_path.registers[machine.PC] - self.code_base
+        if spent and 0 <= offset < len(self.counts):
+            self.counts[offset] += 1
+            ticks = self.handler_ticks if self._interrupted else self.main_ticks
+            ticks[offset] += spent
+            self._tick += spent
+
+    def label_of(self, offset: int) -> str:
+        idx = bisect.bisect_right(self._label_positions, offset) - 1
+        if idx < 0:
+            return "?"
+        return self._label_names[idx]
+
+    def frame_of(self, offset: int) -> str:
+        idx = bisect.bisect_right(self._label_positions, offset) - 1
+        if idx < 0:
+            return str(self.code_base + offset)
+        return f"{self._label_names[idx]}+{offset - self._label_positions[idx]}"
+
+    def by_label(self) -> dict[str, list[int]]:
+        """Label -> [executions, main program ticks, handler ticks], in code order."""
+        result: dict[str, list[int]] = {}
+        for offset, count in enumerate(self.counts):
+            if count:
+                totals = result.setdefault(self.label_of(offset), [0, 0, 0])
+                totals[0] += count
+                totals[1] += self.main_ticks[offset]
+                totals[2] += self.handler_ticks[offset]
+        return result
+
+    def write_report(self, sink: IO[str], top: int = 20):
+        main_ticks, handler_ticks = sum(self.main_ticks), sum(self.handler_ticks)
+        total = max(1, main_ticks + handler_ticks + self.entry_ticks)
+        sink.write(f"instr: {sum(self.counts) + self.interrupts}  ticks: {total}\n")
+        sink.write(f"main program: {main_ticks} ticks ({main_ticks / total:.1%})\n")
+        sink.write(f"interrupt handler: {handler_ticks} ticks ({handler_ticks / total:.1%}), "
+                   f"{self.interrupts} interrupts, entry {self.entry_ticks} ticks\n\n")
+
+        sink.write(f"{'label':<20} {'count':>10} {'ticks':>10} {'handler':>10} {'%':>7}\n")
+        for label, (count, main, handler) in self.by_label().items():
+            sink.write(f"{label:<20} {count:>10} {main:>10} {handler:>10} {(main + handler) / total:>7.1%}\n")
+
+        sink.write(f"\n{'addr':>6} {'where':<20} {'opcode':<6} {'count':>10} {'ticks':>10}\n")
+        hottest = sorted((offset for offset, count in enumerate(self.counts) if count),
+                         key=lambda offset: -(self.main_ticks[offset] + self.handler_ticks[offset]))
+        for offset in hottest[:top]:
+            instr = self.code[offset]
+            opcode = OPCODE_NAMES[instr.opcode] if instr is not None else "data"
+            sink.write(f"{self.code_base + offset:>6} {self.frame_of(offset):<20} {opcode:<6} "
+                       f"{self.counts[offset]:>10} {self.main_ticks[offset] + self.handler_ticks[offset]:>10}\n")
+
+    def write_folded(self, sink: IO[str]):
+        for offset in range(len(self.counts)):
+            for root, ticks in (("main", self.main_ticks), ("interrupt", self.handler_ticks)):
+                if ticks[offset]:
+                    sink.write(f"{root};{self.label_of(offset)};{self.frame_of(offset)} {ticks[offset]}\n")
+        if self.entry_ticks:
+            sink.write(f"interrupt;entry {self.entry_ticks}\n")
+
+
+def profile(source: str, input_schedule, config: machine.MachineConfig = machine.MachineConfig()) -> Profiler:
+    program, labels = translator.translate_with_labels(source)
+    prepare_program(program)
+    control_unit = machine.build_machine(program, input_schedule, config=config)
+    profiler = Profiler(control_unit, labels)
+    machine.run(control_unit, config.limit, tracer=profiler)
+    return profiler
+
+
+def main(args):
+    parser = argparse.ArgumentParser(prog="profiler.py")
+    parser.add_argument("source_file")
+    parser.add_argument("input_file")
+    parser.add_argument("--report", help="report file, stdout by default")
+    parser.add_argument("--folded", help="folded stacks for flame graphs")
+    parser.add_argument("--top", type=int, default=20, help="hottest addresses in the report")
+    machine.add_config_args(parser)
+    options = parser.parse_args(args)
+
+    with open(options.source_file, encoding="utf-8") as file:
+        source = file.read()
+    with open(options.input_file, encoding="utf-8") as file:
+        profiler = profile(source, read_events(file), machine.config_from_args(options))
+
+    with contextlib.ExitStack() as stack:
+        sink = stack.enter_context(open(options.report, "w", encoding="utf-8")) if options.report else sys.stdout
+        profiler.write_report(sink, options.top)
+    if options.folded:
+        with open(options.folded, "w", encoding="utf-8") as file:
+            profiler.write_folded(file)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
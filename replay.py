@@ -0,0 +1,317 @@
+"""
+Deterministic replay log with seek.
+
+`record` runs a program and takes a checkpoint of the machine every
+`interval` ticks. A checkpoint keeps the registers, counters and flags,
+how many input events have been consumed, the length of the output and
+the code cells written over. Memory is stored in full only in keyframes,
+every KEYFRAME_EVERY checkpoints. Other checkpoints keep only the pages
+that changed since the previous one.
+
+The input events are kept once, in the order they are taken off the
+queue. A restored machine gets the ones not consumed yet, so a run
+continued from a checkpoint is the same as the recorded run.
+
+`ReplayLog.seek` gets to any tick or instruction index: it restores the
+last checkpoint before it and steps forward.
+
+    replay.py record <program> <input_file> <log> [--interval N]
+    replay.py seek <log> (--tick T | --instr N)
+
+The log file is a small JSON header followed by a zlib-compressed blob
+with the code records, the code mask and the memory pages.
+"""
+
+import argparse
+import bisect
+import json
+import struct
+import sys
+import zlib
+from typing import NamedTuple, Optional
+
+import machine
+from devices import read_events
+from isa import BINARY_INSTRUCTION
+from machine import MAX_INSTRUCTION_TICKS, ControlUnit, DataPath, InterruptController, MachineConfig
+from snapshot import encode_code
+
+REPLAY_MAGIC = b"PMRL"
+REPLAY_VERSION = 1
+REPLAY_HEADER = struct.Struct("<4sHI")      # magic, version, header length
+
+DEFAULT_INTERVAL = 10000
+KEYFRAME_EVERY = 32
+PAGE_WORDS = 512
+
+
+class Checkpoint(NamedTuple):
+    """
+    State of a running machine between two instructions. `pages` are
+    (page number, page bytes) changed since the previous checkpoint;
+    `keyframe` is the whole memory or None. `dropped` are the code offsets
+    written over.
+    """
+    tick: int
+    instr: int
+    registers: list[int]
+    is_interrupted: bool
+    input_buf: int
+    mem_addr_bus: int
+    alu_result: int
+    alu_zf: bool
+    events_consumed: int
+    output_len: int
+    dropped: tuple
+    pages: tuple
+    keyframe: Optional[bytes]
+
+
+def changed_pages(previous: bytes, current: bytes) -> tuple:
+    page_bytes = 8 * PAGE_WORDS
+    if previous == current:
+        return ()
+    return tuple((start // page_bytes, current[start:start + page_bytes])
+                 for start in range(0, len(current), page_bytes)
+                 if previous[start:start + page_bytes] != current[start:start + page_bytes])
+
+
+class ReplayLog:
+    """The checkpoints of a run, with what is needed to rebuild the machine from any of them."""
+
+    def __init__(self, code: tuple, start: int, config: MachineConfig, events: list, interval: int):
+        self.code = code
+        self.start = start
+        self.config = config
+        self.events = events
+        self.interval = interval
+        self.checkpoints: list[Checkpoint] = []
+        self.output: str = ""
+        self.instr: int = 0
+        self.ticks: int = 0
+        self.error: Optional[str] = None
+        self._ticks: list[int] = []
+        self._instrs: list[int] = []
+        self._memory: bytes = b""
+
+    def add_checkpoint(self, control_unit: ControlUnit):
+        data_path = control_unit.data_path
+        memory = data_path.memory.tobytes()
+        keyframe = memory if len(self.checkpoints) % KEYFRAME_EVERY == 0 else None
+        pages = () if keyframe is not None else changed_pages(self._memory, memory)
+        self._memory = memory
+
+        dropped = tuple(offset for offset, instr in enumerate(data_path.code) if instr is None) \
+            if data_path.code_writes else ()
+        if self.checkpoints and dropped == self.checkpoints[-1].dropped:
+            dropped = self.checkpoints[-1].dropped
+        self.checkpoints.append(Checkpoint(
+            tick=control_unit.current_tick(),
+            instr=control_unit.instr_counter,
+            registers=list(data_path.registers),
+            is_interrupted=control_unit.is_interrupted,
+            input_buf=data_path.input_buf,
+            mem_addr_bus=data_path.mem_addr_bus,
+            alu_result=data_path.alu.result,
+            alu_zf=data_path.alu.ZF,
+            events_consumed=control_unit.input_irq.consumed,
+            output_len=len(data_path.output_buf),
+            dropped=dropped,
+            pages=pages,
+            keyframe=keyframe,
+        ))
+        self._ticks.append(control_unit.current_tick())
+        self._instrs.append(control_unit.instr_counter)
+
+    def memory_at(self, index: int) -> bytearray:
+        """The memory of a checkpoint: its keyframe with the pages changed since applied."""
+        key = index - index % KEYFRAME_EVERY
+        memory = bytearray(self.checkpoints[key].keyframe)
+        page_bytes = 8 * PAGE_WORDS
+        for checkpoint in self.checkpoints[key + 1:index + 1]:
+            for page, data in checkpoint.pages:
+                memory[page * page_bytes:page * page_bytes + len(data)] = data
+        return memory
+
+    def restore(self, index: int) -> ControlUnit:
+        """A fresh machine in the state of checkpoint `index`, ready for `machine.run`."""
+        checkpoint = self.checkpoints[index]
+        config = self.config
+        memory = machine.allocate_memory(config.memory_size)
+        memory[:] = memoryview(self.memory_at(index)).cast('q')
+
+        data_path = DataPath(memory)
+        data_path.registers = list(checkpoint.registers)
+        data_path.code = list(self.code)
+        for offset in checkpoint.dropped:
+            data_path.code[offset] = None
+        data_path.code_base = config.program_addr
+        data_path.input_buf = checkpoint.input_buf
+        data_path.mem_addr_bus = checkpoint.mem_addr_bus
+        if config.input_addr is not None:
+            data_path.input_map_addr = config.input_addr
+        if config.output_addr is not None:
+            data_path.output_map_addr = config.output_addr
+        data_path.alu.result = checkpoint.alu_result
+        data_path.alu.ZF = checkpoint.alu_zf
+        data_path.output_buf = list(self.output[:checkpoint.output_len])
+
+        input_irq = InterruptController(self.events[checkpoint.events_consumed:])
+        input_irq.consumed = checkpoint.events_consumed
+        control_unit = ControlUnit(data_path, input_irq, config.limit)
+        control_unit.tick_limit = config.tick_limit
+        control_unit._tick = checkpoint.tick
+        control_unit.instr_counter = checkpoint.instr
+        control_unit.is_interrupted = checkpoint.is_interrupted
+        return control_unit
+
+    def seek(self, tick: Optional[int] = None, instr: Optional[int] = None) -> ControlUnit:
+        """
+        The machine at the first instruction boundary at or after `tick`,
+        or after `instr` instructions. Checkpoints are taken only while the
+        machine runs, so a target past the end of the run steps into the
+        stop again and gives the state it stopped in, with its error.
+        """
+        assert (tick is None) != (instr is None), "Seek to either a tick or an instruction"
+        if tick is not None:
+            index = max(0, bisect.bisect_right(self._ticks, tick) - 1)
+        else:
+            index = max(0, bisect.bisect_right(self._instrs, instr) - 1)
+        control_unit = self.restore(index)
+        limit = self.config.limit
+        if instr is not None:
+            machine.run(control_unit, limit, stop_at=instr)
+            return control_unit
+        while control_unit.current_tick() < tick and not control_unit.halted and control_unit.error is None:
+            chunk = max(1, (tick - control_unit.current_tick()) // MAX_INSTRUCTION_TICKS)
+            machine.run(control_unit, limit, stop_at=control_unit.instr_counter + chunk)
+        return control_unit
+
+    def save(self, filename: str):
+        records, mask = encode_code(self.code)
+        blob = bytearray(records + mask)
+        checkpoints = []
+        for checkpoint in self.checkpoints:
+            fields = checkpoint._asdict()
+            pages = []
+            for page, data in checkpoint.pages:
+                pages.append([page, len(blob), len(data)])
+                blob += data
+            fields["pages"] = pages
+            if checkpoint.keyframe is not None:
+                fields["keyframe"] = [len(blob), len(checkpoint.keyframe)]
+                blob += checkpoint.keyframe
+            checkpoints.append(fields)
+        header = json.dumps({
+            "start": self.start,
+            "config": self.config._asdict(),
+            "code_count": len(self.code),
+            "events": self.events,
+            "interval": self.interval,
+            "output": self.output,
+            "instr": self.instr,
+            "ticks": self.ticks,
+            "error": self.error,
+            "checkpoints": checkpoints,
+        }).encode("utf-8")
+        with open(filename, "wb") as file:
+            file.write(REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, len(header)))
+            file.write(header)
+            file.write(zlib.compress(bytes(blob)))
+
+
+def load_log(filename: str) -> ReplayLog:
+    with open(filename, "rb") as file:
+        data = file.read()
+    magic, version, header_len = REPLAY_HEADER.unpack_from(data)
+    assert magic == REPLAY_MAGIC, "Not a replay log"
+    assert version == REPLAY_VERSION, f"Unsupported replay log version {version}"
+    header = json.loads(data[REPLAY_HEADER.size:REPLAY_HEADER.size + header_len])
+    blob = zlib.decompress(data[REPLAY_HEADER.size + header_len:])
+
+    code_count = header["code_count"]
+    records = blob[:code_count * BINARY_INSTRUCTION.size]
+    mask = blob[code_count * BINARY_INSTRUCTION.size:code_count * (BINARY_INSTRUCTION.size + 1)]
+    code = tuple(machine.decode_record(record) if live else None
+                 for record, live in zip(BINARY_INSTRUCTION.iter_unpack(records), mask))
+    log = ReplayLog(code, header["start"], MachineConfig(**header["config"]),
+                    [tuple(event) for event in header["events"]], header["interval"])
+    log.output = header["output"]
+    log.instr = header["instr"]
+    log.ticks = header["ticks"]
+    log.error = header["error"]
+    for fields in header["checkpoints"]:
+        fields["dropped"] = tuple(fields["dropped"])
+        fields["pages"] = tuple((page, blob[offset:offset + size]) for page, offset, size in fields["pages"])
+        if fields["keyframe"] is not None:
+            offset, size = fields["keyframe"]
+            fields["keyframe"] = blob[offset:offset + size]
+        checkpoint = Checkpoint(**fields)
+        log.checkpoints.append(checkpoint)
+        log._ticks.append(checkpoint.tick)
+        log._instrs.append(checkpoint.instr)
+    return log
+
+
+def record(program, input_schedule, config: MachineConfig = MachineConfig(),
+           interval: int = DEFAULT_INTERVAL) -> ReplayLog:
+    """Run `program` like `machine.simulation` and log a checkpoint every `interval` ticks."""
+    events = list(input_schedule)
+    order = sorted(range(len(events)), key=lambda idx: (events[idx][0], idx))
+    control_unit = machine.build_machine(program, events, config=config)
+    data_path = control_unit.data_path
+    log = ReplayLog(tuple(data_path.code), int(program["start"]), config,
+                    [tuple(events[idx]) for idx in order], interval)
+
+    log.add_checkpoint(control_unit)
+    next_tick = interval
+    while True:
+        chunk = max(1, (next_tick - control_unit.current_tick()) // MAX_INSTRUCTION_TICKS)
+        log.instr = machine.run(control_unit, config.limit, stop_at=control_unit.instr_counter + chunk)
+        if control_unit.halted or control_unit.error is not None:
+            break
+        if control_unit.current_tick() >= next_tick:
+            log.add_checkpoint(control_unit)
+            next_tick = (control_unit.current_tick() // interval + 1) * interval
+    log.output = ''.join(data_path.output_buf)
+    log.ticks = control_unit.current_tick()
+    log.error = control_unit.error
+    return log
+
+
+def describe(control_unit: ControlUnit) -> str:
+    data_path = control_unit.data_path
+    registers = ' '.join(f"{register.value}={value}" for register, value in data_path.registers_dump().items())
+    return f"tick: {control_unit.current_tick()}  instr: {control_unit.instr_counter}  " \
+           f"interrupted: {control_unit.is_interrupted}\n{registers}\noutput: {''.join(data_path.output_buf)}"
+
+
+def main(args):
+    parser = argparse.ArgumentParser(prog="replay.py")
+    commands = parser.add_subparsers(dest="command", required=True)
+    record_parser = commands.add_parser("record", help="run a program and write its replay log")
+    record_parser.add_argument("program_file")
+    record_parser.add_argument("input_file")
+    record_parser.add_argument("log_file")
+    record_parser.add_argument("--interval", type=int, default=DEFAULT_INTERVAL, help="ticks between checkpoints")
+    machine.add_config_args(record_parser)
+    seek_parser = commands.add_parser("seek", help="print the machine state at a point of a logged run")
+    seek_parser.add_argument("log_file")
+    target = seek_parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--tick", type=int)
+    target.add_argument("--instr", type=int)
+    options = parser.parse_args(args)
+
+    if options.command == "record":
+        program = machine.load_program_file(options.program_file)
+        with open(options.input_file, encoding="utf-8") as file:
+            log = record(program, read_events(file), machine.config_from_args(options), options.interval)
+        log.save(options.log_file)
+        print(f"checkpoints: {len(log.checkpoints)}  instr: {log.instr}  ticks: {log.ticks}")
+    else:
+        log = load_log(options.log_file)
+        print(describe(log.seek(options.tick, options.instr)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,125 @@
+"""
+Snapshots of the full machine state.
+
+A snapshot is a small JSON header followed by binary images:
+
+    magic, version, header length
+    header      -- registers, counters, flags, pending input events and
+                   the output not yet written to a streaming device
+    memory      -- the data memory as signed 64-bit words
+    code        -- instructions in the binary program format
+    code mask   -- one byte per instruction, 0 where data was written over it
+
+A snapshot is taken between instructions, e.g. after `machine.run` with
+`stop_at`, and restored into a fresh ControlUnit that `machine.run` resumes.
+"""
+
+import json
+import struct
+from typing import Tuple
+
+from isa import BINARY_INSTRUCTION, encode_instruction
+from machine import ControlUnit, DataPath, InterruptController, allocate_memory, decode_record, run
+
+SNAPSHOT_MAGIC = b"PMSN"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<4sHI")      # magic, version, header length
+
+
+def encode_code(code) -> Tuple[bytes, bytes]:
+    """Records of the binary program format and a mask with 0 where data was written over the code."""
+    records, mask = [], bytearray(len(code))
+    for idx, instr in enumerate(code):
+        if instr is None:
+            records.append(bytes(BINARY_INSTRUCTION.size))
+            continue
+        mask[idx] = 1
+        if isinstance(instr.source, tuple):
+            records.append(BINARY_INSTRUCTION.pack(*instr.source))
+        else:
+            records.append(encode_instruction({k: v for k, v in instr.source.items() if k != "type"}))
+    return b"".join(records), bytes(mask)
+
+
+def take_snapshot(control_unit: ControlUnit) -> bytes:
+    data_path = control_unit.data_path
+    records, mask = encode_code(data_path.code)
+    header = json.dumps({
+        "memory_size": len(data_path.memory),
+        "code_base": data_path.code_base,
+        "code_count": len(data_path.code),
+        "registers": data_path.registers,
+        "input_buf": data_path.input_buf,
+        "mem_addr_bus": data_path.mem_addr_bus,
+        "input_map_addr": data_path.input_map_addr,
+        "output_map_addr": data_path.output_map_addr,
+        "alu_result": data_path.alu.result,
+        "alu_zf": data_path.alu.ZF,
+        "tick": control_unit.current_tick(),
+        "instr_counter": control_unit.instr_counter,
+        "is_interrupted": control_unit.is_interrupted,
+        "halted": control_unit.halted,
+        "limit": control_unit.limit,
+        "tick_limit": control_unit.tick_limit,
+        "pending": control_unit.input_irq.pending(),
+        "output": ''.join(data_path.output_buf),
+    }).encode("utf-8")
+    return b"".join([SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(header)), header,
+                     data_path.memory.tobytes(), records, mask])
+
+
+def restore_snapshot(data: bytes, limit: int = None) -> ControlUnit:
+    data = memoryview(data)
+    magic, version, header_len = SNAPSHOT_HEADER.unpack_from(data)
+    assert magic == SNAPSHOT_MAGIC, "Not a machine snapshot"
+    assert version == SNAPSHOT_VERSION, f"Unsupported snapshot version {version}"
+    pos = SNAPSHOT_HEADER.size
+    header = json.loads(bytes(data[pos:pos + header_len]))
+    pos += header_len
+
+    memory = allocate_memory(header["memory_size"])
+    memory[:] = data[pos:pos + 8 * header["memory_size"]].cast('q')
+    pos += 8 * header["memory_size"]
+    code_count = header["code_count"]
+    records = data[pos:pos + code_count * BINARY_INSTRUCTION.size]
+    pos += code_count * BINARY_INSTRUCTION.size
+    mask = data[pos:pos + code_count]
+
+    data_path = DataPath(memory)
+    data_path.registers = header["registers"]
+    data_path.code = [decode_record(record) if live else None
+                      for record, live in zip(BINARY_INSTRUCTION.iter_unpack(records), mask)]
+    data_path.code_base = header["code_base"]
+    data_path.input_buf = header["input_buf"]
+    data_path.mem_addr_bus = header["mem_addr_bus"]
+    data_path.input_map_addr = header.get("input_map_addr", data_path.input_map_addr)
+    data_path.output_map_addr = header.get("output_map_addr", data_path.output_map_addr)
+    data_path.alu.result = header["alu_result"]
+    data_path.alu.ZF = header["alu_zf"]
+    data_path.output_buf = list(header["output"])
+
+    input_irq = InterruptController(tuple(event) for event in header["pending"])
+    control_unit = ControlUnit(data_path, input_irq, header["limit"] if limit is None else limit)
+    control_unit.tick_limit = header.get("tick_limit")
+    control_unit._tick = header["tick"]
+    control_unit.instr_counter = header["instr_counter"]
+    control_unit.is_interrupted = header["is_interrupted"]
+    control_unit.halted = header["halted"]
+    return control_unit
+
+
+def save_snapshot(control_unit: ControlUnit, filename: str):
+    with open(filename, "wb") as file:
+        file.write(take_snapshot(control_unit))
+
+
+def load_snapshot(filename: str, limit: int = None) -> ControlUnit:
+    with open(filename, "rb") as file:
+        return restore_snapshot(file.read(), limit)
+
+
+def resume_simulation(data: bytes, limit: int = None, tracer=None) -> Tuple[str, int, int]:
+    """Continue a run from a snapshot. Returns the same triple as `machine.simulation`."""
+    control_unit = restore_snapshot(data, limit)
+    instr_counter = run(control_unit, control_unit.limit, tracer)
+    return ''.join(control_unit.data_path.output_buf), instr_counter, control_unit.current_tick()
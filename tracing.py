@@ -0,0 +1,59 @@
+import json
+import logging
+from typing import IO
+
+from isa import Opcode, Register
+
+OPCODE_NAMES = [opcode.value for opcode in Opcode]
+REGISTER_NAMES = [register.value for register in Register]
+
+TRACE_MODES = ["none", "text", "jsonl"]
+
+
+class TextTracer:
+    """
+    The processor state log used by the golden tests.
+
+    Records are formatted lazily, so nothing is built when DEBUG is off.
+    """
+
+    def record(self, pc, control_unit):
+        logging.debug('%r', control_unit)
+
+    def finish(self, control_unit):
+        logging.debug('%s', control_unit.data_path.registers_dump())
+
+
+class JsonlTracer:
+    """One JSON object per executed instruction, written to `sink`."""
+
+    def __init__(self, sink: IO[str]):
+        self.sink = sink
+
+    def record(self, pc, control_unit):
+        instr = control_unit.last_instr
+        self.sink.write(json.dumps({
+            "instr": control_unit.instr_counter,
+            "tick": control_unit.current_tick(),
+            "pc": pc,
+            "interrupted": control_unit.is_interrupted,
+            "opcode": OPCODE_NAMES[instr.opcode],
+            "rd": REGISTER_NAMES[instr.rd] if instr.rd is not None else None,
+            "rs1": REGISTER_NAMES[instr.rs1] if instr.rs1 is not None else None,
+            "rs2": REGISTER_NAMES[instr.rs2] if instr.rs2 is not None else None,
+            "imm": instr.imm,
+        }) + '\n')
+
+    def finish(self, control_unit):
+        self.sink.flush()
+
+
+def make_tracer(mode: str, sink: IO[str] = None):
+    if mode == "none":
+        return None
+    if mode == "text":
+        return TextTracer()
+    if mode == "jsonl":
+        assert sink is not None, "jsonl trace requires a sink"
+        return JsonlTracer(sink)
+    raise ValueError(f"Unknown trace mode: {mode}")
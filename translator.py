@@ -1,182 +1,144 @@
+import argparse
+import re
 import sys
-from typing import Tuple, Union
+from typing import NamedTuple, Tuple, Union
 
-from isa import InstructionType
+from isa import InstructionType, encode_program
 import json
 
 
-def parse_symbol(text: str) -> Tuple[str, int]:
-    it = text[0]
-    if (ord('a') <= ord(it) <= ord('z')) or \
-            (ord('A') <= ord(it) <= ord('Z')) or \
-            (ord('0') <= ord(it) <= ord('9')) or \
-            it == '_':
-        return it, 1
-    return '', 0
-
-
-def parse_digit(text: str) -> Tuple[str, int]:
-    it = text[0]
-    if ord('0') <= ord(it) <= ord('9'):
-        return it, 1
-    return '', 0
-
-
-def parse_comma(text: str) -> Tuple[str, int]:
-    if text[0] == ',':
-        return ',', 1
-    return '', 0
-
-
-def parse_delimiter(text: str) -> Tuple[str, int]:
-    if text[0] == ',' and text[1] == ' ':
+# part of the translation cache key, bump it whenever the output of `translate` changes
+TRANSLATOR_VERSION = "2"
+
+COMMANDS = frozenset([
+    'ld',
+    'st',
+    'jmp',
+    'beq',
+    'add',
+    'addi',
+    'sub',
+    'subi',
+    'mul',
+    'div',
+    'rem',
+    'iret',
+    'hlt'])
+
+REGISTERS = frozenset([
+    'r0',
+    'r1',
+    'r2',
+    'r3',
+    'r4',
+    'r5',
+    'r6',
+    'r7',
+    'pc',
+    'sp'])
+
+# Parsers take the whole text and a position and return the token and its
+# length. Nothing is sliced off the text, so tokenizing is linear.
+WORD_RE = re.compile(r'[a-zA-Z0-9_]*')
+NUMBER_RE = re.compile(r'[0-9]*')
+REGISTER_RE = re.compile(r'[a-zA-Z0-9_]{0,2}')
+SPACES_RE = re.compile(r' *')
+GAP_RE = re.compile(r'[ \n\r\t]*')
+# a line that starts with a label starts a block; no token spans two lines
+BLOCK_START_RE = re.compile(r'^[ \r\t]*[a-zA-Z0-9_]*:', re.MULTILINE)
+
+
+def parse_delimiter(text: str, pos: int) -> Tuple[str, int]:
+    if text[pos] == ',' and text[pos + 1] == ' ':
         return ', ', 2
     return '', 0
 
 
-def parse_word(text: str) -> Tuple[str, int]:
-    word, ll = '', 0
-    while True:
-        ch, cnt = parse_symbol(text[ll:])
-        if cnt == 0:
-            break
-        word += ch
-        ll += cnt
-    return word, ll
+def parse_word(text: str, pos: int) -> Tuple[str, int]:
+    word = WORD_RE.match(text, pos).group()
+    return word, len(word)
 
 
-def parse_label(text: str) -> Tuple[str, int]:
-    label, ll = parse_word(text)
-    if text[ll] == ':':
-        label, ll = label + ':', ll + 1
-        return label, ll
+def parse_label(text: str, pos: int) -> Tuple[str, int]:
+    label, ll = parse_word(text, pos)
+    if text[pos + ll] == ':':
+        return label + ':', ll + 1
     return '', 0
 
 
-def parse_spaces(text: str) -> Tuple[str, int]:
-    spaces, ll = "", 0
-    while True:
-        if text[ll] == ' ':
-            spaces += ' '
-            ll += 1
-        else:
-            break
-    return spaces, ll
+def parse_spaces(text: str, pos: int) -> Tuple[str, int]:
+    spaces = SPACES_RE.match(text, pos).group()
+    return spaces, len(spaces)
 
 
-def parse_gap(text: str) -> Tuple[str, int]:
-    gap, ll = '', 0
-    while True:
-        if ll < len(text) and (text[ll] in [' ', '\n', '\r', '\t']):
-            gap += text[ll]
-            ll += 1
-        else:
-            break
-    return gap, ll
+def parse_gap(text: str, pos: int) -> Tuple[str, int]:
+    gap = GAP_RE.match(text, pos).group()
+    return gap, len(gap)
 
 
-def parse_command(text: str) -> Tuple[str, int]:
-    label, ll = '', 0
-    while True:
-        ch, cnt = parse_symbol(text[ll:])
-        if cnt == 0:
-            break
-        label += ch
-        ll += cnt
-    if label in [
-        'ld',
-        'st',
-        'jmp',
-        'beq',
-        'add',
-        'addi',
-        'sub',
-        'subi',
-        'mul',
-        'div',
-        'rem',
-        'iret',
-            'hlt']:
-        return label, ll
+def parse_command(text: str, pos: int) -> Tuple[str, int]:
+    command, ll = parse_word(text, pos)
+    if command in COMMANDS:
+        return command, ll
     return '', 0
 
 
-def parse_register(text: str) -> Tuple[str, int]:
-    register, ll = '', 0
-    for i in range(2):
-        ch, cnt = parse_symbol(text[ll:])
-        register += ch
-        ll += cnt
-    if register in [
-        'r0',
-        'r1',
-        'r2',
-        'r3',
-        'r4',
-        'r5',
-        'r6',
-        'r7',
-        'pc',
-            'sp']:
-        return register, ll
+def parse_register(text: str, pos: int) -> Tuple[str, int]:
+    register = REGISTER_RE.match(text, pos).group()
+    if register in REGISTERS:
+        return register, len(register)
     return '', 0
 
 
-def parse_number(text: str) -> Tuple[str, int]:
-    number, ll = "", 0
-    while True:
-        ch, cnt = parse_digit(text[ll:])
-        if cnt == 0:
-            break
-        number += ch
-        ll += cnt
-    return number, ll
+def parse_number(text: str, pos: int) -> Tuple[str, int]:
+    number = NUMBER_RE.match(text, pos).group()
+    return number, len(number)
 
 
-def parse_instruction(text) -> Tuple[dict, int]:
+def parse_instruction(text: str, pos: int) -> Tuple[dict, int]:
     instr: dict[str, Union[str, InstructionType]] = dict()
     ll: int = 0
 
-    command, llt = parse_command(text[ll:])
+    command, llt = parse_command(text, pos + ll)
     if llt == 0:
         return {}, 0
     ll += llt
 
-    spaces, llt = parse_spaces(text[ll:])
+    spaces, llt = parse_spaces(text, pos + ll)
     ll += llt
 
-    register1, llt = parse_register(text[ll:])
+    register1, llt = parse_register(text, pos + ll)
     ll += llt
     if llt > 0:
-        delimiter, llt = parse_delimiter(text[ll:])
+        delimiter, llt = parse_delimiter(text, pos + ll)
         if llt == 0:
             return {}, 0
         ll += llt
 
-        register2, llt = parse_register(text[ll:])
+        register2, llt = parse_register(text, pos + ll)
         if llt == 0:
             return {}, 0
         ll += llt
 
-        delimiter, llt = parse_delimiter(text[ll:])
+        delimiter, llt = parse_delimiter(text, pos + ll)
         ll += llt
         if llt == 0:
             return {"opcode": command, "rd": register1,
                     "rs": register2, "type": InstructionType.C}, ll
 
-        register3, llt = parse_register(text[ll:])
+        register3, llt = parse_register(text, pos + ll)
         ll += llt
         if llt > 0:
             return {"opcode": command, "rd": register1, "rs1": register2,
                     "rs2": register3, "type": InstructionType.A}, ll
 
-        word, llt = parse_word(text[ll:])
+        word, llt = parse_word(text, pos + ll)
         if llt > 0 and command in ['beq', 'jmp']:
             ll += llt
             return {"opcode": command, "rs1": register1, "rs2": register2,
                     "label": word, "type": InstructionType.E}, ll
 
-        number, llt = parse_number(text[ll:])
+        number, llt = parse_number(text, pos + ll)
         ll += llt
         if llt > 0:
             return {"opcode": command, "rd": register1, "rs": register2,
@@ -184,7 +146,7 @@ def parse_instruction(text) -> Tuple[dict, int]:
 
         return {}, 0
 
-    word, llt = parse_word(text[ll:])
+    word, llt = parse_word(text, pos + ll)
     ll += llt
     if llt > 0:
         return {"opcode": command, "label": word,
@@ -195,15 +157,21 @@ def parse_instruction(text) -> Tuple[dict, int]:
 
 def tokenize(text):
     tokens: list[Tuple[str, list]] = []
+    tokenize_into(text, tokens)
+    return tokens
+
+
+def tokenize_into(text, tokens: list) -> bool:
+    """Append the tokens of `text` to `tokens`. False when it stopped at text it can't parse."""
     cursor = 0
     while cursor < len(text) - 1:
-        label, it = parse_label(text[cursor:])
+        label, it = parse_label(text, cursor)
         if it > 0:
             tokens.append((label, []))
             cursor += it
             continue
 
-        instr, it = parse_instruction(text[cursor:])
+        instr, it = parse_instruction(text, cursor)
         if it > 0:
             if len(tokens) > 0 and isinstance(tokens[-1], tuple):
                 tokens[-1][1].append(instr)
@@ -212,11 +180,11 @@ def tokenize(text):
             cursor += it
             continue
 
-        gap, it = parse_gap(text[cursor:])
+        gap, it = parse_gap(text, cursor)
         if it == 0:
-            break
+            return False
         cursor += it
-    return tokens
+    return True
 
 
 def get_start_token_idx(tokens):
@@ -237,8 +205,169 @@ def get_int_token_idx(tokens):
     return int_token_idx
 
 
-def translate(text):
-    tokens = tokenize(text + '\n')
+MAX_IMM = 2147483647
+
+
+def is_jump(instr) -> bool:
+    """`jmp label`: the only unconditional jump the optimizer follows."""
+    return instr["opcode"] == "jmp" and instr["type"] == InstructionType.D
+
+
+def is_branch(instr) -> bool:
+    return instr["opcode"] == "beq" and instr["type"] == InstructionType.E
+
+
+def constant_of(instr, register: str) -> Union[int, None]:
+    """The value `addi/subi register, r0, imm` writes, None for any other instruction."""
+    if instr["opcode"] not in ("addi", "subi") or instr["type"] != InstructionType.B \
+            or instr["rd"] != register or instr["rs"] != "r0" or not instr["imm"].isdigit():
+        return None
+    return int(instr["imm"]) if instr["opcode"] == "addi" else -int(instr["imm"])
+
+
+def is_optimizable(tokens, label_index: dict[str, int]) -> bool:
+    """
+    Every jump of the program has a known target and no instruction uses
+    PC, so the code can be moved.
+    """
+    for _, instrs in tokens:
+        for instr in instrs:
+            if "pc" in (instr.get("rd"), instr.get("rs"), instr.get("rs1"), instr.get("rs2")):
+                return False
+            if instr["opcode"] in ("jmp", "beq") and not (is_jump(instr) or is_branch(instr)):
+                return False
+            if "label" in instr and instr["label"] not in label_index:
+                return False
+    return True
+
+
+def fold_constants(instrs: list) -> bool:
+    """
+    `addi rX, r0, a` followed by `addi/subi rX, rX, b` or by another
+    constant load of rX becomes a single constant load.
+    """
+    changed = False
+    i = 0
+    while i + 1 < len(instrs):
+        first, second = instrs[i], instrs[i + 1]
+        register = first.get("rd")
+        value = constant_of(first, register) if register not in (None, "r0") else None
+        if value is not None and second["type"] == InstructionType.B and second["rd"] == register \
+                and second["opcode"] in ("addi", "subi") and second["rs"] in (register, "r0") \
+                and second["imm"].isdigit():
+            if second["rs"] == register:
+                value += int(second["imm"]) if second["opcode"] == "addi" else -int(second["imm"])
+            else:
+                value = constant_of(second, register)
+            if abs(value) <= MAX_IMM:
+                instrs[i:i + 2] = [{"opcode": "addi" if value >= 0 else "subi", "rd": register, "rs": "r0",
+                                    "imm": str(abs(value)), "type": InstructionType.B}]
+                changed = True
+                continue
+        i += 1
+    return changed
+
+
+def optimize_tokens(tokens) -> list:
+    """
+    Peephole passes over the token list in its final order, before label
+    resolution. Labels stay with their tokens, so their positions and the
+    relative jump offsets are computed afterwards as usual.
+
+    The passes fold constant loads, thread jumps to `jmp label`, drop a
+    `jmp` to the next instruction and remove code that can't be reached
+    from `_start` or from the interrupt vector at position 0. The program
+    computes the same, in fewer instructions and ticks, so interrupts
+    arrive at other points of it. A program that uses PC as a register or
+    jumps to a computed address is left as it is, and so is one that reads
+    or writes its own code cells.
+    """
+    changed = True
+    while changed:
+        changed = False
+        flat = [instr for _, instrs in tokens for instr in instrs]
+        label_index: dict[str, int] = {}
+        pos = 0
+        for label, instrs in tokens:
+            label_index[label[:-1]] = pos
+            pos += len(instrs)
+        if not is_optimizable(tokens, label_index):
+            return tokens
+
+        for _, instrs in tokens:
+            changed |= fold_constants(instrs)
+        if changed:
+            continue
+
+        for instr in flat:
+            if "label" in instr:
+                label, seen = instr["label"], set()
+                target = label_index[label]
+                while target < len(flat) and is_jump(flat[target]) and target not in seen:
+                    seen.add(target)
+                    label = flat[target]["label"]
+                    target = label_index[label]
+                if label != instr["label"]:
+                    instr["label"] = label
+                    changed = True
+
+        removed = set()
+        for i, instr in enumerate(flat):
+            if is_jump(instr) and label_index[instr["label"]] == i + 1:
+                removed.add(i)
+
+        reachable = set()
+        stack = [0, label_index["_start"]]
+        while stack:
+            i = stack.pop()
+            if i in reachable or i >= len(flat):
+                continue
+            reachable.add(i)
+            instr = flat[i]
+            if "label" in instr:
+                stack.append(label_index[instr["label"]])
+            if not is_jump(instr) and instr["opcode"] not in ("hlt", "iret"):
+                stack.append(i + 1)
+        removed |= set(range(len(flat))) - reachable
+
+        if removed:
+            changed = True
+            kept = {id(instr) for i, instr in enumerate(flat) if i not in removed}
+            tokens = [(label, [instr for instr in instrs if id(instr) in kept]) for label, instrs in tokens]
+    return tokens
+
+
+def emit_instruction(instr) -> dict:
+    """The machine code of a parsed instruction, with the fields of its type."""
+    if instr["type"] == InstructionType.A:
+        return {"opcode": instr["opcode"],
+                "rd": instr["rd"],
+                "rs1": instr["rs1"],
+                "rs2": instr["rs2"]}
+
+    if instr["type"] == InstructionType.B:
+        return {"opcode": instr["opcode"],
+                "rd": instr["rd"],
+                "rs": instr["rs"],
+                "imm": instr["imm"]}
+
+    if instr["type"] == InstructionType.C:
+        return {"opcode": instr["opcode"], "rd": instr["rd"], "rs": instr["rs"]}
+
+    if instr["type"] == InstructionType.D:
+        return {"opcode": instr["opcode"], "imm": instr["imm"]}
+
+    if instr["type"] == InstructionType.E:
+        return {"opcode": instr["opcode"],
+                "rs1": instr["rs1"],
+                "rs2": instr["rs2"],
+                "imm": instr["imm"]}
+
+    return {"opcode": instr["opcode"]}
+
+
+def order_tokens(tokens):
+    """Put the `_int` token first, in place."""
     int_token_idx = get_int_token_idx(tokens)
     start_token_idx = get_start_token_idx(tokens)
 
@@ -247,11 +376,31 @@ def translate(text):
     if int_token_idx is not None:
         tokens[0], tokens[int_token_idx] = tokens[int_token_idx], tokens[0]
 
+
+def get_label_positions(tokens) -> dict[str, int]:
     label_positions: dict[str, int] = {}
     cur_pos = 0
     for token in tokens:
         label_positions[token[0][:-1]] = cur_pos
         cur_pos += len(token[1])
+    return label_positions
+
+
+def translate_with_labels(text, optimize: bool = False) -> Tuple[dict, dict[str, int]]:
+    """
+    Translate the source and also return the position of every label in
+    the code. `optimize` runs the peephole passes of `optimize_tokens`.
+    """
+    return translate_tokens(tokenize(text + '\n'), optimize)
+
+
+def translate_tokens(tokens, optimize: bool = False) -> Tuple[dict, dict[str, int]]:
+    """The rest of `translate_with_labels` after tokenizing. The tokens are changed in place."""
+    order_tokens(tokens)
+    if optimize:
+        tokens = optimize_tokens(tokens)
+
+    label_positions = get_label_positions(tokens)
 
     cur_pos = 0
     for token in tokens:
@@ -260,54 +409,123 @@ def translate(text):
                 instr['imm'] = label_positions[instr['label']] - cur_pos
             cur_pos += 1
 
-    code = []
-    for token in tokens:
-        for instr in token[1]:
-            if instr["type"] == InstructionType.A:
-                code.append({"opcode": instr["opcode"],
-                             "rd": instr["rd"],
-                             "rs1": instr["rs1"],
-                             "rs2": instr["rs2"]})
+    code = [emit_instruction(instr) for token in tokens for instr in token[1]]
+
+    target = {
+        "start": label_positions["_start"],
+        "code": code
+    }
+    return target, label_positions
 
-            elif instr["type"] == InstructionType.B:
-                code.append({"opcode": instr["opcode"],
-                             "rd": instr["rd"],
-                             "rs": instr["rs"],
-                             "imm": instr["imm"]})
 
-            elif instr["type"] == InstructionType.C:
-                code.append({"opcode": instr["opcode"], "rd": instr["rd"], "rs": instr["rs"]})
+def translate(text, optimize: bool = False):
+    return translate_with_labels(text, optimize)[0]
 
-            elif instr["type"] == InstructionType.D:
-                code.append({"opcode": instr["opcode"], "imm": instr["imm"]})
 
-            elif instr["type"] == InstructionType.E:
-                code.append({"opcode": instr["opcode"],
-                             "rs1": instr["rs1"],
-                             "rs2": instr["rs2"],
-                             "imm": instr["imm"]})
+class Block(NamedTuple):
+    """
+    The tokens of a block of source lines, with their code. A jump's `imm`
+    in `code` is patched for every translation; `complete` is False when
+    tokenizing stopped inside the block.
+    """
+    tokens: list
+    code: list
+    complete: bool
 
-            elif instr["type"] == InstructionType.F:
-                code.append({"opcode": instr["opcode"]})
 
-    target = {
-        "start": label_positions["_start"],
-        "code": code
-    }
-    return target
+def compile_block(text: str) -> Block:
+    tokens: list[Tuple[str, list]] = []
+    complete = tokenize_into(text, tokens)
+    code = [[emit_instruction(dict(instr, imm=0) if "label" in instr else instr) for instr in instrs]
+            for _, instrs in tokens]
+    return Block(tokens, code, complete)
+
+
+class IncrementalTranslator:
+    """
+    Translates successive versions of a source, as an editor saves them.
+
+    The source is split into blocks at the lines that start with a label.
+    A block with the same text as in the previous version keeps its tokens
+    and code, so only the edited blocks are parsed again. The code of the
+    kept blocks is copied and only the relative offsets of jumps are
+    computed anew. The result is the same as of `translate_with_labels`.
+    """
+
+    def __init__(self):
+        self._blocks: dict[str, Block] = {}
+        self.parsed: int = 0
+
+    def blocks(self, text: str) -> list[Block]:
+        """The blocks of `text`, parsing the ones not seen in the previous version."""
+        starts = [match.start() for match in BLOCK_START_RE.finditer(text)]
+        bounds = [0] + [start for start in starts if start > 0] + [len(text)]
+        blocks, result = {}, []
+        self.parsed = 0
+        for begin, end in zip(bounds, bounds[1:]):
+            chunk = text[begin:end]
+            block = self._blocks.get(chunk) or blocks.get(chunk)
+            if block is None:
+                block = compile_block(chunk)
+                self.parsed += 1
+            blocks[chunk] = block
+            result.append(block)
+            if not block.complete:
+                break
+        self._blocks = blocks
+        return result
+
+    def translate_with_labels(self, text, optimize: bool = False) -> Tuple[dict, dict[str, int]]:
+        blocks = self.blocks(text + '\n')
+        if optimize:
+            return translate_tokens([(label, [dict(instr) for instr in instrs])
+                                     for block in blocks for label, instrs in block.tokens], True)
+
+        tokens = [(label, instrs, code) for block in blocks for (label, instrs), code in zip(block.tokens, block.code)]
+        order_tokens(tokens)
+        label_positions = get_label_positions(tokens)
+
+        result = []
+        for _, instrs, code in tokens:
+            base = len(result)
+            result += map(dict, code)
+            for idx, instr in enumerate(instrs):
+                if "label" in instr:
+                    result[base + idx]["imm"] = label_positions[instr["label"]] - (base + idx)
+
+        target = {
+            "start": label_positions["_start"],
+            "code": result
+        }
+        return target, label_positions
+
+    def translate(self, text, optimize: bool = False):
+        return self.translate_with_labels(text, optimize)[0]
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(prog="translator.py")
+    parser.add_argument("source")
+    parser.add_argument("target")
+    parser.add_argument("--format", choices=["json", "binary"], default="json",
+                        help="json is kept as a readable debug format")
+    parser.add_argument("--optimize", action="store_true", help="run the peephole passes, see optimize_tokens")
+    return parser.parse_args(args)
 
 
 def main(args):
-    assert len(args) == 2, \
-        "2 argument required <input_file> <target_file>"
-    source, target = args
+    options = parse_args(args)
 
-    with open(source, "rt", encoding="utf-8") as f:
+    with open(options.source, "rt", encoding="utf-8") as f:
         source = f.read()
 
-    program = translate(source)
-    with open(target, "w", encoding="utf-8") as f:
-        f.write(json.dumps(program))
+    program = translate(source, options.optimize)
+    if options.format == "binary":
+        with open(options.target, "wb") as f:
+            f.write(encode_program(program))
+    else:
+        with open(options.target, "w", encoding="utf-8") as f:
+            f.write(json.dumps(program))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,334 @@
+"""
+Vectorized simulation of one program over many input schedules.
+
+Each input schedule is a lane. Registers are an N x 10 array, memory is
+N x M, and every lane has its own PC, counters, interrupt state and mask
+of live code cells. A step fetches for all active lanes at once, takes
+the due interrupts, and then runs each group of lanes that has the same
+instruction handler as one array operation. Self-modifying code only
+clears the lane's live mask.
+
+Registers are unbounded on the scalar machine. Here they are 64-bit, so
+an instruction is done in a lane only when its result is exact and it
+can't fail. Otherwise the lane is handed over unchanged to a scalar
+ControlUnit, which does the instruction and the rest of the run. This
+happens on an error, on an overflow, on an illegal instruction, and at
+the instruction or tick limit. The results are the same as
+`machine.simulation` for each schedule, errors included.
+
+NumPy is an optional dependency, required only by this module.
+"""
+
+from typing import Iterable, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # optional dependency
+    np = None
+
+import machine
+from api import Program, RunResult
+from isa import Register
+from machine import BEQ, HLT, IDLE_JMP, ILLEGAL_INSTRUCTION, IRET, JMP, LD, PC, SP, ST, ALU_OPERATIONS, \
+    AluOperation, ControlUnit, DataPath, InterruptController, MachineConfig
+
+NO_EVENT = 2 ** 63 - 1
+INT64_MIN = -2 ** 63
+REGISTER_NAMES = [register.value for register in Register]
+
+
+def _checked_add(a, b):
+    result = a + b
+    return result, ((a ^ result) & (b ^ result)) < 0
+
+
+def _checked_sub(a, b):
+    result = a - b
+    return result, ((a ^ b) & (a ^ result)) < 0
+
+
+def _checked_mul(a, b):
+    # conservative: a product that might not fit is done by the scalar machine
+    return a * b, np.abs(a.astype(np.float64)) * np.abs(b.astype(np.float64)) >= 2.0 ** 62
+
+
+def _checked_div(a, b):
+    bad = (b == 0) | ((a == INT64_MIN) & (b == -1))
+    return np.floor_divide(a, np.where(bad, 1, b)), bad
+
+
+def _checked_rem(a, b):
+    bad = b == 0
+    return np.remainder(a, np.where(bad, 1, b)), bad
+
+
+CHECKED_OPERATIONS = {
+    AluOperation.ADD: _checked_add,
+    AluOperation.SUB: _checked_sub,
+    AluOperation.MUL: _checked_mul,
+    AluOperation.DIV: _checked_div,
+    AluOperation.REM: _checked_rem,
+}
+
+
+class Lanes:
+    """The state of N machines that run the same decoded code."""
+
+    def __init__(self, program: Program, schedules: list, config: MachineConfig):
+        assert np is not None, "vectorized simulation requires numpy"
+        code = machine.decode_program(program.code)
+        self.code = code
+        self.config = config
+        self.base = config.program_addr
+        self.size = config.memory_size
+        self.input_addr = config.input_addr if config.input_addr is not None else self.size - 2
+        self.output_addr = config.output_addr if config.output_addr is not None else self.size - 1
+        assert self.base + len(code) <= self.size, "Program doesn't fit into memory"
+
+        self.handler = np.array([instr.handler for instr in code], dtype=np.int64)
+        self.rd = np.array([instr.rd or 0 for instr in code], dtype=np.int64)
+        self.rs1 = np.array([instr.rs1 or 0 for instr in code], dtype=np.int64)
+        self.rs2 = np.array([instr.rs2 or 0 for instr in code], dtype=np.int64)
+        self.use_rs1 = np.array([instr.rs1 is not None for instr in code], dtype=bool)
+        self.use_rs2 = np.array([instr.rs2 is not None for instr in code], dtype=bool)
+        self.imm = np.array([instr.imm for instr in code], dtype=np.int64)
+
+        n = len(schedules)
+        self.registers = np.zeros((n, len(Register)), dtype=np.int64)
+        self.registers[:, SP] = config.stack_top if config.stack_top is not None else self.size - 3
+        self.registers[:, PC] = self.base + program.start
+        self.memory = np.zeros((n, self.size), dtype=np.int64)
+        self.memory[:, 0] = self.base
+        self.live = np.ones((n, len(code)), dtype=bool)
+        self.tick = np.zeros(n, dtype=np.int64)
+        self.instr = np.zeros(n, dtype=np.int64)
+        self.interrupted = np.zeros(n, dtype=bool)
+        self.input_buf = np.full(n, -1, dtype=np.int64)
+        self.active = np.ones(n, dtype=bool)
+        self.outputs: list[list[str]] = [[] for _ in range(n)]
+        self.results: list[Optional[RunResult]] = [None] * n
+
+        # events of all lanes in one array, each lane ordered like InterruptController
+        self.event_ticks, self.event_chars, starts, ends = [], [], [], []
+        for schedule in schedules:
+            events = sorted(schedule, key=lambda event: event[0])
+            starts.append(len(self.event_ticks))
+            self.event_ticks += [tick for tick, _ in events]
+            self.event_chars += [char for _, char in events]
+            ends.append(len(self.event_ticks))
+        self.event_ptr = np.array(starts, dtype=np.int64)
+        self.event_end = np.array(ends, dtype=np.int64)
+        self.next_due = np.array([self.event_ticks[start] if start < end else NO_EVENT
+                                  for start, end in zip(starts, ends)], dtype=np.int64)
+
+    def _operands(self, lanes, offsets):
+        registers = self.registers
+        op1 = np.where(self.use_rs1[offsets], registers[lanes, self.rs1[offsets]], self.imm[offsets])
+        op2 = np.where(self.use_rs2[offsets], registers[lanes, self.rs2[offsets]], self.imm[offsets])
+        return op1, op2
+
+    def _readable(self, lanes, addr):
+        """Lanes whose memory read at `addr` succeeds on the scalar machine."""
+        ok = (addr >= -self.size) & (addr < self.size)
+        offset = addr - self.base
+        in_code = (offset >= 0) & (offset < len(self.code))
+        ok[in_code] &= ~self.live[lanes[in_code], offset[in_code]]
+        return ok
+
+    def _write(self, lanes, addr, values):
+        offset = addr - self.base
+        in_code = (offset >= 0) & (offset < len(self.code))
+        self.live[lanes[in_code], offset[in_code]] = False
+        self.memory[lanes, addr] = values
+
+    def _finish(self, lanes, steps, ticks):
+        self.tick[lanes] += ticks
+        self.instr[lanes] += steps
+
+    def handoff(self, lane: int):
+        """Continue a lane on the scalar machine from its current state."""
+        memory = machine.allocate_memory(self.size)
+        np.asarray(memory)[:] = self.memory[lane]
+        data_path = DataPath(memory)
+        data_path.registers = self.registers[lane].tolist()
+        data_path.code = [instr if live else None for instr, live in zip(self.code, self.live[lane])]
+        data_path.code_base = self.base
+        data_path.input_buf = int(self.input_buf[lane])
+        data_path.input_map_addr = self.input_addr
+        data_path.output_map_addr = self.output_addr
+        data_path.output_buf = self.outputs[lane]
+
+        ptr, end = int(self.event_ptr[lane]), int(self.event_end[lane])
+        input_irq = InterruptController(list(zip(self.event_ticks[ptr:end], self.event_chars[ptr:end])))
+        control_unit = ControlUnit(data_path, input_irq, self.config.limit)
+        control_unit.tick_limit = self.config.tick_limit
+        control_unit._tick = int(self.tick[lane])
+        control_unit.instr_counter = int(self.instr[lane])
+        control_unit.is_interrupted = bool(self.interrupted[lane])
+
+        instr = machine.run(control_unit, self.config.limit)
+        self.results[lane] = RunResult(
+            output=''.join(data_path.output_buf),
+            instr=instr,
+            ticks=control_unit.current_tick(),
+            registers=dict(zip(REGISTER_NAMES, data_path.registers)),
+            error=control_unit.error,
+            halted=control_unit.halted,
+        )
+        self.active[lane] = False
+
+    def _handoff_all(self, lanes):
+        for lane in lanes.tolist():
+            self.handoff(lane)
+
+    def step(self) -> bool:
+        """One instruction in every active lane. False when no lane is left."""
+        lanes = np.flatnonzero(self.active)
+        if lanes.size == 0:
+            return False
+
+        offsets = self.registers[lanes, PC] - self.base
+        ok = (offsets >= 0) & (offsets < len(self.code))
+        ok[ok] &= self.live[lanes[ok], offsets[ok]]
+        ok &= self.instr[lanes] < self.config.limit
+        if self.config.tick_limit is not None:
+            ok &= self.tick[lanes] <= self.config.tick_limit - machine.MAX_INSTRUCTION_TICKS
+        self._handoff_all(lanes[~ok])
+        lanes, offsets = lanes[ok], offsets[ok]
+
+        irq = ~self.interrupted[lanes] & (self.next_due[lanes] <= self.tick[lanes] + 1)
+        if irq.any():
+            self._interrupt(lanes[irq])
+            lanes, offsets = lanes[~irq], offsets[~irq]
+
+        handlers = self.handler[offsets]
+        for handler in np.unique(handlers).tolist():
+            group = handlers == handler
+            self._execute(handler, lanes[group], offsets[group])
+        return True
+
+    def _interrupt(self, lanes):
+        sp = self.registers[lanes, SP] - 1
+        ok = (sp >= -self.size) & (sp < self.size)
+        self._handoff_all(lanes[~ok])
+        lanes, sp = lanes[ok], sp[ok]
+
+        self._write(lanes, sp, self.registers[lanes, PC])
+        self.registers[lanes, SP] = sp
+        self.registers[lanes, PC] = self.memory[lanes, 0]
+        self.interrupted[lanes] = True
+        self._finish(lanes, 1, 4)
+        event_ticks, event_chars = self.event_ticks, self.event_chars
+        for lane in lanes.tolist():
+            tick, ptr, end = int(self.tick[lane]) - 3, int(self.event_ptr[lane]), int(self.event_end[lane])
+            char = None
+            while ptr < end and event_ticks[ptr] <= tick:
+                char = event_chars[ptr]
+                ptr += 1
+            self.event_ptr[lane] = ptr
+            self.next_due[lane] = event_ticks[ptr] if ptr < end else NO_EVENT
+            self.input_buf[lane] = ord(char)
+
+    def _execute(self, handler: int, lanes, offsets):
+        if handler >= ILLEGAL_INSTRUCTION and handler != IDLE_JMP:
+            self._handoff_all(lanes)
+        elif handler == HLT:
+            self._finish(lanes, 1, 1)
+            self.active[lanes] = False
+            for lane in lanes.tolist():
+                self.results[lane] = RunResult(
+                    output=''.join(self.outputs[lane]),
+                    instr=int(self.instr[lane]),
+                    ticks=int(self.tick[lane]),
+                    registers=dict(zip(REGISTER_NAMES, self.registers[lane].tolist())),
+                    error=None,
+                    halted=True,
+                )
+        elif handler in (JMP, IDLE_JMP):
+            op1, op2 = self._operands(lanes, offsets)
+            target, bad = _checked_add(op1, op2)
+            self._handoff_all(lanes[bad])
+            lanes = lanes[~bad]
+            self.registers[lanes, PC] = target[~bad]
+            self._finish(lanes, 1, 2)
+            if handler == IDLE_JMP:
+                self._skip_idle(lanes)
+        elif handler == BEQ:
+            op1, op2 = self._operands(lanes, offsets)
+            taken = op1 == op2
+            self.registers[lanes, PC] += np.where(taken, self.imm[offsets], 1)
+            self._finish(lanes, 1, np.where(taken, 3, 2))
+        elif handler == IRET:
+            sp = self.registers[lanes, SP]
+            ok = self._readable(lanes, sp)
+            self._handoff_all(lanes[~ok])
+            lanes, sp = lanes[ok], sp[ok]
+            self.registers[lanes, PC] = self.memory[lanes, sp]
+            self.registers[lanes, SP] = sp - 1
+            self.interrupted[lanes] = False
+            self._finish(lanes, 1, 3)
+        elif handler == LD:
+            self._load(lanes, offsets)
+        elif handler == ST:
+            self._store(lanes, offsets)
+        else:
+            op1, op2 = self._operands(lanes, offsets)
+            result, bad = CHECKED_OPERATIONS[ALU_OPERATIONS[handler]](op1, op2)
+            self._handoff_all(lanes[bad])
+            lanes, offsets = lanes[~bad], offsets[~bad]
+            self.registers[lanes, self.rd[offsets]] = result[~bad]
+            self.registers[lanes, PC] += 1
+            self._finish(lanes, 1, 3)
+
+    def _load(self, lanes, offsets):
+        op1, op2 = self._operands(lanes, offsets)
+        addr, bad = _checked_add(op1, op2)
+        is_input = addr == self.input_addr
+        ok = ~bad & np.where(is_input, self.input_buf[lanes] != -1, self._readable(lanes, np.where(bad, 0, addr)))
+        self._handoff_all(lanes[~ok])
+        lanes, offsets, addr, is_input = lanes[ok], offsets[ok], addr[ok], is_input[ok]
+
+        self.registers[lanes, self.rd[offsets]] = np.where(
+            is_input, self.input_buf[lanes], self.memory[lanes, np.where(is_input, 0, addr)])
+        self.registers[lanes, PC] += 1
+        self._finish(lanes, 1, 3)
+
+    def _store(self, lanes, offsets):
+        op1, op2 = self._operands(lanes, offsets)
+        addr, bad = _checked_add(op1, op2)
+        values = self.registers[lanes, self.rd[offsets]]
+        is_output = addr == self.output_addr
+        in_range = (addr >= -self.size) & (addr < self.size)
+        ok = ~bad & np.where(is_output, (values >= 0) & (values <= 0x10FFFF), in_range)
+        self._handoff_all(lanes[~ok])
+        lanes, addr, values, is_output = lanes[ok], addr[ok], values[ok], is_output[ok]
+
+        for lane, value in zip(lanes[is_output].tolist(), values[is_output].tolist()):
+            self.outputs[lane].append(chr(value))
+        to_memory = ~is_output
+        self._write(lanes[to_memory], addr[to_memory], values[to_memory])
+        self.registers[lanes, PC] += 1
+        self._finish(lanes, 1, 3)
+
+    def _skip_idle(self, lanes):
+        """`ControlUnit.skip_idle_iterations` for each lane, stopping at the limit."""
+        max_iterations = self.config.limit - self.instr[lanes]
+        if self.config.tick_limit is not None:
+            max_iterations = np.minimum(max_iterations, (self.config.tick_limit - self.tick[lanes]) // 2 - 2)
+        max_iterations = np.maximum(max_iterations, 0)
+        due = self.next_due[lanes]
+        skipped = np.where(self.interrupted[lanes] | (due == NO_EVENT), max_iterations,
+                           np.clip((due - self.tick[lanes]) // 2, 0, max_iterations))
+        self._finish(lanes, skipped, 2 * skipped)
+
+
+def simulate_lanes(program: Program, schedules: Iterable[Iterable[Tuple[int, str]]],
+                   config: MachineConfig = MachineConfig()) -> list[RunResult]:
+    """
+    Run `program` from `api.assemble` once per schedule, like `api.run`
+    with each of them. Schedules are read into lists.
+    """
+    lanes = Lanes(program, [list(schedule) for schedule in schedules], config)
+    while lanes.step():
+        pass
+    return lanes.results